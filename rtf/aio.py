@@ -0,0 +1,202 @@
+# Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runtime of the asyncio generated Python clients (generated with --asyncio).
+
+The calls are deferred as in rtf.client, but the nodes are fetched by
+awaiting them: `value = await tf.reduce_sum(x)`.
+"""
+
+import asyncio
+import os
+import sys
+
+from . import client, values
+
+# Used by the generated client, as the ones of rtf.client.
+from .client import Constant, RemoteError, bound  # pylint: disable=unused-import
+
+
+class AsyncSession(client.Session):
+    """Asynchronous connection to a RTF server, built on grpc.aio.
+
+    Every fetch is a DefineAndCall stream on the same channel: up to `depth`
+    streams are in flight at the same time, the other fetches wait for a slot.
+    """
+
+    def __init__(
+        self, target=None, depth=None, shared_memory=None, max_message_size=None
+    ):
+        """
+        Args:
+            target: address of the server, $RTF_TARGET or localhost:50051
+                    by default.
+            depth: maximum number of DefineAndCall in flight,
+                   $RTF_PIPELINE_DEPTH or 64 by default.
+            shared_memory: size in bytes of the shared memory segments, as
+                           in rtf.client.Session.
+            max_message_size: maximum size in bytes of the messages, as in
+                              rtf.client.Session.
+        """
+        super().__init__(target, shared_memory, max_message_size)
+        self.depth = depth or int(os.environ.get("RTF_PIPELINE_DEPTH", "64"))
+        self.in_flight = 0
+        self._channel = None
+        self._slots = None
+
+    def _get_stub(self):
+        # The channel and the semaphore belong to the running event loop:
+        # they are created on first use, in the loop.
+        if self._stub is None:
+            import grpc.aio
+
+            from .proto import rtf_pb2_grpc
+
+            self._channel = grpc.aio.insecure_channel(self.target, self.channel_options)
+            self._stub = rtf_pb2_grpc.RTFStub(self._channel)
+            self._slots = asyncio.Semaphore(self.depth)
+        return self._stub
+
+    def fetch(self, node):
+        raise TypeError(
+            f"{node!r} belongs to an asynchronous session: await it to fetch its value"
+        )
+
+    async def fetch_async(self, node):
+        """Execute the program that computes node, returns its value.
+        The standard output of the program is written to sys.stdout.
+
+        Raises:
+            RemoteError: when the execution fails.
+        """
+        stub = self._get_stub()
+        while True:
+            nodes, program = self._claim(node)
+            if nodes is not None:
+                break
+            await asyncio.wait([asyncio.wrap_future(future) for future in program])
+        computed = False
+        try:
+            async with self._slots:
+                self.round_trips += 1
+                self.in_flight += 1
+                segment = self._acquire()
+                try:
+                    body = None
+                    async for response in stub.DefineAndCall(
+                        iter(self.statements(node, segment, nodes))
+                    ):
+                        if response.stdout:
+                            sys.stdout.write(response.stdout)
+                        if response.error:
+                            raise RemoteError(response.node_id, response.error)
+                        body = self._body(response, segment) or body
+                    computed = True
+                    if body is None:
+                        raise RemoteError(node.node_id, f"{node!r} has no value")
+                    return values.loads(body)
+                finally:
+                    self._release(segment)
+                    self.in_flight -= 1
+        finally:
+            self._done(nodes, program, computed)
+
+    async def stream(self, node, credits=None):
+        """Execute the program that computes the tf.data.Dataset node, and
+        iterate asynchronously the elements of the dataset, streamed by the
+        server with at most `credits` elements ahead of the iteration
+        (as rtf.client.Session.stream).
+
+        Raises:
+            RemoteError: when the execution fails.
+        """
+        from .proto import rtf_pb2
+
+        credits = credits or int(os.environ.get("RTF_STREAM_CREDITS", "16"))
+        stub = self._get_stub()
+        requests = asyncio.Queue()
+        for request in self._stream_requests(node, credits):
+            requests.put_nowait(request)
+
+        async def request_iterator():
+            while (request := await requests.get()) is not None:
+                yield request
+
+        async with self._slots:
+            self.round_trips += 1
+            self.in_flight += 1
+            call = stub.Stream(request_iterator())
+            consumed = 0
+            try:
+                async for response in call:
+                    if response.stdout:
+                        sys.stdout.write(response.stdout)
+                    if response.error:
+                        raise RemoteError(response.node_id, response.error)
+                    if response.element:
+                        yield self._element(response)
+                        consumed += 1
+                        if consumed >= max(credits // 2, 1):
+                            requests.put_nowait(rtf_pb2.StreamRequest(credits=consumed))
+                            consumed = 0
+            finally:
+                requests.put_nowait(None)
+                call.cancel()
+                self.in_flight -= 1
+
+    async def close(self):
+        """Close the channel, remove the shared memory segments."""
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = self._stub = self._slots = None
+        super().close()
+
+
+_SESSION = None
+
+
+def configure(target=None, depth=None, shared_memory=None):
+    """Replace the AsyncSession used by the generated client."""
+    global _SESSION  # pylint: disable=global-statement
+    _SESSION = AsyncSession(target, depth, shared_memory)
+    return _SESSION
+
+
+def default_session():
+    """The AsyncSession used by the generated client."""
+    if _SESSION is None:
+        return configure()
+    return _SESSION
+
+
+def defer(path, args=(), kwargs=None):
+    """Record the call of the remote function (or class) at path, in the
+    asynchronous session. Returns its Node: await it to fetch its value."""
+    return client.defer(path, args, kwargs, default_session())
+
+
+def member(path):
+    """Record the access to the remote member at path, in the asynchronous
+    session. Returns its Node: await it to fetch its value."""
+    return client.member(path, default_session())
+
+
+class Member(client.Member):
+    """A member of a remote class whose value can change, recorded in the
+    asynchronous session (see rtf.client.Member)."""
+
+    __slots__ = ()
+
+    def __get__(self, instance, owner=None):
+        return member(self.path)
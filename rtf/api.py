@@ -0,0 +1,421 @@
+# Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact in-memory model of the TensorFlow API, built from the golden protos.
+
+The nodes are immutable, use __slots__ and their strings are interned:
+identical members and methods (e.g. the same __init__ argspec) are shared
+among every object and every model.
+"""
+
+import bisect
+import hashlib
+import sys
+
+
+class APIMember:
+    """A member (attribute, submodule, class) of a module or class."""
+
+    __slots__ = ("name", "mtype")
+
+    def __init__(self, name, mtype):
+        self.name = name
+        self.mtype = mtype
+
+    def __repr__(self):
+        return f"APIMember({self.name!r}, {self.mtype!r})"
+
+
+class APIMethod:
+    """A method of a module or class. argspec is None when unknown."""
+
+    __slots__ = ("name", "path", "argspec")
+
+    def __init__(self, name, path, argspec):
+        self.name = name
+        self.path = path
+        self.argspec = argspec
+
+    def __repr__(self):
+        return f"APIMethod({self.name!r}, {self.argspec!r})"
+
+
+class APIScope:
+    """The content of a module or class: tuples of members and methods.
+    is_instance is the (sanitized) MRO of a class, empty for modules."""
+
+    __slots__ = ("member", "member_method", "is_instance")
+
+    def __init__(self, member, member_method, is_instance=()):
+        self.member = member
+        self.member_method = member_method
+        self.is_instance = is_instance
+
+
+class APIObject:
+    """A module, a class or a protocol buffer of the API.
+
+    Exactly one of tf_module and tf_class is set, for modules and classes.
+    Protocol buffers have neither and tf_proto set to True.
+    digest is the hash of the golden proto the object has been built from.
+    """
+
+    __slots__ = ("path", "tf_module", "tf_class", "tf_proto", "digest")
+
+    def __init__(self, path, tf_module, tf_class, tf_proto, digest):
+        self.path = path
+        self.tf_module = tf_module
+        self.tf_class = tf_class
+        self.tf_proto = tf_proto
+        self.digest = digest
+
+    @property
+    def scope(self):
+        """The APIScope of the module or class, None for protos."""
+        return self.tf_module if self.tf_module is not None else self.tf_class
+
+    @property
+    def kind(self):
+        """ "module", "class" or "proto"."""
+        if self.tf_module is not None:
+            return "module"
+        return "class" if self.tf_class is not None else "proto"
+
+    def __repr__(self):
+        return f"APIObject({self.path!r}, {self.kind})"
+
+
+class _Interner:
+    """Shares the equal strings and nodes created while building the models."""
+
+    def __init__(self):
+        self._nodes = {}
+
+    def member(self, member):
+        key = ("member", member.name, member.mtype)
+        if key not in self._nodes:
+            self._nodes[key] = APIMember(
+                sys.intern(member.name), sys.intern(member.mtype)
+            )
+        return self._nodes[key]
+
+    def method(self, method):
+        argspec = method.argspec if method.HasField("argspec") else None
+        key = ("method", method.name, method.path, argspec)
+        if key not in self._nodes:
+            self._nodes[key] = APIMethod(
+                sys.intern(method.name),
+                sys.intern(method.path),
+                sys.intern(argspec) if argspec is not None else None,
+            )
+        return self._nodes[key]
+
+    def scope(self, proto, is_instance=()):
+        return APIScope(
+            tuple(self.member(member) for member in proto.member),
+            tuple(self.method(method) for method in proto.member_method),
+            tuple(sys.intern(cls) for cls in is_instance),
+        )
+
+
+_INTERNER = _Interner()
+
+
+class APIModel:
+    """Read-only mapping from the keys of the golden proto dict to the
+    APIObject of the API, with parent/children indexes on the keys.
+    """
+
+    def __init__(self, objects):
+        """
+        Args:
+            objects: dict key -> APIObject.
+        """
+        self._objects = objects
+        self._parents = {}
+        self._children = {}
+        for key in objects:
+            parent = key.rpartition(".")[0]
+            while parent and parent not in objects:
+                parent = parent.rpartition(".")[0]
+            if parent:
+                self._parents[key] = parent
+                self._children.setdefault(parent, []).append(key)
+
+    @staticmethod
+    def from_golden_proto_dict(golden_proto_dict):
+        """Build the model of the golden proto dict."""
+        objects = {}
+        for key, tf_api_object in golden_proto_dict.items():
+            tf_module = tf_class = None
+            if tf_api_object.HasField("tf_module"):
+                tf_module = _INTERNER.scope(tf_api_object.tf_module)
+            elif tf_api_object.HasField("tf_class"):
+                tf_class = _INTERNER.scope(
+                    tf_api_object.tf_class, tf_api_object.tf_class.is_instance
+                )
+            objects[sys.intern(key)] = APIObject(
+                sys.intern(tf_api_object.path),
+                tf_module,
+                tf_class,
+                tf_api_object.HasField("tf_proto"),
+                hashlib.sha256(
+                    tf_api_object.SerializeToString(deterministic=True)
+                ).hexdigest(),
+            )
+        return APIModel(objects)
+
+    def filter(self, omit_golden_symbols_map):
+        """Returns a view of the model without the omitted symbols.
+        Only the scopes of the filtered objects are new, the other objects
+        and every member and method are shared with this model.
+
+        Args:
+            omit_golden_symbols_map: dict key -> list of member names to omit.
+        """
+        if not omit_golden_symbols_map:
+            return self
+        objects = dict(self._objects)
+        for key, symbol_list in omit_golden_symbols_map.items():
+            api_object = objects[key]
+            scope = api_object.scope
+            if scope is None:
+                continue
+            scope = APIScope(
+                tuple(m for m in scope.member if m.name not in symbol_list),
+                tuple(m for m in scope.member_method if m.name not in symbol_list),
+                scope.is_instance,
+            )
+            digest = hashlib.sha256(api_object.digest.encode())
+            digest.update(repr(sorted(symbol_list)).encode())
+            objects[key] = APIObject(
+                api_object.path,
+                scope if api_object.tf_module is not None else None,
+                scope if api_object.tf_class is not None else None,
+                api_object.tf_proto,
+                digest.hexdigest(),
+            )
+        return APIModel(objects)
+
+    def subset(self, keys):
+        """Returns a view of the model with only the objects in keys,
+        in the order of the model."""
+        keys = set(keys)
+        return APIModel({key: obj for key, obj in self._objects.items() if key in keys})
+
+    def parent(self, key):
+        """The key of the closest object containing key, or None."""
+        return self._parents.get(key)
+
+    def children(self, key):
+        """The keys of the objects whose parent is key."""
+        return tuple(self._children.get(key, ()))
+
+    def __getitem__(self, key):
+        return self._objects[key]
+
+    def __contains__(self, key):
+        return key in self._objects
+
+    def __iter__(self):
+        return iter(self._objects)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def keys(self):
+        return self._objects.keys()
+
+    def values(self):
+        return self._objects.values()
+
+    def items(self):
+        return self._objects.items()
+
+
+class Symbol:
+    """A symbol of the API: an object (module, class, proto) or one of the
+    members/methods of a module or class.
+
+    kind is one of "module", "class", "proto", "member", "method".
+    mtype is set for members, argspec for methods (None when unknown).
+    """
+
+    __slots__ = ("path", "kind", "mtype", "argspec")
+
+    def __init__(self, path, kind, mtype=None, argspec=None):
+        self.path = path
+        self.kind = kind
+        self.mtype = mtype
+        self.argspec = argspec
+
+    def __repr__(self):
+        return f"Symbol({self.path!r}, {self.kind!r})"
+
+
+class SymbolIndex:
+    """Index of the fully qualified symbols of an APIModel.
+
+    Exact and member lookups are dictionary lookups, prefix enumeration is a
+    binary search over the sorted paths.
+    The paths can use the aliases in ALIASES, e.g. tf.keras.layers.Dense.
+    """
+
+    ALIASES = {"tf": "tensorflow"}
+
+    _KINDS = ("module", "class", "proto")
+
+    def __init__(self, api_model):
+        self._symbols = {}
+        self._members = {}
+        for key, api_object in api_model.items():
+            scope = api_object.scope
+            self._symbols[key] = Symbol(key, api_object.kind)
+            if scope is None:
+                continue
+            members = self._members.setdefault(key, {})
+            for member in scope.member:
+                path = f"{key}.{member.name}"
+                members[member.name] = self._symbols.setdefault(
+                    path, Symbol(path, "member", mtype=member.mtype)
+                )
+            for method in scope.member_method:
+                path = f"{key}.{method.name}"
+                members[method.name] = self._symbols[path] = Symbol(
+                    path, "method", argspec=method.argspec
+                )
+        # Members that are modules or classes are the objects themselves.
+        for key, members in self._members.items():
+            for name in members:
+                path = f"{key}.{name}"
+                if self._symbols[path].kind in SymbolIndex._KINDS:
+                    members[name] = self._symbols[path]
+        self._paths = sorted(self._symbols)
+
+    @staticmethod
+    def _expand(path):
+        head, dot, tail = path.partition(".")
+        return SymbolIndex.ALIASES.get(head, head) + dot + tail
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def __contains__(self, path):
+        return SymbolIndex._expand(path) in self._symbols
+
+    def lookup(self, path):
+        """Returns the Symbol with the fully qualified path, or None."""
+        return self._symbols.get(SymbolIndex._expand(path))
+
+    def members(self, path):
+        """Returns the dict name -> Symbol of the members and methods of the
+        module or class at path (empty if path is not a module or class)."""
+        return self._members.get(SymbolIndex._expand(path), {})
+
+    def prefix(self, prefix):
+        """Returns the sorted list of the paths starting with prefix."""
+        prefix = SymbolIndex._expand(prefix)
+        start = bisect.bisect_left(self._paths, prefix)
+        end = bisect.bisect_left(self._paths, prefix + "\U0010ffff", start)
+        return self._paths[start:end]
+
+    def validate(self, path):
+        """Check that path refers to an existing symbol, as far as the API
+        describes it: the attributes of members (e.g. of an instance like
+        tf.float32), of the values returned by methods and the private
+        attributes (e.g. __call__) are not known, and are considered valid.
+
+        Returns:
+            None if path is valid, otherwise the longest invalid prefix.
+        """
+        parts = SymbolIndex._expand(path).split(".")
+        current = parts[0]
+        if current not in self._symbols:
+            return current
+        for part in parts[1:]:
+            symbol = self._symbols[current]
+            if symbol.kind not in ("module", "class") or part.startswith("_"):
+                return None
+            current = f"{current}.{part}"
+            if part not in self._members.get(symbol.path, ()):
+                return current
+        return None
+
+
+def _scope_entries(api_object):
+    """Returns the dict name -> (kind, mtype or argspec) of the members and
+    methods of the object."""
+    scope = api_object.scope
+    if scope is None:
+        return {}
+    entries = {member.name: ("member", member.mtype) for member in scope.member}
+    entries.update(
+        (method.name, ("method", method.argspec)) for method in scope.member_method
+    )
+    return entries
+
+
+def diff(old_model, new_model):
+    """Compute the differences between two APIModel.
+
+    The objects with the same digest are unchanged and skipped without
+    comparing their members.
+
+    Returns:
+        dict with the keys:
+            "added", "removed": the sorted lists of the keys of the objects
+                                added to/removed from new_model.
+            "changed": dict key -> changes, for the objects in both models
+                       whose content differs. The changes are a dict with
+                       "added"/"removed" (sorted names of the members and
+                       methods) and "changed" (name -> {"old", "new"}, the
+                       old and new mtype or argspec of the member/method).
+                       "kind" ({"old", "new"}: "module", "class" or "proto")
+                       is set when the kind of the object changed, otherwise
+                       "is_instance" (the old and new MRO) if it changed.
+    """
+    changed = {}
+    for key in old_model.keys() & new_model.keys():
+        old_object, new_object = old_model[key], new_model[key]
+        if old_object.digest == new_object.digest:
+            continue
+        old_entries = _scope_entries(old_object)
+        new_entries = _scope_entries(new_object)
+        changes = {
+            "added": sorted(new_entries.keys() - old_entries.keys()),
+            "removed": sorted(old_entries.keys() - new_entries.keys()),
+            "changed": {
+                name: {"old": old_entries[name][1], "new": new_entries[name][1]}
+                for name in sorted(old_entries.keys() & new_entries.keys())
+                if old_entries[name] != new_entries[name]
+            },
+        }
+        # e.g. a class that became a module, or a changed MRO.
+        if old_object.kind != new_object.kind:
+            changes["kind"] = {"old": old_object.kind, "new": new_object.kind}
+        elif (
+            old_object.scope is not None
+            and old_object.scope.is_instance != new_object.scope.is_instance
+        ):
+            changes["is_instance"] = {
+                "old": list(old_object.scope.is_instance),
+                "new": list(new_object.scope.is_instance),
+            }
+        changed[key] = changes
+
+    return {
+        "added": sorted(new_model.keys() - old_model.keys()),
+        "removed": sorted(old_model.keys() - new_model.keys()),
+        "changed": dict(sorted(changed.items())),
+    }
@@ -0,0 +1,133 @@
+# Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of the responses of deterministic programs."""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .proto import rtf_pb2
+
+
+def fingerprint(statements, shared=None):
+    """Compute the key of a program: the hash of its statements and of the
+    content of the input files they declare.
+
+    Args:
+        statements: the list of RTFStatement that define the program.
+        shared: the values uploaded by the client in shared memory, read
+                by the statements, or None.
+    Returns:
+        the hex digest of the key.
+    """
+    digest = hashlib.sha256()
+    inputs = set()
+    for statement in statements:
+        # The uuid identifies the client, not the program: it's ignored.
+        digest.update(
+            f"{statement.node_id}:{statement.parent_id}:"
+            f"{list(statement.contexts)}:{len(statement.stmt)}:".encode()
+        )
+        digest.update(statement.stmt.encode())
+        digest.update(f"{len(statement.value)}:".encode())
+        digest.update(statement.value)
+        inputs.update(statement.inputs)
+    if shared is not None:
+        digest.update(f"\0shared:{len(shared)}\0".encode())
+        digest.update(shared)
+
+    for path in sorted(inputs):
+        digest.update(f"\0{path}\0".encode())
+        try:
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b""):
+                    digest.update(chunk)
+        except OSError as error:
+            digest.update(f"{type(error).__name__}".encode())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of the responses streamed by the executed programs,
+    bounded by the size in bytes of the serialized responses.
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        Args:
+            max_size: maximum size in bytes of the cached responses.
+            ttl: seconds after which a cached entry expires.
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key):
+        """Returns the list of cached RTFResponse for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                logging.debug("cache miss %s, %s", key, self.stats())
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            logging.debug("cache hit %s, %s", key, self.stats())
+            serialized = entry[2]
+
+        return [rtf_pb2.RTFResponse.FromString(response) for response in serialized]
+
+    def put(self, key, responses):
+        """Cache the list of RTFResponse for key, evicting the least
+        recently used entries when needed.
+        """
+        serialized = [response.SerializeToString() for response in responses]
+        size = sum(len(response) for response in serialized)
+        if size > self._max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._size + size > self._max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (time.monotonic() + self._ttl, size, serialized)
+            self._size += size
+
+    def stats(self):
+        """Returns the cache metrics as a dict."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
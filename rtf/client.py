@@ -0,0 +1,678 @@
+# Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runtime of the generated Python clients."""
+
+import collections
+import inspect
+import itertools
+import math
+import os
+import sys
+import threading
+import uuid
+import weakref
+
+from . import values
+
+
+class Constant:
+    """A member of the remote API whose value never changes (a dtype, an enum
+    member, a str or int constant...). The generated clients bake the constants
+    in the stubs: accessing them doesn't call the server, and the remote code
+    refers to them by path.
+    """
+
+    __slots__ = ("path", "mtype")
+
+    def __init__(self, path, mtype):
+        """
+        Args:
+            path: the path of the member, e.g. tensorflow.float32.
+            mtype: the type of the member, as in the golden protos.
+        """
+        self.path = path
+        self.mtype = mtype
+
+    def __eq__(self, other):
+        return isinstance(other, Constant) and self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return self.path.replace("tensorflow.", "tf.", 1)
+
+
+class RemoteError(Exception):
+    """Raised when the execution of a program on the server fails.
+    The message is the traceback sent by the server."""
+
+    def __init__(self, node_id, error):
+        super().__init__(error)
+        self.node_id = node_id
+
+
+class Session:
+    """Connection to a RTF server.
+
+    The calls of the generated client are not executed when made: every call
+    records a Node, that refers to the nodes of its arguments. When the value
+    of a node is needed, the statements of the node and of its ancestors are
+    sent in a single DefineAndCall, so the number of round trips depends on the
+    number of values fetched, not on the number of calls.
+
+    The server keeps the nodes computed by the programs in the namespace of
+    the client (RTFStatement.keep), until they're garbage collected: every
+    node is computed once, and the next programs refer to it. A program that
+    depends on nodes computed by a program in flight waits for it.
+    """
+
+    def __init__(self, target=None, shared_memory=None, max_message_size=None):
+        """
+        Args:
+            target: address of the server, $RTF_TARGET or localhost:50051
+                    by default.
+            shared_memory: size in bytes of the shared memory segments used
+                           to exchange the large values with a server on the
+                           same host, connected through a unix: target (see
+                           rtf.shm). $RTF_SHARED_MEMORY or 64 MiB by default,
+                           0 disables them.
+            max_message_size: maximum size in bytes of the messages sent and
+                              received, $RTF_MAX_MESSAGE_SIZE or 256 MiB by
+                              default.
+        """
+        self.target = target or os.environ.get("RTF_TARGET", "localhost:50051")
+        if max_message_size is None:
+            max_message_size = int(
+                os.environ.get("RTF_MAX_MESSAGE_SIZE", 256 * 1024 * 1024)
+            )
+        self.channel_options = [
+            ("grpc.max_send_message_length", max_message_size),
+            ("grpc.max_receive_message_length", max_message_size),
+        ]
+        self.uuid = str(uuid.uuid4())
+        self.round_trips = 0
+        self._stub = None
+        self._lock = threading.Lock()
+        # Guards the state of the nodes (computed, program).
+        self._nodes_lock = threading.Lock()
+        # The names of the collected nodes, removed from the namespace of the
+        # client by the next program.
+        self._released = collections.deque()
+        self._segments = None
+        if shared_memory is None:
+            shared_memory = int(os.environ.get("RTF_SHARED_MEMORY", 64 * 1024 * 1024))
+        if shared_memory and self.target.startswith("unix:"):
+            from . import shm
+
+            self._segments = shm.SegmentPool(shared_memory)
+            weakref.finalize(self, self._segments.close)
+
+    def _get_stub(self):
+        # grpc and the protos are imported on first use: importing the
+        # generated client stays cheap.
+        with self._lock:
+            if self._stub is None:
+                import grpc
+
+                from .proto import rtf_pb2_grpc
+
+                self._stub = rtf_pb2_grpc.RTFStub(
+                    grpc.insecure_channel(self.target, self.channel_options)
+                )
+            return self._stub
+
+    @staticmethod
+    def _ancestors(node, claimed=True):
+        """The ancestors of node (and node) not computed on the server, by
+        node_id, and the programs in flight computing some of them (if
+        claimed, the nodes they compute are not in the ancestors)."""
+        nodes, programs, stack = {}, set(), [node]
+        while stack:
+            current = stack.pop()
+            if current.node_id in nodes or current.computed:
+                continue
+            if current.program is not None and claimed:
+                programs.add(current.program)
+                continue
+            nodes[current.node_id] = current
+            stack.extend(current.inputs)
+        return nodes, programs
+
+    def _claim(self, node):
+        """Claim the nodes to compute to fetch node: returns them, with the
+        future of the program computing them, or None and the futures of the
+        programs in flight to wait for."""
+        with self._nodes_lock:
+            nodes, programs = self._ancestors(node)
+            if programs:
+                return None, programs
+            from concurrent import futures
+
+            program = futures.Future()
+            for current in nodes.values():
+                current.program = program
+            return nodes, program
+
+    def _done(self, nodes, program, computed):
+        """The program computing nodes ended: they're computed on the
+        server (and released when collected), if it succeeded."""
+        with self._nodes_lock:
+            for current in nodes.values():
+                current.program = None
+                current.computed = computed
+                if computed:
+                    # The uploaded value is on the server.
+                    current._data = None  # pylint: disable=protected-access
+                    weakref.finalize(current, self._released.append, current.name)
+        program.set_result(computed)
+
+    def statements(self, node, segment=None, nodes=None):
+        """The RTFStatement that compute node and return its value,
+        referring to the nodes computed by the previous programs.
+        The large values are uploaded in the shared memory segment, if any.
+
+        Args:
+            node: the Node.
+            segment: the shared memory segment, or None.
+            nodes: the nodes to compute (see _claim), by node_id. None for
+                   the ancestors of node not computed yet, without
+                   claiming them: their values are not kept.
+        """
+        from . import shm
+        from .proto import rtf_pb2
+
+        def statement(current):
+            # The values are sent in RTFStatement.value, the large ones
+            # uploaded in shared memory if possible.
+            data = current._data  # pylint: disable=protected-access
+            offset = None
+            if data is not None and segment is not None and len(data) >= shm.MIN_SIZE:
+                offset = segment.put(data)
+            if offset is not None:
+                return rtf_pb2.RTFStatement(
+                    uuid=self.uuid,
+                    node_id=current.node_id,
+                    stmt=current.statement(
+                        lambda data: f"rtf_load_shared({offset}, {len(data)})"
+                    ),
+                )
+            return rtf_pb2.RTFStatement(
+                uuid=self.uuid,
+                node_id=current.node_id,
+                stmt=current.statement(),
+                value=data,
+            )
+
+        if nodes is None:
+            with self._nodes_lock:
+                nodes, _ = self._ancestors(node, claimed=False)
+        released = []
+        while self._released:
+            released.append(self._released.popleft())
+
+        # Sorted by node_id: every node is created after its inputs.
+        statements = [statement(nodes[node_id]) for node_id in sorted(nodes)]
+        statements.append(
+            rtf_pb2.RTFStatement(
+                uuid=self.uuid,
+                node_id=node.node_id,
+                parent_id=node.node_id,
+                stmt=f"rtf_return({node.name})",
+                shared=segment.region() if segment is not None else None,
+                keep=True,
+                release=released,
+            )
+        )
+        return statements
+
+    @staticmethod
+    def _body(response, segment):
+        """The serialized value in the response (in its body, or in the
+        shared memory segment), or None."""
+        if response.HasField("shared_body"):
+            return segment.view(response.shared_body)
+        return response.body or None
+
+    def _acquire(self):
+        """The shared memory segment of a call, or None."""
+        return self._segments.acquire() if self._segments is not None else None
+
+    def _release(self, segment):
+        if segment is not None:
+            self._segments.release(segment)
+
+    def close(self):
+        """Remove the shared memory segments."""
+        if self._segments is not None:
+            self._segments.close()
+
+    def fetch(self, node):
+        """Execute the program that computes node, returns its value.
+        The standard output of the program is written to sys.stdout.
+
+        Raises:
+            RemoteError: when the execution fails.
+        """
+        while True:
+            nodes, program = self._claim(node)
+            if nodes is not None:
+                break
+            from concurrent import futures
+
+            futures.wait(program)
+        self.round_trips += 1
+        segment = self._acquire()
+        computed = False
+        try:
+            body = None
+            for response in self._get_stub().DefineAndCall(
+                iter(self.statements(node, segment, nodes))
+            ):
+                if response.stdout:
+                    sys.stdout.write(response.stdout)
+                if response.error:
+                    raise RemoteError(response.node_id, response.error)
+                body = self._body(response, segment) or body
+            computed = True
+            if body is None:
+                raise RemoteError(node.node_id, f"{node!r} has no value")
+            return values.loads(body)
+        finally:
+            self._done(nodes, program, computed)
+            self._release(segment)
+
+    async def fetch_async(self, node):
+        """fetch, in a thread of the default executor of the running loop."""
+        import asyncio  # only the asynchronous clients pay its import
+
+        return await asyncio.get_running_loop().run_in_executor(None, self.fetch, node)
+
+    def _stream_requests(self, node, credits):
+        """The StreamRequest of the program that streams the dataset node,
+        with the first credits."""
+        from .proto import rtf_pb2
+
+        statements = self.statements(node)
+        statements[-1].stmt = f"rtf_stream({node.name})"
+        requests = [rtf_pb2.StreamRequest(statement=stmt) for stmt in statements]
+        requests.append(rtf_pb2.StreamRequest(credits=credits))
+        return requests
+
+    @staticmethod
+    def _element(response):
+        """The element of the dataset in the response of Stream: a tuple of
+        its components, or its only component."""
+        components = tuple(values.loads(data) for data in response.element)
+        return components[0] if len(components) == 1 else components
+
+    def stream(self, node, credits=None):
+        """Execute the program that computes the tf.data.Dataset node, and
+        iterate the elements of the dataset, streamed by the server (as
+        numpy arrays: a tuple of them for the nested elements).
+        The client grants the credits: at most `credits` elements are sent
+        ahead of the iteration, $RTF_STREAM_CREDITS or 16 by default.
+
+        Raises:
+            RemoteError: when the execution fails.
+        """
+        import queue
+
+        from .proto import rtf_pb2
+
+        credits = credits or int(os.environ.get("RTF_STREAM_CREDITS", "16"))
+        requests = queue.SimpleQueue()
+        for request in self._stream_requests(node, credits):
+            requests.put(request)
+        self.round_trips += 1
+        call = self._get_stub().Stream(iter(requests.get, None))
+        # The consumed elements are granted again in batches.
+        consumed = 0
+        try:
+            for response in call:
+                if response.stdout:
+                    sys.stdout.write(response.stdout)
+                if response.error:
+                    raise RemoteError(response.node_id, response.error)
+                if response.element:
+                    yield self._element(response)
+                    consumed += 1
+                    if consumed >= max(credits // 2, 1):
+                        requests.put(rtf_pb2.StreamRequest(credits=consumed))
+                        consumed = 0
+        finally:
+            requests.put(None)
+            call.cancel()
+
+
+_SESSION = None
+
+
+def default_session():
+    """The Session used by the generated client."""
+    global _SESSION  # pylint: disable=global-statement
+    if _SESSION is None:
+        _SESSION = Session()
+    return _SESSION
+
+
+def stream(node, credits=None):
+    """Iterate the elements of the tf.data.Dataset node, streamed by the
+    server (see Session.stream)."""
+    return node.session.stream(node, credits)
+
+
+def _source(value):
+    """The Python source of a call argument, and the nodes it refers to."""
+    if isinstance(value, Node):
+        return value.name, [value]
+    if isinstance(value, Constant):
+        return repr(value), []
+    if isinstance(value, _Slice):
+        sources, nodes = [], []
+        for item in (value.value.start, value.value.stop, value.value.step):
+            source, item_nodes = _source(item) if item is not None else ("", [])
+            sources.append(source)
+            nodes.extend(item_nodes)
+        return ":".join(sources), nodes
+    if isinstance(value, (list, tuple)):
+        sources, nodes = [], []
+        for item in value:
+            source, item_nodes = _source(item)
+            sources.append(source)
+            nodes.extend(item_nodes)
+        if isinstance(value, list):
+            return f"[{', '.join(sources)}]", nodes
+        return f"({', '.join(sources)}{',' if len(sources) == 1 else ''})", nodes
+    if isinstance(value, dict):
+        sources, nodes = [], []
+        for key, item in value.items():
+            source, item_nodes = _source(item)
+            sources.append(f"{key!r}: {source}")
+            nodes.extend(item_nodes)
+        return f"{{{', '.join(sources)}}}", nodes
+    if isinstance(value, float) and not math.isfinite(value):
+        return f"float({str(value)!r})", []
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        return repr(value), []
+    if hasattr(value, "__array__"):
+        # A node of its own: its statement loads the value, from the message
+        # or from shared memory (see Session.statements).
+        node = Node.of_value(value)
+        return node.name, [node]
+    raise TypeError(f"Unsupported argument type {type(value).__name__}")
+
+
+class Node:
+    """A value computed on the server, deferred until fetched.
+
+    The attributes, the calls and the operators on a Node create new nodes.
+    The value is fetched (with a single round trip, see Session) by numpy(),
+    and by the conversions to Python values (float, int, bool, str, len...).
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, expression, inputs, session=None):
+        """
+        Args:
+            expression: the Python source that computes the value,
+                        referring to the names of the nodes in inputs.
+            inputs: the nodes the expression refers to.
+            session: the Session executing the node, the default one if None.
+        """
+        self.node_id = next(Node._ids)
+        self.name = f"_n{self.node_id}"
+        self.expression = expression
+        self.inputs = tuple(inputs)
+        self.session = session or (
+            self.inputs[0].session if self.inputs else default_session()
+        )
+        self.fetched = False
+        # True once computed on the server, that keeps it for the next
+        # programs. The future of the program computing it, while in flight.
+        self.computed = False
+        self.program = None
+        self._value = None
+        self._data = None
+
+    @staticmethod
+    def of_value(value, session=None):
+        """The Node of a value of the client (e.g. a numpy array), sent
+        serialized with the program."""
+        data = values.dumps(value)
+        node = Node(f"rtf_load(<{len(data)} bytes>)", (), session)
+        node._data = data
+        return node
+
+    def statement(self, load=None):
+        """The statement that assigns the value of the node to its name.
+
+        Args:
+            load: the function returning the source that loads a serialized
+                  value, rtf_load(node_id) by default: the value is sent in
+                  the RTFStatement.
+        """
+        load = load or (lambda data: f"rtf_load({self.node_id})")
+        if self._data is not None:
+            return f"{self.name} = {load(self._data)}"
+        return f"{self.name} = {self.expression}"
+
+    def numpy(self):
+        """The value of the node (a numpy array or scalar), fetched once."""
+        if not self.fetched:
+            self._value = self.session.fetch(self)
+            self.fetched = True
+        return self._value
+
+    def __await__(self):
+        """Fetch the value with an asynchronous session (see rtf.aio)."""
+        return self._fetch_async().__await__()
+
+    async def _fetch_async(self):
+        if not self.fetched:
+            self._value = await self.session.fetch_async(self)
+            self.fetched = True
+        return self._value
+
+    def _apply(self, template, *operands):
+        sources, inputs = [], []
+        for operand in operands:
+            source, nodes = _source(operand)
+            sources.append(source)
+            inputs.extend(nodes)
+        return Node(template.format(*sources), inputs, self.session)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._apply(f"{{}}.{name}", self)
+
+    def __call__(self, *args, **kwargs):
+        return _call(self._apply("{}", self), args, kwargs, self.session)
+
+    def __getitem__(self, key):
+        keys = key if isinstance(key, tuple) else (key,)
+        sources, inputs = [], [self]
+        for item in keys:
+            source, nodes = _source(_Slice(item) if isinstance(item, slice) else item)
+            sources.append(source)
+            inputs.extend(nodes)
+        return Node(f"{self.name}[{', '.join(sources)}]", inputs, self.session)
+
+    def __array__(self, dtype=None, copy=None):
+        import numpy as np
+
+        return np.asarray(self.numpy(), dtype=dtype)
+
+    def __bool__(self):
+        return bool(self.numpy())
+
+    def __int__(self):
+        return int(self.numpy())
+
+    def __index__(self):
+        return int(self.numpy())
+
+    def __float__(self):
+        return float(self.numpy())
+
+    def __len__(self):
+        return len(self.numpy())
+
+    def __iter__(self):
+        return iter(self.numpy())
+
+    def __str__(self):
+        return str(self.numpy())
+
+    def __repr__(self):
+        return f"<rtf.Node {self.name} = {self.expression}>"
+
+
+class _Slice:
+    """A slice in the subscript of a Node."""
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _binary(template):
+    return lambda self, other: self._apply(template, self, other)
+
+
+def _reflected(template):
+    return lambda self, other: self._apply(template, other, self)
+
+
+for _name, _operator in (
+    ("add", "+"),
+    ("sub", "-"),
+    ("mul", "*"),
+    ("truediv", "/"),
+    ("floordiv", "//"),
+    ("mod", "%"),
+    ("pow", "**"),
+    ("matmul", "@"),
+    ("and", "&"),
+    ("or", "|"),
+    ("xor", "^"),
+):
+    setattr(Node, f"__{_name}__", _binary(f"({{}} {_operator} {{}})"))
+    setattr(Node, f"__r{_name}__", _reflected(f"({{}} {_operator} {{}})"))
+for _name, _operator in (("lt", "<"), ("le", "<="), ("gt", ">"), ("ge", ">=")):
+    setattr(Node, f"__{_name}__", _binary(f"({{}} {_operator} {{}})"))
+Node.__neg__ = lambda self: self._apply("(-{})", self)
+Node.__abs__ = lambda self: self._apply("abs({})", self)
+Node.__invert__ = lambda self: self._apply("(~{})", self)
+
+
+def _call(function, args, kwargs, session=None):
+    """The Node of the call of function (a Node or a Constant/path source)."""
+    sources, inputs = [], []
+    if isinstance(function, Node):
+        sources.append(function.name)
+        inputs.append(function)
+    else:
+        sources.append(function)
+    arguments = []
+    for value in args:
+        source, nodes = _source(value)
+        arguments.append(source)
+        inputs.extend(nodes)
+    for key, value in kwargs.items():
+        source, nodes = _source(value)
+        arguments.append(f"{key}={source}")
+        inputs.extend(nodes)
+    return Node(f"{sources[0]}({', '.join(arguments)})", inputs, session)
+
+
+def defer(path, args=(), kwargs=None, session=None):
+    """Record the call of the remote function (or class) at path, e.g.
+    tensorflow.math.add. Returns its Node, executed when fetched."""
+    return _call(path.replace("tensorflow.", "tf.", 1), args, kwargs or {}, session)
+
+
+def member(path, session=None):
+    """Record the access to the remote member at path whose value can
+    change, e.g. a variable of a module. Returns its Node."""
+    return Node(path.replace("tensorflow.", "tf.", 1), (), session)
+
+
+class Member:
+    """A member of a remote class whose value can change (a property, a
+    class attribute...): accessing it on the generated class records a Node
+    of the member. The instances of the generated classes are nodes, their
+    members are nodes too (see Node.__getattr__)."""
+
+    __slots__ = ("path",)
+
+    def __init__(self, path):
+        self.path = path
+
+    def __get__(self, instance, owner=None):
+        return member(self.path)
+
+
+def bound(function, arguments):
+    """The (args, kwargs) of a call of a generated stub, from its locals().
+    The arguments equal to their default value are not sent: the server
+    uses the real defaults, the generated ones are approximations."""
+    code = function.__code__
+    positional = code.co_varnames[: code.co_argcount]
+    keyword_only = code.co_varnames[
+        code.co_argcount : code.co_argcount + code.co_kwonlyargcount
+    ]
+    index = code.co_argcount + code.co_kwonlyargcount
+    varargs = varkw = None
+    if code.co_flags & inspect.CO_VARARGS:
+        varargs = code.co_varnames[index]
+        index += 1
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        varkw = code.co_varnames[index]
+    defaults = dict(
+        zip(
+            positional[len(positional) - len(function.__defaults__ or ()) :],
+            function.__defaults__ or (),
+        )
+    )
+    defaults.update(function.__kwdefaults__ or {})
+
+    # With variadic positional arguments, every positional argument must be
+    # passed by position.
+    by_position = varargs is not None and bool(arguments[varargs])
+    args, kwargs = [], {}
+    for name in positional:
+        value = arguments[name]
+        if by_position or name not in defaults:
+            args.append(value)
+        elif not _is_default(value, defaults[name]):
+            kwargs[name] = value
+    if by_position:
+        args.extend(arguments[varargs])
+    for name in keyword_only:
+        if name not in defaults or not _is_default(arguments[name], defaults[name]):
+            kwargs[name] = arguments[name]
+    if varkw is not None:
+        kwargs.update(arguments[varkw])
+    return args, kwargs
+
+
+def _is_default(value, default):
+    return value is default or (
+        type(value) is type(default)
+        and isinstance(value, (bool, int, float, str))
+        and value == default
+    )
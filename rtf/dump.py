@@ -0,0 +1,151 @@
+# Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dump the API of the installed TensorFlow into a new golden corpus."""
+
+import os
+import re
+import time
+from concurrent import futures
+from glob import glob
+
+from google.protobuf import text_format
+
+from .generators.base import Generator
+from .proto.lib import api_objects_pb2, tf_decorator, tf_inspect
+from .proto.lib.python_object_to_proto_visitor import PythonObjectToProtoVisitor
+from .proto.lib.traverse import traverse
+
+
+def _key_to_filename(key):
+    """From an api object key, construct the name of its golden file.
+    The inverse of Generator._filename_to_key."""
+    return (
+        re.sub("([A-Z]{1})", lambda match: "-" + match.group(0).lower(), key) + ".pbtxt"
+    )
+
+
+def _write_golden_file(args):
+    """Write a serialized TFAPIObject as a golden file.
+    Executed in the worker processes by dump."""
+    filename, serialized = args
+    with open(filename, "w") as fp_pbtxt:
+        fp_pbtxt.write(
+            text_format.MessageToString(
+                api_objects_pb2.TFAPIObject.FromString(serialized)
+            )
+        )
+    return filename
+
+
+def golden_dir(tensorflow_version):
+    """The folder of the golden files of the given tensorflow version."""
+    return os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "proto",
+        "r" + str(tensorflow_version),
+    )
+
+
+def dump(dest_dir=None, workers=None):
+    """Visit the API of the installed TensorFlow and write its golden files.
+    The binary index of the golden protos is written too, so the generators
+    do not parse the new golden files again.
+
+    Args:
+        dest_dir: the folder of the golden files,
+                  rtf/proto/r<major.minor> by default.
+        workers: the number of processes writing the files,
+                 os.cpu_count() by default.
+    Returns:
+        the tensorflow version and the list of golden files written.
+    """
+    import tensorflow as tf  # pylint: disable=import-outside-toplevel
+
+    version = ".".join(tf.__version__.split(".")[:2])
+    dest_dir = dest_dir or golden_dir(version)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    visitor = PythonObjectToProtoVisitor()
+    traverse(tf, visitor, ("tensorflow", "keras"))
+    # The keys of the golden proto dict are the paths of the objects,
+    # sorted as get_golden_proto_dict sorts the golden files.
+    golden_proto_dict = {
+        key: visitor.GetProtos()[key]
+        for key in sorted(visitor.GetProtos(), key=_key_to_filename)
+    }
+
+    jobs = [
+        (os.path.join(dest_dir, _key_to_filename(key)), proto.SerializeToString())
+        for key, proto in golden_proto_dict.items()
+    ]
+    # Golden files of objects no longer in the API.
+    for filename in set(glob(os.path.join(dest_dir, "*.pbtxt"))) - {
+        filename for filename, _ in jobs
+    }:
+        os.remove(filename)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) < 2 * workers:
+        files = [_write_golden_file(job) for job in jobs]
+    else:
+        with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            files = list(
+                pool.map(
+                    _write_golden_file,
+                    jobs,
+                    chunksize=max(len(jobs) // (4 * workers), 1),
+                )
+            )
+
+    if os.path.realpath(dest_dir) == os.path.realpath(golden_dir(version)):
+        Generator._write_index(
+            Generator._index_path(version),
+            Generator._golden_digest(files),
+            golden_proto_dict,
+        )
+    return version, files
+
+
+def benchmark_inspect(passes=3):
+    """Introspect every routine in the API of the installed TensorFlow,
+    several times, as the visitor does: unwrap and argspec.
+
+    Args:
+        passes: the number of traversals of the API.
+    Returns:
+        the elapsed time of every pass and the statistics of the caches.
+    """
+    import tensorflow as tf  # pylint: disable=import-outside-toplevel
+
+    routines = []
+    traverse(
+        tf,
+        lambda path, parent, children: routines.extend(
+            child for _, child in children if tf_inspect.isroutine(child)
+        ),
+        ("tensorflow", "keras"),
+    )
+
+    elapsed = []
+    for _ in range(passes):
+        start = time.perf_counter()
+        for routine in routines:
+            _, target = tf_decorator.unwrap(routine)
+            try:
+                tf_inspect.getargspec(target)
+            except (TypeError, ValueError):
+                pass
+        elapsed.append(time.perf_counter() - start)
+    return elapsed, tf_decorator.cache_info()
@@ -14,18 +14,25 @@
 
 """CLI application to generate rtf clients."""
 
+import json
 import os
 import sys
+import time
 from argparse import ArgumentParser
+from concurrent import futures
 
+from .api import diff
+from .dump import benchmark_inspect, dump
+from .generators.base import Generator, Parser
 from .generators.go import Go
 from .generators.python import Python
 
 
-def make_generator(lang):
+def make_generator(lang, **kwargs):
     """Given a taret language, creates the correct Generator object.
     Args:
         lang: the target language as a string.
+        kwargs: the options of the generator.
     Returns:
         generator
     """
@@ -38,11 +45,76 @@ def make_generator(lang):
     else:
         raise ValueError(f"Language {lang} not supported")
 
-    return generator()
+    return generator(**kwargs)
+
+
+def _generate(generator, dest_dir, api_model):
+    """Run the generator on the parsed API, returns the list of generated files
+    and the elapsed time."""
+    start = time.perf_counter()
+    os.makedirs(os.path.join(dest_dir, Generator.MODULE_NAME), exist_ok=True)
+    files = generator.generate(dest_dir, api_model)
+    return files, time.perf_counter() - start
+
+
+def _diff(from_version, to_version):
+    """Print the differences between the APIs of two versions."""
+    models = []
+    for version in (from_version, to_version):
+        api_model = Generator.get_api_model(version)
+        if not api_model:
+            print(f"No golden API for tensorflow {version}", file=sys.stderr)
+            return 1
+        models.append(api_model)
+    json.dump(diff(*models), sys.stdout, indent=1)
+    print()
+    return 0
+
+
+def _benchmark_argspecs(version, passes=3):
+    """Parse the argspecs and build the signatures (Python and Go) of every
+    method of the golden API of a version, several times: the first pass
+    with empty caches. Print the elapsed time of every pass and the
+    statistics of the caches."""
+    api_model = Generator.get_api_model(version)
+    if not api_model:
+        print(f"No golden API for tensorflow {version}", file=sys.stderr)
+        return 1
+    argspecs = [
+        method.argspec
+        for tf_api_object in api_model.values()
+        if tf_api_object.scope is not None
+        for method in tf_api_object.scope.member_method
+        if method.argspec
+    ]
+    cached = {
+        "parse_argspec": Parser._parse_argspec,  # pylint: disable=protected-access
+        "python_signature": Python.build_signature,
+        "go_signature": Go.build_signature,
+    }
+    for function in cached.values():
+        function.cache_clear()
+    print(
+        f"r{version}: {len(argspecs)} argspecs, {len(set(argspecs))} unique",
+        file=sys.stderr,
+    )
+    for i in range(passes):
+        start = time.perf_counter()
+        for argspec in argspecs:
+            Python.build_signature(argspec)
+            Go.build_signature(argspec)
+        print(f"pass {i}: {time.perf_counter() - start:.3f}s", file=sys.stderr)
+    json.dump(
+        {name: function.cache_info()._asdict() for name, function in cached.items()},
+        sys.stderr,
+        indent=1,
+    )
+    print(file=sys.stderr)
+    return 0
 
 
 def main():
-    """Main, parses CLI, builds and runs the generator."""
+    """Main, parses CLI, builds and runs the generators."""
     parser = ArgumentParser(
         description="Convert the TensorFlow Python API to a gRPC client for the <target language>"
     )
@@ -50,16 +122,145 @@ def main():
         "--dest_dir", default=os.getcwd(), help="where to put the generated client"
     )
     parser.add_argument(
-        "--target", default="Go", help="the target language", choices=["Go", "Python"]
+        "--target",
+        default=["Go"],
+        nargs="+",
+        help="the target languages. When more than one, every client is "
+        "generated in the dest_dir/<target> folder",
+        choices=["Go", "Python"],
+    )
+    parser.add_argument(
+        "--tensorflow_version",
+        default=["2.1"],
+        nargs="+",
+        help="The tensorflow versions to use. When more than one, every client is "
+        "generated in the dest_dir/r<version> folder",
+        choices=Generator.golden_versions(),
+    )
+    parser.add_argument(
+        "--formatter",
+        default="black",
+        help="Python only: format the code with black, or quickly without it",
+        choices=["black", "fast"],
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="Python only: generate the asyncio client (grpc.aio), whose calls are awaited",
+    )
+    parser.add_argument(
+        "--go_module",
+        default=None,
+        help="Go only: path of the generated Go module (tensorflow by default)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of clients generated concurrently",
+    )
+    parser.add_argument(
+        "--diff",
+        nargs=2,
+        metavar=("FROM_VERSION", "TO_VERSION"),
+        help="instead of generating the clients, print (JSON) the differences "
+        "between the golden APIs of two tensorflow versions",
     )
     parser.add_argument(
+        "--dump_api",
+        nargs="?",
+        const="",
+        metavar="GOLDEN_DIR",
+        help="instead of generating the clients, dump the API of the installed "
+        "tensorflow as golden files into GOLDEN_DIR (rtf/proto/r<version> by default)",
+    )
+    parser.add_argument(
+        "--benchmark_inspect",
+        action="store_true",
+        help="instead of generating the clients, measure the introspection "
+        "(unwrap and argspec) of every routine of the installed tensorflow",
+    )
+    parser.add_argument(
+        "--benchmark_argspecs",
+        action="store_true",
+        help="instead of generating the clients, measure the argspec parsing "
+        "and the signature building of every method of the golden API of "
         "--tensorflow_version",
-        default=2.1,
-        help="The tensorflow version to use",
-        choices=["2.1"],
     )
     args = parser.parse_args()
-    return make_generator(args.target)(args.dest_dir, args.tensorflow_version)
+    if args.benchmark_inspect:
+        elapsed, caches = benchmark_inspect()
+        for i, seconds in enumerate(elapsed):
+            print(f"pass {i}: {seconds:.3f}s", file=sys.stderr)
+        json.dump(caches, sys.stderr, indent=1)
+        print(file=sys.stderr)
+        return 0
+    if args.benchmark_argspecs:
+        for version in args.tensorflow_version:
+            if _benchmark_argspecs(version):
+                return 1
+        return 0
+    if args.diff:
+        return _diff(*args.diff)
+    if args.dump_api is not None:
+        start = time.perf_counter()
+        version, files = dump(args.dump_api or None, args.workers)
+        print(
+            f"r{version}: {len(files)} golden files dumped in "
+            f"{time.perf_counter() - start:.2f}s",
+            file=sys.stderr,
+        )
+        return 0
+
+    targets = list(dict.fromkeys(args.target))
+    versions = list(dict.fromkeys(args.tensorflow_version))
+
+    # The API of every version is parsed once and shared by all the targets.
+    jobs = {}
+    with futures.ThreadPoolExecutor(
+        max_workers=args.workers or len(targets) * len(versions)
+    ) as pool:
+        for version in versions:
+            start = time.perf_counter()
+            api_model = Generator.get_api_model(version)
+            print(
+                f"r{version}: API loaded in {time.perf_counter() - start:.2f}s",
+                file=sys.stderr,
+            )
+            for target in targets:
+                dest_dir = args.dest_dir
+                if len(targets) > 1:
+                    dest_dir = os.path.join(dest_dir, target.lower())
+                if len(versions) > 1:
+                    dest_dir = os.path.join(dest_dir, f"r{version}")
+                options = {}
+                if target == "Python":
+                    options["formatter"] = args.formatter
+                    options["asyncio"] = args.asyncio
+                if target == "Go":
+                    options["module"] = args.go_module
+                job = pool.submit(
+                    _generate,
+                    make_generator(target, **options),
+                    dest_dir,
+                    api_model,
+                )
+                jobs[job] = (target, version)
+
+        failed = False
+        for job in futures.as_completed(jobs):
+            target, version = jobs[job]
+            try:
+                files, elapsed = job.result()
+            except Exception as error:  # pylint: disable=broad-except
+                failed = True
+                print(f"{target} r{version}: failed: {error}", file=sys.stderr)
+            else:
+                print(
+                    f"{target} r{version}: {len(files)} files generated in {elapsed:.2f}s",
+                    file=sys.stderr,
+                )
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
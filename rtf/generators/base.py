@@ -16,13 +16,19 @@
 
 import abc
 import ast
+import collections
+import functools
+import hashlib
+import json
 import logging
 import os
 import re
+from concurrent import futures
 from glob import glob
 
-from google.protobuf import text_format
+from google.protobuf import message, text_format
 
+from ..api import APIModel
 from ..proto.lib import api_objects_pb2
 
 
@@ -31,6 +37,36 @@ class Generator:
 
     MODULE_NAME = "tensorflow"
 
+    # Version of the generated code. Bump it when the output of a generator
+    # changes, so that every file is generated again.
+    VERSION = 1
+
+    # File, in dest_dir, with the hash of the inputs of every generated file.
+    MANIFEST = ".rtf-manifest.json"
+
+    # Types (mtype in the golden protos) of the members whose value never
+    # changes. The enum members ("<enum 'Name'>") are constants too.
+    CONSTANT_MTYPES = frozenset(
+        (
+            "<type 'int'>",
+            "<type 'float'>",
+            "<type 'bool'>",
+            "<type 'str'>",
+            "<type 'tuple'>",
+            "<type 'frozenset'>",
+            "<type 'NoneType'>",
+            "<class 'tensorflow.python.framework.dtypes.DType'>",
+        )
+    )
+
+    @staticmethod
+    def is_constant(member):
+        """Whether the value of the APIMember never changes: the clients
+        resolve it without calling the server."""
+        return member.mtype in Generator.CONSTANT_MTYPES or member.mtype.startswith(
+            "<enum "
+        )
+
     @staticmethod
     def snake_to_camel(name):
         """Convert a sname_name to a CamelName."""
@@ -68,34 +104,116 @@ class Generator:
         return ret_val
 
     @staticmethod
-    def _filter_golden_proto_dict(golden_proto_dict, omit_golden_symbols_map):
-        """Filter out golden proto dict symbols that should be omitted."""
-
-        if not omit_golden_symbols_map:
-            return golden_proto_dict
-        filtered_proto_dict = dict(golden_proto_dict)
-        for key, symbol_list in omit_golden_symbols_map.items():
-            api_object = api_objects_pb2.TFAPIObject()
-            api_object.CopyFrom(filtered_proto_dict[key])
-            filtered_proto_dict[key] = api_object
-            module_or_class = None
-            if api_object.HasField("tf_module"):
-                module_or_class = api_object.tf_module
-            elif api_object.HasField("tf_class"):
-                module_or_class = api_object.tf_class
-            if module_or_class is not None:
-                for members in (module_or_class.member, module_or_class.member_method):
-                    filtered_members = [m for m in members if m.name not in symbol_list]
-                    # Two steps because protobuf repeated fields disallow slice assignment.
-                    del members[:]
-                    members.extend(filtered_members)
-        return filtered_proto_dict
+    def _read_file_to_serialized_proto(filename):
+        """Read a golden file, returns its key and its serialized protobuf.
+        Executed in the worker processes by _read_golden_files."""
+        return (
+            Generator._filename_to_key(filename),
+            Generator._read_file_to_proto(filename).SerializeToString(),
+        )
+
+    @staticmethod
+    def _read_golden_files(golden_file_list, workers=None):
+        """Parse the golden files using a pool of processes.
+
+        Args:
+            golden_file_list: the list of golden files to parse.
+            workers: the number of processes, os.cpu_count() by default.
+        Returns:
+            the golden proto dict, whose keys are in the order of golden_file_list.
+        """
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(golden_file_list) < 2 * workers:
+            return {
+                Generator._filename_to_key(filename): Generator._read_file_to_proto(
+                    filename
+                )
+                for filename in golden_file_list
+            }
+
+        with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            return {
+                key: api_objects_pb2.TFAPIObject.FromString(serialized)
+                for key, serialized in pool.map(
+                    Generator._read_file_to_serialized_proto,
+                    golden_file_list,
+                    chunksize=max(len(golden_file_list) // (4 * workers), 1),
+                )
+            }
+
+    @staticmethod
+    def _golden_digest(golden_file_list):
+        """Hash of the name and content of every golden file."""
+        digest = hashlib.sha256()
+        for filename in golden_file_list:
+            with open(filename, "rb") as fp_pbtxt:
+                pbtxt = fp_pbtxt.read()
+            digest.update(f"{os.path.basename(filename)}:{len(pbtxt)}:".encode())
+            digest.update(pbtxt)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _index_path(tensorflow_version):
+        """Path of the binary index of the golden protos."""
+        cache_dir = os.environ.get("RTF_CACHE_DIR") or os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "rtf"
+        )
+        return os.path.join(cache_dir, f"golden-r{tensorflow_version}.pb")
+
+    @staticmethod
+    def _read_index(index_path, digest):
+        """Read the binary index at index_path. Returns the golden proto dict,
+        or None if the index is missing or has not been built from the golden
+        files with the given digest."""
+        try:
+            with open(index_path, "rb") as fp_index:
+                index = api_objects_pb2.TFAPIIndex.FromString(fp_index.read())
+        except (OSError, message.DecodeError):
+            return None
+        if index.digest != digest:
+            return None
+        return dict(zip(index.key, index.object))
+
+    @staticmethod
+    def _write_index(index_path, digest, golden_proto_dict):
+        """Write the golden proto dict into the binary index at index_path."""
+        index = api_objects_pb2.TFAPIIndex(digest=digest)
+        index.key.extend(golden_proto_dict.keys())
+        index.object.extend(golden_proto_dict.values())
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as fp_index:
+                fp_index.write(index.SerializeToString())
+            os.replace(tmp_path, index_path)
+        except OSError as error:
+            logging.warning(
+                "Unable to write the golden index %s: %s", index_path, error
+            )
+
+    @staticmethod
+    def golden_versions():
+        """The tensorflow versions with a golden API (rtf/proto/r<version>)."""
+        proto_path = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), os.path.pardir, "proto"
+        )
+        return sorted(
+            (
+                os.path.basename(path)[1:]
+                for path in glob(os.path.join(proto_path, "r*"))
+                if os.path.isdir(path)
+            ),
+            key=lambda version: tuple(int(part) for part in version.split(".")),
+        )
 
     @staticmethod
     def get_golden_proto_dict(tensorflow_version):
         """
         Get the GOLDEN proto dictionary of the TensorFlow API at
         the specified version (if available).
+
+        The parsed protos are stored in a binary index, that's read instead of
+        parsing the golden files again until their content changes.
         """
 
         proto_path = os.path.join(
@@ -105,55 +223,207 @@ class Generator:
             "r" + str(tensorflow_version),
             "*.pbtxt",
         )
-        golden_file_list = glob(proto_path)
-        golden_proto_dict = {
-            Generator._filename_to_key(filename): Generator._read_file_to_proto(
-                filename
-            )
-            for filename in golden_file_list
-        }
-        omit_golden_symbols_map = {}
-        golden_proto_dict = Generator._filter_golden_proto_dict(
-            golden_proto_dict, omit_golden_symbols_map
-        )
+        golden_file_list = sorted(glob(proto_path))
+        digest = Generator._golden_digest(golden_file_list)
+        index_path = Generator._index_path(tensorflow_version)
+        golden_proto_dict = Generator._read_index(index_path, digest)
+        if golden_proto_dict is None:
+            golden_proto_dict = Generator._read_golden_files(golden_file_list)
+            Generator._write_index(index_path, digest, golden_proto_dict)
         return golden_proto_dict
 
+    @staticmethod
+    def get_api_model(tensorflow_version):
+        """
+        Get the APIModel of the TensorFlow API at the specified version,
+        without the symbols that should be omitted.
+        """
+        omit_golden_symbols_map = {}
+        return APIModel.from_golden_proto_dict(
+            Generator.get_golden_proto_dict(tensorflow_version)
+        ).filter(omit_golden_symbols_map)
+
     @abc.abstractmethod
-    def convert(self, dest_dir, golden_proto_dict):
+    def output_files(self, key, tf_api_object):
+        """
+        The files generated, by convert, from an API object.
+
+        Args:
+            key: the key of tf_api_object in the api_model.
+            tf_api_object: the APIObject.
+        Returns:
+            the list of paths of the files, relative to dest_dir.
+        """
+
+    def package_files(self, api_model):
+        """
+        The files generated from the whole API model (e.g. an index of the
+        package), instead of from an API object. They are written by
+        generate when their content changes.
+
+        Args:
+            api_model: the APIModel of the TensorFlow API.
+        Returns:
+            a dict of the file paths, relative to dest_dir, and their content.
+        """
+        return {}
+
+    def options(self):
+        """
+        The options of the generator that change the generated code. They're
+        part of the hash of the generated files, with VERSION: changing them
+        generates every file again.
+
+        Returns:
+            a dict of the option names and their (JSON serializable) values.
+        """
+        return {}
+
+    @abc.abstractmethod
+    def convert(self, dest_dir, api_model):
         """
         The convert function to use for creating the
         files in the target language.
-        Use the golden_proto_dict to create the client.
+        Use the api_model to create the client.
 
         Args:
             dest_dir: the destination dir of the package
-            golden_proto_dict: the dictionary of the TensorFlow API
-                               (obtained via get_golden_proto_dict).
+            api_model: the APIModel of the TensorFlow API
+                       (obtained via get_api_model).
         """
 
+    @staticmethod
+    def _read_manifest(dest_dir):
+        try:
+            with open(os.path.join(dest_dir, Generator.MANIFEST), "r") as fp:
+                return json.load(fp)["files"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    @staticmethod
+    def _write_manifest(dest_dir, files):
+        with open(os.path.join(dest_dir, Generator.MANIFEST), "w") as fp:
+            json.dump({"files": files}, fp, indent=1, sort_keys=True)
+
+    def generate(self, dest_dir, api_model):
+        """
+        Generate the client, converting only the API objects whose generated
+        files are missing or have been generated from different inputs.
+        The files generated by a previous run and no longer generated
+        are removed.
+
+        Args:
+            dest_dir: the destination dir of the package
+            api_model: the APIModel of the TensorFlow API
+                       (obtained via get_api_model).
+        Returns:
+            the list of generated files.
+        """
+        file_keys = {}
+        for key, tf_api_object in api_model.items():
+            for file_path in self.output_files(key, tf_api_object):
+                file_keys.setdefault(file_path, []).append(key)
+
+        generator = json.dumps(
+            [type(self).__name__, self.VERSION, self.options()], sort_keys=True
+        )
+        files = {}
+        for file_path, keys in file_keys.items():
+            digest = hashlib.sha256(generator.encode())
+            for key in keys:
+                digest.update(f"{key}:{api_model[key].digest}".encode())
+            files[file_path] = digest.hexdigest()
+
+        package_files = self.package_files(api_model)
+        for file_path, code in package_files.items():
+            files[file_path] = hashlib.sha256(code.encode()).hexdigest()
+
+        manifest = Generator._read_manifest(dest_dir)
+        root = os.path.realpath(dest_dir)
+        for file_path in manifest.keys() - files.keys():
+            # The manifest is a file of dest_dir, that can be edited: only the
+            # files inside dest_dir are removed.
+            path = os.path.realpath(os.path.join(dest_dir, file_path))
+            if path == root or os.path.commonpath([root, path]) != root:
+                logging.warning(
+                    "%s, in the manifest of %s, is outside of it: not removed",
+                    file_path,
+                    dest_dir,
+                )
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        changed = [
+            file_path
+            for file_path, digest in files.items()
+            if manifest.get(file_path) != digest
+            or not os.path.exists(os.path.join(dest_dir, file_path))
+        ]
+        self.convert(
+            dest_dir,
+            api_model.subset(
+                key
+                for file_path in changed
+                if file_path in file_keys
+                for key in file_keys[file_path]
+            ),
+        )
+        for file_path, code in package_files.items():
+            if file_path in changed:
+                file_path = os.path.join(dest_dir, file_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as fp:
+                    fp.write(code)
+        Generator._write_manifest(dest_dir, files)
+        return changed
+
     def __call__(self, dest_dir, tensorflow_version):
         base_dir = os.path.join(dest_dir, Generator.MODULE_NAME)
         if not os.path.isdir(base_dir):
             os.makedirs(base_dir)
-        self.convert(dest_dir, Generator.get_golden_proto_dict(tensorflow_version))
+        return self.generate(dest_dir, Generator.get_api_model(tensorflow_version))
+
+
+# Parsed argspec. args and defaults are tuples (defaults is None when there
+# are no default values), varargs and keywords are names or None.
+ArgSpec = collections.namedtuple("ArgSpec", ["args", "varargs", "keywords", "defaults"])
 
 
 class Parser:
+
+    _VARIADIC_RE = re.compile(r"\b(varargs|keywords)=([A-Za-z_]\w*)")
+
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _parse_argspec(argspec):
+        """Parse the argspec string of a golden TFAPIMethod into an ArgSpec.
+        The ArgSpec are immutable and cached: every generator shares the
+        same instance for the same argspec string."""
         # Argspec needs to be "corrected" in order to be correctly parsed.
         # Eg. The argspect of certain methods could be: args=['something'], varargs=args
         # but since args is not a variable, this will throw an error when parsed using
-        # literal eval.
-        args = f"f({argspec})"
-        args = args.replace("varargs=args", "varargs='args'").replace(
-            "keywords=kwargs", "keywords='kwargs'"
+        # literal eval. Hence, the names of varargs and keywords are quoted.
+        args = Parser._VARIADIC_RE.sub(
+            lambda match: (
+                match.group(0)
+                if match.group(2) == "None"
+                else f"{match.group(1)}='{match.group(2)}'"
+            ),
+            f"f({argspec})",
         )
 
         tree = ast.parse(args)
         funccall = tree.body[0].value
-        # { 'args': [], 'varargs': [], 'keywords': [], 'defaults': [] }
-        return {arg.arg: ast.literal_eval(arg.value) for arg in funccall.keywords}
+        spec = {arg.arg: ast.literal_eval(arg.value) for arg in funccall.keywords}
+        return ArgSpec(
+            args=tuple(spec["args"]),
+            varargs=spec["varargs"],
+            keywords=spec["keywords"],
+            defaults=tuple(spec["defaults"]) if spec["defaults"] else None,
+        )
 
     @abc.abstractstaticmethod
     def build_signature(argspec):
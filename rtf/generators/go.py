@@ -13,129 +13,356 @@
 # limitations under the License.
 
 """Generator for the Go programming language."""
+
+import functools
+import io
 import os
+from glob import glob
 
-from .base import Generator
+from .base import Generator, Parser
 
+# The Go keywords, and the names used by the generated functions: the
+# parameters with these names are renamed.
+_RESERVED = frozenset(
+    (
+        "break case chan const continue default defer else fallthrough for func go "
+        "goto if import interface map package range return select struct switch "
+        "type var any args me rtf"
+    ).split()
+)
 
-class Go(Generator):
-    """Generator for the Go programming language."""
 
-    HEADER = (
-        "/**\n"
-        " * This file is machine generated. Do NOT edit unless you\n"
-        " * REALLY know what are you doing.\n"
-        " */\n\n"
-        "package {package}\n\n"
-    )
+class Go(Parser, Generator):
+    """Generator for the Go programming language.
+
+    The client is a Go module (go.mod in DEST_DIR/tensorflow): every
+    TensorFlow module is a package, whose file contains its functions and
+    classes. The runtime (package rtf: connection pool, deferred nodes,
+    values) is copied from go_runtime.
+    """
 
-    RTF_CLIENT = "type Sender struct {\n" "\tsend(*RTFMessage)\n" "}\n\n"
+    HEADER = "// Code generated by rtf.generate. DO NOT EDIT.\n\n"
 
-    FUNCTION = 'func {func_name}{func_signature} {{\n\tclient.Send("TODO")\n}}\n\n'
+    GO_MOD = (
+        "module {module}\n\n"
+        "go 1.21\n\n"
+        "require (\n"
+        "\tgoogle.golang.org/grpc v1.64.0\n"
+        "\tgoogle.golang.org/protobuf v1.34.1\n"
+        ")\n"
+    )
 
-    CLASS = "type {type_name} struct {{\n\tSender\n}}\n\n"
+    # The Go code of rtf.proto is generated by protoc, in the runtime package.
+    GO_GENERATE = (
+        "// Package rtf is the runtime of the generated client.\n"
+        "package rtf\n\n"
+        "//go:generate protoc "
+        "--go_out=. --go_opt=paths=source_relative,Mrtf.proto={import_path} "
+        "--go-grpc_out=. --go-grpc_opt=paths=source_relative,Mrtf.proto={import_path} "
+        "rtf.proto\n"
+    )
 
-    METHOD = (
-        "func (me *{type_name}) {func_name}{func_signature} {{\n"
-        '\tme.send("TODO")\n'
-        "}}\n\n"
+    RUNTIME_DIR = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), "go_runtime"
     )
 
-    def _create_commons(self, module, dest_dir):
-        module_name = module.name.split(".")[-1]
-        base_dir = os.path.join(dest_dir, Generator.MODULE_NAME)
-        if not os.path.isdir(base_dir):
-            os.makedirs(base_dir)
-
-        # TODO: Compile the .proto to .go
-
-        common_file = os.path.join(base_dir, "_" + Generator.MODULE_NAME + ".go")
-        with open(common_file, "w") as fp:
-            # The header puts the file into the same package
-            fp.write(Go.HEADER.format(package=Generator.MODULE_NAME))
-            fp.write("import (\n")
-            for package in ["context", "google.golang.org/grpc"]:
-                fp.write('\t"{}"\n'.format(package))
-            fp.write(")\n\n")
+    # The first parameter of the methods bound to the instance or the class
+    # (instance: the methods of the Keras layers wrapped by a decorator).
+    BOUND = (("self",), ("cls",), ("instance",))
+
+    # 2: client driven by the API model, one package per module.
+    # 3: static methods and classmethods as functions, values in the statements.
+    VERSION = 3
+
+    def __init__(self, module=None):
+        """
+        Args:
+            module: path of the generated Go module, tensorflow by default.
+        """
+        self._module = module or Generator.MODULE_NAME
+        self._api_model = None
+
+    @staticmethod
+    def exported(name):
+        """The exported Go identifier of a Python name: reduce_sum -> ReduceSum."""
+        if name[:1].isupper():
+            return name
+        return "".join(part[:1].upper() + part[1:] for part in name.split("_"))
+
+    @staticmethod
+    def parameter(name):
+        """The Go parameter of a Python parameter: input_tensor -> inputTensor."""
+        name = Go.exported(name)
+        name = name[:1].lower() + name[1:]
+        while name in _RESERVED:
+            name += "_"
+        return name
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def build_signature(argspec, method=False):
+        """The Go parameters of the argspec, the Go names of the required
+        parameters, and the Python signature (for the documentation).
+        The optional parameters, and the variadic ones, are args ...any."""
+        spec = Parser._parse_argspec(argspec)
+        args = spec.args
+        if method and args[:1] in Go.BOUND:
+            args = args[1:]
+        required = len(args) - len(spec.defaults or ())
+        names = []
+        for position, arg in enumerate(args[:required]):
+            name = Go.parameter(arg) or f"arg{position}"
+            while name in names:
+                name += "_"
+            names.append(name)
+
+        python = list(args[:required])
+        python.extend(
+            f"{arg}={default}"
+            for arg, default in zip(args[required:], spec.defaults or ())
+        )
+        if spec.varargs:
+            python.append(f"*{spec.varargs}")
+        if spec.keywords:
+            python.append(f"**{spec.keywords}")
+        params = [f"{name} any" for name in names] + ["args ...any"]
+        return ", ".join(params), tuple(names), ", ".join(python).replace("\n", " ")
+
+    def _package(self, key):
+        """The directory, relative to dest_dir, and the name of the package
+        of the module at key."""
+        parts = key.split(".")
+        name = parts[-1]
+        while name in _RESERVED:
+            name += "_"
+        return os.path.join(*parts), name
+
+    def _module_of(self, key):
+        """The key of the module containing the object at key."""
+        while self._api_model[key].tf_module is None:
+            key = self._api_model.parent(key)
+        return key
+
+    def output_files(self, key, tf_api_object):
+        # Every module is a package: its functions and its classes (the
+        # nested ones too) are in the package file.
+        if tf_api_object.tf_module is None and tf_api_object.tf_class is None:
+            return []
+        directory, name = self._package(self._module_of(key))
+        return [os.path.join(directory, name + ".go")]
+
+    def package_files(self, api_model):
+        runtime = os.path.join(Generator.MODULE_NAME, "rtf")
+        files = {
+            os.path.join(Generator.MODULE_NAME, "go.mod"): Go.GO_MOD.format(
+                module=self._module
+            ),
+            os.path.join(runtime, "generate.go"): Go.HEADER
+            + Go.GO_GENERATE.format(import_path=f"{self._module}/rtf"),
+        }
+        sources = glob(os.path.join(Go.RUNTIME_DIR, "*.go")) + [
+            os.path.join(
+                Go.RUNTIME_DIR, os.path.pardir, os.path.pardir, "proto", "rtf.proto"
+            )
+        ]
+        for source in sources:
+            with open(source, "r") as fp:
+                files[os.path.join(runtime, os.path.basename(source))] = fp.read()
+        return files
+
+    def _write_function(self, fp, go_name, path, argspec, method=False):
+        if argspec:
+            params, required, python = self.build_signature(argspec, method)
+        else:
+            # Builtins, whose argspec is unknown.
+            params, required, python = "args ...any", [], "*args, **kwargs"
+        fp.write(
+            f"// {go_name} calls {path}({python}).\n"
+            f"func {go_name}({params}) *rtf.Node {{\n"
+            f'\treturn rtf.Defer("{path}", []any{{{", ".join(required)}}}, args)\n'
+            "}\n\n"
+        )
+
+    def _write_class(self, fp, key, type_name, tf_class, names):
+        """Write the type of the class, its constructor and methods.
+        Returns the members that are constants."""
+        fp.write(
+            f"// {type_name} is an instance of {key}.\n"
+            f"type {type_name} struct {{\n\t*rtf.Node\n}}\n\n"
+        )
+        constructor = "New" + type_name
+        argspec = next(
+            (m.argspec for m in tf_class.member_method if m.name == "__init__"), ""
+        )
+        if argspec:
+            params, required, python = self.build_signature(argspec, method=True)
+        else:
+            params, required, python = "args ...any", [], "*args, **kwargs"
+        if constructor not in names:
+            names.add(constructor)
             fp.write(
-                "var opts []grpc.DialOption\n"
-                "opts = append(opts, grpc.WithInsecure())\n"
-                'conn, err := grpc.Dial("127.0.0.1:5001", opts...)\n'
-                "if err != nil {\n"
-                '\tpanic("failed to dial client")\n'
-                "}\n"
-                "defer conn.Close()\n"
-                "client := rtf.NewRTFClient(conn)\n"
+                f"// {constructor} constructs a {key}({python}).\n"
+                f"func {constructor}({params}) {type_name} {{\n"
+                f'\treturn {type_name}{{rtf.Defer("{key}", '
+                f"[]any{{{', '.join(required)}}}, args)}}\n"
+                "}\n\n"
             )
 
-    def convert(self, dest_dir, golden_proto_dict):
-        base_dir = os.path.join(dest_dir, Generator.MODULE_NAME)
-        package_file = os.path.join(base_dir, Generator.MODULE_NAME + ".go")
-        with open(package_file, "w") as fp:
-            # Main package: contains only the converted functions
-            # + some Go utilities.
-            fp.write(Go.HEADER.format(package=Generator.MODULE_NAME))
-            for func in module.functions:
-                if not func.private or keep_private:
-                    name = func.name.split(".")[-1]
-                    name = Generator.snake_to_camel(name)
-                    line = Go.FUNCTION.format(
-                        func_name=name, func_signature=func.signature
+        # The methods of the type hide the ones of rtf.Node with the same
+        # name: the generated code calls the ones of me.Node.
+        # Call is __call__ (rtf.Node.Call, when the class doesn't define it):
+        # the method call, of the Keras layers, is not generated.
+        methods = {"Node", "Call"}
+        for member_method in tf_class.member_method:
+            name = member_method.name
+            if not name or name.startswith("__") and name != "__call__":
+                continue
+            go_name = self.exported(name)
+            if not go_name:
+                continue
+            # The static methods and the classmethods are functions of the
+            # package, e.g. DatasetRange for tf.data.Dataset.range.
+            if member_method.argspec and Parser._parse_argspec(
+                member_method.argspec
+            ).args[:1] not in (("self",), ("instance",)):
+                if type_name + go_name not in names:
+                    names.add(type_name + go_name)
+                    self._write_function(
+                        fp,
+                        type_name + go_name,
+                        f"{key}.{name}",
+                        member_method.argspec,
+                        method=True,
                     )
-                    fp.write(line)
-        raise ValueError("TODO: refactor me - using the GOLDEN dict proto information")
-
-        # Every class is a new file. Every new file is memmber of the package.
-        for cls in module.classes:
-            py_name = cls.name.split(".")[-1]
-            file_path = os.path.join(
-                base_dir, Generator.camel_to_snake(py_name) + ".go"
+                continue
+            if go_name in methods and name != "__call__":
+                continue
+            methods.add(go_name)
+            if member_method.argspec:
+                params, required, python = self.build_signature(
+                    member_method.argspec, method=True
+                )
+            else:
+                params, required, python = "args ...any", [], "*args, **kwargs"
+            target = (
+                f"me.Node.Call(append([]any{{{', '.join(required)}}}, args...)...)"
+                if name == "__call__"
+                else f'me.Node.Method("{name}", []any{{{", ".join(required)}}}, args)'
             )
-            with open(file_path, "w") as fp:
-                type_name = Generator.snake_to_camel(py_name)
-                fp.write(Go.HEADER.format(package=Generator.MODULE_NAME))
-                fp.write(Go.CLASS.format(type_name=type_name))
-
-                fp.write(
-                    "func New{func_name}{func_signature} *{func_name} {{\n"
-                    "\treturn &{func_name}{{}}\n"
-                    "}}\n\n".format(
-                        func_name=type_name,
-                        func_signature=cls.init.signature.replace("self", "").replace(
-                            "(, ", "("
-                        )
-                        if cls.init
-                        else "()",
-                    )
+            fp.write(
+                f"// {go_name} calls {key}.{name}({python}).\n"
+                f"func (me {type_name}) {go_name}({params}) *rtf.Node {{\n"
+                f"\treturn {target}\n"
+                "}\n\n"
+            )
+
+        constants = []
+        for member in tf_class.member:
+            if Generator.is_constant(member):
+                constants.append(member)
+                continue
+            go_name = self.exported(member.name)
+            if not go_name or go_name in methods or member.name.startswith("__"):
+                continue
+            methods.add(go_name)
+            fp.write(
+                f"// {go_name} returns the attribute {key}.{member.name}.\n"
+                f"func (me {type_name}) {go_name}() *rtf.Node {{\n"
+                f'\treturn me.Node.Attr("{member.name}")\n'
+                "}\n\n"
+            )
+        return constants
+
+    def render(self, key, api_model):
+        """Render the source code of the package of the module at key,
+        with the classes of api_model in the module."""
+        tf_module = api_model[key].tf_module
+        classes = [
+            class_key
+            for class_key, tf_api_object in api_model.items()
+            if tf_api_object.tf_class is not None and self._module_of(class_key) == key
+        ]
+        _, package = self._package(key)
+
+        fp = io.StringIO()
+        fp.write(Go.HEADER)
+        fp.write(f"// Package {package} is the remote {key} module.\n")
+        fp.write(f"package {package}\n")
+        body = io.StringIO()
+
+        # The Go names are unique in the package: the types first, then the
+        # functions and the members. The duplicates are skipped.
+        types, names = {}, set()
+        for class_key in classes:
+            type_name = "".join(
+                self.exported(part) for part in class_key[len(key) + 1 :].split(".")
+            )
+            # e.g. the aliases constant and Constant of the same class.
+            if type_name not in names:
+                names.add(type_name)
+                types[class_key] = type_name
+        constants = []
+        for class_key, type_name in types.items():
+            constants.extend(
+                (
+                    f"{type_name}{self.exported(member.name)}",
+                    f"{class_key}.{member.name}",
+                )
+                for member in self._write_class(
+                    body, class_key, type_name, api_model[class_key].tf_class, names
                 )
+            )
 
-                if cls.call:
-                    fp.write(
-                        Go.METHOD.format(
-                            type_name=type_name,
-                            func_name="Call",
-                            func_signature=cls.call.signature.replace(
-                                "self", ""
-                            ).replace("(, ", "("),
-                        )
-                    )
+        for member_method in tf_module.member_method:
+            go_name = self.exported(member_method.name)
+            if not go_name or go_name in names:
+                continue
+            names.add(go_name)
+            self._write_function(
+                body, go_name, f"{key}.{member_method.name}", member_method.argspec
+            )
+
+        members, module_constants = [], []
+        for member in tf_module.member:
+            path = f"{key}.{member.name}"
+            go_name = self.exported(member.name)
+            # The submodules are packages, the classes are types.
+            if member.mtype == "<type 'module'>" or path in classes:
+                continue
+            if Generator.is_constant(member):
+                module_constants.append((go_name, path))
+            else:
+                members.append((go_name, path))
+
+        for go_name, path in module_constants + constants:
+            if go_name and go_name not in names:
+                names.add(go_name)
+                body.write(f'const {go_name} = rtf.Constant("{path}")\n')
+        for go_name, path in members:
+            if go_name and go_name not in names:
+                names.add(go_name)
+                body.write(f'var {go_name} = rtf.Ref("{path}")\n')
+
+        code = body.getvalue()
+        if code:
+            fp.write(f'\nimport "{self._module}/rtf"\n\n')
+            fp.write(code.rstrip("\n") + "\n")
+        return fp.getvalue()
+
+    def generate(self, dest_dir, api_model):
+        # The file of a class is the file of its module: output_files and
+        # convert look it up in the model.
+        self._api_model = api_model
+        return super().generate(dest_dir, api_model)
 
-                for method in cls.methods:
-                    if not method.private or keep_private:
-                        fp.write(
-                            Go.METHOD.format(
-                                type_name=type_name,
-                                func_name=Generator.snake_to_camel(
-                                    method.name.split(".")[-1]
-                                ),
-                                func_signature=method.signature.replace(
-                                    "self", ""
-                                ).replace("(, ", "("),
-                            )
-                        )
-
-        for submodule in module.modules:
-            if not keep_private and submodule.private:
+    def convert(self, dest_dir, api_model):
+        if self._api_model is None:
+            self._api_model = api_model
+        for key, tf_api_object in api_model.items():
+            if tf_api_object.tf_module is None:
                 continue
-            modname = submodule.name.split(".")[-1]
-            # self.convert(submodule, base_dir, keep_private)
+            for file_path in self.output_files(key, tf_api_object):
+                file_path = os.path.join(dest_dir, file_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as fp:
+                    fp.write(self.render(key, api_model))
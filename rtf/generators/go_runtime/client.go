@@ -0,0 +1,392 @@
+// Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package rtf
+
+import (
+	"context"
+	"crypto/rand"
+	"encoding/hex"
+	"errors"
+	"fmt"
+	"io"
+	"os"
+	"runtime"
+	"sort"
+	"strconv"
+	"sync"
+	"sync/atomic"
+	"time"
+
+	"google.golang.org/grpc"
+	"google.golang.org/grpc/credentials/insecure"
+)
+
+// Options of a Client. The zero value is the default configuration.
+type Options struct {
+	// Target is the address of the server, $RTF_TARGET or localhost:50051
+	// by default.
+	Target string
+	// Conns is the number of connections of the pool, $RTF_CONNS or 4 by
+	// default. Every connection multiplexes the concurrent calls on its
+	// HTTP/2 streams: more connections only spread the load.
+	Conns int
+	// Timeout is the deadline of the calls whose context has none,
+	// 0 for no deadline.
+	Timeout time.Duration
+	// Stdout receives the standard output of the programs, os.Stdout
+	// by default.
+	Stdout io.Writer
+	// MaxMessageSize is the maximum size in bytes of the messages sent and
+	// received, $RTF_MAX_MESSAGE_SIZE or 256 MiB by default.
+	MaxMessageSize int
+	// DialOptions are appended to the default ones (insecure credentials,
+	// MaxMessageSize).
+	DialOptions []grpc.DialOption
+}
+
+// RemoteError is returned when the execution of a program on the server fails.
+type RemoteError struct {
+	// NodeID is the ID of the node whose statement raised.
+	NodeID int64
+	// Message is the traceback sent by the server.
+	Message string
+}
+
+func (e *RemoteError) Error() string {
+	return e.Message
+}
+
+// Client is a pool of long-lived connections to a RTF server, shared by the
+// goroutines: it's safe for concurrent use. Every Fetch is a DefineAndCall
+// stream on one of the connections, chosen round robin.
+type Client struct {
+	uuid    string
+	conns   []*grpc.ClientConn
+	stubs   []RTFClient
+	next    atomic.Uint64
+	calls   atomic.Int64
+	timeout time.Duration
+
+	stdoutMu sync.Mutex
+	stdout   io.Writer
+
+	releasedMu sync.Mutex
+	released   []string // the names of the collected nodes kept by the server
+}
+
+// Dial creates a Client. The connections are established in background, and
+// established again when lost: Dial doesn't wait for the server.
+func Dial(options Options) (*Client, error) {
+	if options.Target == "" {
+		options.Target = os.Getenv("RTF_TARGET")
+		if options.Target == "" {
+			options.Target = "localhost:50051"
+		}
+	}
+	if options.Conns <= 0 {
+		options.Conns, _ = strconv.Atoi(os.Getenv("RTF_CONNS"))
+		if options.Conns <= 0 {
+			options.Conns = 4
+		}
+	}
+	if options.Stdout == nil {
+		options.Stdout = os.Stdout
+	}
+	if options.MaxMessageSize <= 0 {
+		options.MaxMessageSize, _ = strconv.Atoi(os.Getenv("RTF_MAX_MESSAGE_SIZE"))
+		if options.MaxMessageSize <= 0 {
+			options.MaxMessageSize = 256 << 20
+		}
+	}
+	id := make([]byte, 16)
+	if _, err := rand.Read(id); err != nil {
+		return nil, err
+	}
+	dialOptions := append(
+		[]grpc.DialOption{
+			grpc.WithTransportCredentials(insecure.NewCredentials()),
+			grpc.WithDefaultCallOptions(
+				grpc.MaxCallSendMsgSize(options.MaxMessageSize),
+				grpc.MaxCallRecvMsgSize(options.MaxMessageSize)),
+		},
+		options.DialOptions...)
+
+	client := &Client{
+		uuid:    hex.EncodeToString(id),
+		timeout: options.Timeout,
+		stdout:  options.Stdout,
+	}
+	for i := 0; i < options.Conns; i++ {
+		conn, err := grpc.NewClient(options.Target, dialOptions...)
+		if err != nil {
+			client.Close()
+			return nil, err
+		}
+		client.conns = append(client.conns, conn)
+		client.stubs = append(client.stubs, NewRTFClient(conn))
+	}
+	return client, nil
+}
+
+var (
+	defaultOnce   sync.Once
+	defaultClient *Client
+	defaultErr    error
+)
+
+// DefaultClient returns the Client used by Node.Fetch, dialed on first use
+// with the default Options.
+func DefaultClient() (*Client, error) {
+	defaultOnce.Do(func() {
+		defaultClient, defaultErr = Dial(Options{})
+	})
+	return defaultClient, defaultErr
+}
+
+// Close closes the connections.
+func (c *Client) Close() error {
+	var errs []error
+	for _, conn := range c.conns {
+		errs = append(errs, conn.Close())
+	}
+	return errors.Join(errs...)
+}
+
+// Calls returns the number of DefineAndCall made by the client.
+func (c *Client) Calls() int64 {
+	return c.calls.Load()
+}
+
+// program is the reusable buffer of the statements of a call.
+type program struct {
+	nodes      map[int64]*Node
+	ids        []int64
+	stack      []*Node
+	statements []*RTFStatement
+}
+
+var programs = sync.Pool{New: func() any {
+	return &program{nodes: make(map[int64]*Node)}
+}}
+
+func (p *program) reset() {
+	clear(p.nodes)
+	clear(p.stack)
+	p.ids, p.stack = p.ids[:0], p.stack[:0]
+}
+
+// statement returns the i-th statement of the buffer, reset.
+func (p *program) statement(i int) *RTFStatement {
+	if i == len(p.statements) {
+		p.statements = append(p.statements, new(RTFStatement))
+	}
+	p.statements[i].Reset()
+	return p.statements[i]
+}
+
+// claim collects the nodes to compute to fetch node: node and its ancestors
+// not kept by the server of c, that are marked as computed by the call whose
+// program is done. When some of them are computed by other calls nothing is
+// claimed, and the programs of the calls to wait for are returned.
+func (p *program) claim(c *Client, node *Node, done chan struct{}) []chan struct{} {
+	nodesMu.Lock()
+	defer nodesMu.Unlock()
+	var waits []chan struct{}
+	p.stack = append(p.stack, node)
+	for len(p.stack) > 0 {
+		current := p.stack[len(p.stack)-1]
+		p.stack = p.stack[:len(p.stack)-1]
+		if _, ok := p.nodes[current.id]; ok || current.kept == c {
+			continue
+		}
+		if current.program != nil {
+			waits = append(waits, current.program)
+			continue
+		}
+		p.nodes[current.id] = current
+		p.ids = append(p.ids, current.id)
+		if current.value() == nil {
+			p.stack = append(p.stack, current.inputs...)
+		}
+	}
+	if len(waits) > 0 {
+		p.reset()
+		return waits
+	}
+	for _, id := range p.ids {
+		p.nodes[id].program = done
+	}
+	return nil
+}
+
+// done ends the call computing the claimed nodes: they're kept by the
+// server of c, until collected, if it succeeded.
+func (p *program) done(c *Client, program chan struct{}, computed bool) {
+	nodesMu.Lock()
+	defer nodesMu.Unlock()
+	for _, id := range p.ids {
+		node := p.nodes[id]
+		node.program = nil
+		if computed {
+			if node.kept != nil {
+				// Kept by the server of another client too: released by
+				// its TTL.
+				runtime.SetFinalizer(node, nil)
+			}
+			node.kept = c
+			runtime.SetFinalizer(node, c.release)
+		}
+	}
+	close(program)
+}
+
+// build writes the statements that compute the claimed nodes and return the
+// value of node: the statements of the nodes, sorted by ID (every node is
+// created after its inputs), then the return, that keeps them on the server
+// and releases the collected ones.
+func (p *program) build(c *Client, node *Node) []*RTFStatement {
+	sort.Slice(p.ids, func(i, j int) bool { return p.ids[i] < p.ids[j] })
+
+	for i, id := range p.ids {
+		statement := p.statement(i)
+		statement.Uuid = c.uuid
+		statement.NodeId = id
+		p.nodes[id].statement(statement)
+	}
+	statement := p.statement(len(p.ids))
+	statement.Uuid = c.uuid
+	statement.NodeId = node.id
+	statement.ParentId = node.id
+	statement.Stmt = "rtf_return(" + node.name + ")"
+	statement.Keep = true
+	c.releasedMu.Lock()
+	statement.Release, c.released = c.released, nil
+	c.releasedMu.Unlock()
+	return p.statements[:len(p.ids)+1]
+}
+
+// release is the finalizer of the nodes kept by the server: their names are
+// released by the next call.
+func (c *Client) release(node *Node) {
+	c.releasedMu.Lock()
+	defer c.releasedMu.Unlock()
+	c.released = append(c.released, node.name)
+}
+
+// Fetch executes the program that computes node, and returns its value.
+// The value is kept by the node: the next fetches don't compute it again.
+// The nodes computed by the previous calls of the client are not computed
+// again: the concurrent calls that need the same nodes wait for the one
+// computing them. The standard output of the program is written to
+// Options.Stdout.
+//
+// The call is bound to ctx: its deadline (or Options.Timeout) and its
+// cancellation stop the execution. The errors of the execution are
+// *RemoteError.
+func (c *Client) Fetch(ctx context.Context, node *Node) (*Tensor, error) {
+	if node.err != nil {
+		return nil, node.err
+	}
+	if value := node.value(); value != nil {
+		return DecodeNPY(value)
+	}
+	if _, ok := ctx.Deadline(); !ok && c.timeout > 0 {
+		var cancel context.CancelFunc
+		ctx, cancel = context.WithTimeout(ctx, c.timeout)
+		defer cancel()
+	}
+	// Canceling the context releases the stream, on every return path.
+	ctx, cancel := context.WithCancel(ctx)
+	defer cancel()
+
+	p := programs.Get().(*program)
+	defer func() {
+		// The messages are reused only once the stream is done with them.
+		p.reset()
+		programs.Put(p)
+	}()
+	done := make(chan struct{})
+	for {
+		waits := p.claim(c, node, done)
+		if waits == nil {
+			break
+		}
+		for _, wait := range waits {
+			select {
+			case <-wait:
+			case <-ctx.Done():
+				return nil, ctx.Err()
+			}
+		}
+		if value := node.value(); value != nil {
+			return DecodeNPY(value)
+		}
+	}
+	computed := false
+	defer func() { p.done(c, done, computed) }()
+	statements := p.build(c, node)
+
+	c.calls.Add(1)
+	stub := c.stubs[c.next.Add(1)%uint64(len(c.stubs))]
+	stream, err := stub.DefineAndCall(ctx)
+	if err != nil {
+		return nil, err
+	}
+	for _, statement := range statements {
+		// On io.EOF the server closed the stream: Recv returns the reason.
+		if err = stream.Send(statement); err != nil {
+			break
+		}
+	}
+	if err == nil || err == io.EOF {
+		err = stream.CloseSend()
+	}
+	if err != nil && err != io.EOF {
+		return nil, err
+	}
+
+	var body []byte
+	for {
+		response, err := stream.Recv()
+		if err == io.EOF {
+			break
+		}
+		if err != nil {
+			return nil, err
+		}
+		if response.Stdout != "" {
+			c.stdoutMu.Lock()
+			io.WriteString(c.stdout, response.Stdout)
+			c.stdoutMu.Unlock()
+		}
+		if response.Error != "" {
+			return nil, &RemoteError{NodeID: response.NodeId, Message: response.Error}
+		}
+		if len(response.Body) > 0 {
+			body = response.Body
+		}
+	}
+	if body == nil {
+		return nil, &RemoteError{NodeID: node.id, Message: fmt.Sprintf("%s has no value", node.name)}
+	}
+	// The server kept the nodes.
+	computed = true
+	tensor, err := DecodeNPY(body)
+	if err != nil {
+		return nil, err
+	}
+	node.setValue(body)
+	return tensor, nil
+}
@@ -0,0 +1,459 @@
+// Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package rtf
+
+import (
+	"context"
+	"fmt"
+	"math"
+	"reflect"
+	"sort"
+	"strconv"
+	"strings"
+	"sync"
+	"sync/atomic"
+)
+
+// Constant is a member of the remote API whose value never changes (a dtype,
+// an enum member, a string or int constant...), referred to by its path:
+// using it doesn't call the server.
+type Constant string
+
+// Kwarg is a keyword argument of a call.
+type Kwarg struct {
+	Name  string
+	Value any
+}
+
+// Kw returns the keyword argument name=value.
+func Kw(name string, value any) Kwarg {
+	return Kwarg{Name: name, Value: value}
+}
+
+// Tuple is sent as a Python tuple, the other slices as lists.
+type Tuple []any
+
+// Slice is a start:stop:step range in Node.Index, nil bounds are omitted.
+type Slice struct {
+	Start, Stop, Step any
+}
+
+// noder is implemented by *Node and by the generated classes, that embed it.
+type noder interface {
+	asNode() *Node
+}
+
+var nodeIDs atomic.Int64
+
+// Node is a value computed on the server, deferred until fetched.
+//
+// The functions of the generated client, and the attributes, calls and
+// indexing of a Node, create new nodes. Nothing is sent until a value is
+// fetched: then the statements of the node and of the nodes it depends on are
+// sent in a single DefineAndCall (see Client.Fetch).
+// The server keeps the nodes computed by the calls of a client: the next
+// calls refer to them by name, and every node is computed once. They're
+// released when the node is garbage collected.
+// A Node is immutable, and safe for concurrent use.
+type Node struct {
+	id         int64
+	name       string
+	expression string
+	inputs     []*Node
+	err        error
+
+	data []byte // the .npy of a value of the client, sent in the statement
+
+	mu      sync.Mutex
+	fetched []byte // the .npy of the value, once fetched
+
+	// Guarded by nodesMu.
+	kept    *Client       // the client whose server keeps the node
+	program chan struct{} // closed when the call computing the node ends
+}
+
+// nodesMu guards the state of the nodes on the servers.
+var nodesMu sync.Mutex
+
+func newNode(expression string, inputs []*Node, err error) *Node {
+	for _, input := range inputs {
+		if err != nil {
+			break
+		}
+		err = input.err
+	}
+	id := nodeIDs.Add(1)
+	return &Node{
+		id:         id,
+		name:       "_n" + strconv.FormatInt(id, 10),
+		expression: expression,
+		inputs:     inputs,
+		err:        err,
+	}
+}
+
+// Ref returns the Node of the member of the remote API at path,
+// e.g. tensorflow.newaxis.
+func Ref(path string) *Node {
+	return newNode(Constant(path).source(), nil, nil)
+}
+
+// Defer records the call of the remote function (or class) at path, e.g.
+// tensorflow.math.add, with the required arguments followed by args: the
+// optional positional arguments, and the keyword arguments (Kw).
+func Defer(path string, required []any, args []any) *Node {
+	return call(Constant(path).source(), nil, required, args)
+}
+
+func (n *Node) asNode() *Node {
+	return n
+}
+
+// Err returns the error recorded while building the node, or one of its
+// inputs: an argument that can't be sent to the server.
+func (n *Node) Err() error {
+	return n.err
+}
+
+// Attr returns the Node of the attribute name.
+func (n *Node) Attr(name string) *Node {
+	return newNode(n.name+"."+name, []*Node{n}, nil)
+}
+
+// Call returns the Node of the call of the node, with the positional and
+// keyword (Kw) arguments args.
+func (n *Node) Call(args ...any) *Node {
+	return call(n.name, n, nil, args)
+}
+
+// Method returns the Node of the call of the method name, as Defer.
+func (n *Node) Method(name string, required []any, args []any) *Node {
+	return call(n.name+"."+name, n, required, args)
+}
+
+// Index returns the Node of node[keys...]: the keys are values, nodes or Slice.
+func (n *Node) Index(keys ...any) *Node {
+	s := getSource()
+	defer putSource(s)
+	s.inputs = append(s.inputs, n)
+	s.buf = append(s.buf, n.name...)
+	s.buf = append(s.buf, '[')
+	for i, key := range keys {
+		if i > 0 {
+			s.buf = append(s.buf, ", "...)
+		}
+		s.value(key)
+	}
+	s.buf = append(s.buf, ']')
+	return s.node()
+}
+
+// Fetch executes, with the default client, the program that computes the
+// node and returns its value.
+func (n *Node) Fetch(ctx context.Context) (*Tensor, error) {
+	client, err := DefaultClient()
+	if err != nil {
+		return nil, err
+	}
+	return client.Fetch(ctx, n)
+}
+
+// String returns the Python statement of the node.
+func (n *Node) String() string {
+	return n.name + " = " + n.expression
+}
+
+// statement writes the statement that assigns the value of the node to its
+// name. The values of the client are sent in the statement and loaded by
+// rtf_load. The nodes kept by the server have no statement: the node of a
+// value fetched with another client is its value, that isn't computed again
+// (e.g. random values keep their value).
+func (n *Node) statement(statement *RTFStatement) {
+	load := "rtf_load(" + strconv.FormatInt(n.id, 10) + ")"
+	if value := n.value(); value != nil {
+		statement.Stmt = n.name + " = tf.constant(" + load + ")"
+		statement.Value = value
+	} else if n.data != nil {
+		statement.Stmt = n.name + " = " + load
+		statement.Value = n.data
+	} else {
+		statement.Stmt = n.String()
+	}
+}
+
+func (n *Node) value() []byte {
+	n.mu.Lock()
+	defer n.mu.Unlock()
+	return n.fetched
+}
+
+func (n *Node) setValue(value []byte) {
+	n.mu.Lock()
+	defer n.mu.Unlock()
+	n.fetched = value
+}
+
+// source returns the Python expression of the constant.
+func (c Constant) source() string {
+	path := string(c)
+	if strings.HasPrefix(path, "tensorflow.") {
+		return "tf." + path[len("tensorflow."):]
+	}
+	return path
+}
+
+// source is the reusable buffer where the Python source of an expression,
+// and the nodes it refers to, are written.
+type source struct {
+	buf    []byte
+	inputs []*Node
+	err    error
+}
+
+var sources = sync.Pool{New: func() any { return new(source) }}
+
+func getSource() *source {
+	return sources.Get().(*source)
+}
+
+func putSource(s *source) {
+	s.buf = s.buf[:0]
+	clear(s.inputs)
+	s.inputs = s.inputs[:0]
+	s.err = nil
+	sources.Put(s)
+}
+
+// node returns the Node of the expression in the buffer.
+func (s *source) node() *Node {
+	inputs := make([]*Node, len(s.inputs))
+	copy(inputs, s.inputs)
+	return newNode(string(s.buf), inputs, s.err)
+}
+
+func (s *source) fail(err error) {
+	if s.err == nil {
+		s.err = err
+	}
+}
+
+func call(function string, self *Node, required []any, args []any) *Node {
+	s := getSource()
+	defer putSource(s)
+	if self != nil {
+		s.inputs = append(s.inputs, self)
+	}
+	s.buf = append(s.buf, function...)
+	s.buf = append(s.buf, '(')
+	count := 0
+	separator := func() {
+		if count > 0 {
+			s.buf = append(s.buf, ", "...)
+		}
+		count++
+	}
+	for _, arg := range required {
+		separator()
+		s.value(arg)
+	}
+	// Python wants the positional arguments before the keyword ones.
+	for _, arg := range args {
+		if _, ok := arg.(Kwarg); !ok {
+			separator()
+			s.value(arg)
+		}
+	}
+	for _, arg := range args {
+		if kwarg, ok := arg.(Kwarg); ok {
+			separator()
+			s.buf = append(s.buf, kwarg.Name...)
+			s.buf = append(s.buf, '=')
+			s.value(kwarg.Value)
+		}
+	}
+	s.buf = append(s.buf, ')')
+	return s.node()
+}
+
+// value writes the Python source of a call argument.
+func (s *source) value(value any) {
+	switch v := value.(type) {
+	case nil:
+		s.buf = append(s.buf, "None"...)
+	case noder:
+		node := v.asNode()
+		if node == nil {
+			s.fail(fmt.Errorf("rtf: nil node argument (%T)", value))
+			s.buf = append(s.buf, "None"...)
+			return
+		}
+		s.buf = append(s.buf, node.name...)
+		s.inputs = append(s.inputs, node)
+	case Constant:
+		s.buf = append(s.buf, v.source()...)
+	case Kwarg:
+		s.fail(fmt.Errorf("rtf: keyword argument %s nested in a value", v.Name))
+		s.buf = append(s.buf, "None"...)
+	case Slice:
+		for i, bound := range [...]any{v.Start, v.Stop, v.Step} {
+			if i > 0 {
+				s.buf = append(s.buf, ':')
+			}
+			if bound != nil {
+				s.value(bound)
+			}
+		}
+	case *Tensor:
+		// A node of its own: its value is sent in its statement.
+		node := newNode("rtf_load()", nil, nil)
+		node.data = v.NPY()
+		s.buf = append(s.buf, node.name...)
+		s.inputs = append(s.inputs, node)
+	case Tuple:
+		s.buf = append(s.buf, '(')
+		for i, item := range v {
+			if i > 0 {
+				s.buf = append(s.buf, ", "...)
+			}
+			s.value(item)
+		}
+		if len(v) == 1 {
+			s.buf = append(s.buf, ',')
+		}
+		s.buf = append(s.buf, ')')
+	case bool:
+		if v {
+			s.buf = append(s.buf, "True"...)
+		} else {
+			s.buf = append(s.buf, "False"...)
+		}
+	case string:
+		s.buf = strconv.AppendQuote(s.buf, v)
+	case []byte:
+		s.buf = appendBytes(s.buf, v)
+	case int:
+		s.buf = strconv.AppendInt(s.buf, int64(v), 10)
+	case int32:
+		s.buf = strconv.AppendInt(s.buf, int64(v), 10)
+	case int64:
+		s.buf = strconv.AppendInt(s.buf, v, 10)
+	case float32:
+		s.buf = appendFloat(s.buf, float64(v), 32)
+	case float64:
+		s.buf = appendFloat(s.buf, v, 64)
+	default:
+		s.reflectValue(reflect.ValueOf(value))
+	}
+}
+
+// reflectValue writes the values of the less common types: the other numeric
+// types, the slices and arrays (as lists) and the maps (as dicts).
+func (s *source) reflectValue(v reflect.Value) {
+	switch v.Kind() {
+	case reflect.Int, reflect.Int8, reflect.Int16, reflect.Int32, reflect.Int64:
+		s.buf = strconv.AppendInt(s.buf, v.Int(), 10)
+	case reflect.Uint, reflect.Uint8, reflect.Uint16, reflect.Uint32, reflect.Uint64, reflect.Uintptr:
+		s.buf = strconv.AppendUint(s.buf, v.Uint(), 10)
+	case reflect.Float32:
+		s.buf = appendFloat(s.buf, v.Float(), 32)
+	case reflect.Float64:
+		s.buf = appendFloat(s.buf, v.Float(), 64)
+	case reflect.Complex64, reflect.Complex128:
+		c := v.Complex()
+		s.buf = append(s.buf, "complex("...)
+		s.buf = appendFloat(s.buf, real(c), 64)
+		s.buf = append(s.buf, ", "...)
+		s.buf = appendFloat(s.buf, imag(c), 64)
+		s.buf = append(s.buf, ')')
+	case reflect.Bool:
+		s.value(v.Bool())
+	case reflect.String:
+		s.value(v.String())
+	case reflect.Slice, reflect.Array:
+		s.buf = append(s.buf, '[')
+		for i := 0; i < v.Len(); i++ {
+			if i > 0 {
+				s.buf = append(s.buf, ", "...)
+			}
+			s.value(v.Index(i).Interface())
+		}
+		s.buf = append(s.buf, ']')
+	case reflect.Map:
+		// The keys are sorted by their source, the program doesn't depend
+		// on the iteration order of the map.
+		items := make([][2]string, 0, v.Len())
+		iter := v.MapRange()
+		for iter.Next() {
+			start := len(s.buf)
+			s.value(iter.Key().Interface())
+			key := string(s.buf[start:])
+			s.value(iter.Value().Interface())
+			items = append(items, [2]string{key, string(s.buf[start+len(key):])})
+			s.buf = s.buf[:start]
+		}
+		sort.Slice(items, func(i, j int) bool { return items[i][0] < items[j][0] })
+		s.buf = append(s.buf, '{')
+		for i, item := range items {
+			if i > 0 {
+				s.buf = append(s.buf, ", "...)
+			}
+			s.buf = append(s.buf, item[0]...)
+			s.buf = append(s.buf, ": "...)
+			s.buf = append(s.buf, item[1]...)
+		}
+		s.buf = append(s.buf, '}')
+	default:
+		s.fail(fmt.Errorf("rtf: unsupported argument type %s", v.Type()))
+		s.buf = append(s.buf, "None"...)
+	}
+}
+
+// appendFloat appends the Python float literal of f.
+func appendFloat(buf []byte, f float64, bitSize int) []byte {
+	switch {
+	case math.IsNaN(f):
+		return append(buf, "float('nan')"...)
+	case math.IsInf(f, 1):
+		return append(buf, "float('inf')"...)
+	case math.IsInf(f, -1):
+		return append(buf, "float('-inf')"...)
+	}
+	start := len(buf)
+	buf = strconv.AppendFloat(buf, f, 'g', -1, bitSize)
+	for _, c := range buf[start:] {
+		if c == '.' || c == 'e' {
+			return buf
+		}
+	}
+	// Without a dot or an exponent, Python reads an int.
+	return append(buf, ".0"...)
+}
+
+// appendBytes appends the Python bytes literal of data.
+func appendBytes(buf []byte, data []byte) []byte {
+	const hex = "0123456789abcdef"
+	buf = append(buf, "b'"...)
+	for _, c := range data {
+		switch {
+		case c == '\\' || c == '\'':
+			buf = append(buf, '\\', c)
+		case c >= ' ' && c < 0x7f:
+			buf = append(buf, c)
+		default:
+			buf = append(buf, '\\', 'x', hex[c>>4], hex[c&0xf])
+		}
+	}
+	return append(buf, '\'')
+}
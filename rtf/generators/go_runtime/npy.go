@@ -0,0 +1,242 @@
+// Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+package rtf
+
+import (
+	"bytes"
+	"encoding/binary"
+	"errors"
+	"fmt"
+	"math"
+	"regexp"
+	"strconv"
+	"strings"
+)
+
+// Tensor is a value exchanged with the server: a numpy array, in the .npy
+// format (see rtf.values). Data are the elements in C order, little endian.
+type Tensor struct {
+	// DType is the numpy type descriptor, e.g. "<f4", "<i8" or "|b1".
+	DType string
+	Shape []int
+	Data  []byte
+}
+
+var npyMagic = []byte("\x93NUMPY")
+
+var npyHeader = regexp.MustCompile(
+	`'descr':\s*'([^']*)'|'fortran_order':\s*(True|False)|'shape':\s*\(([^)]*)\)`)
+
+// DecodeNPY decodes a value in the .npy format.
+func DecodeNPY(data []byte) (*Tensor, error) {
+	if len(data) < 10 || !bytes.HasPrefix(data, npyMagic) {
+		return nil, errors.New("rtf: not a .npy value")
+	}
+	var size, offset int
+	switch data[6] {
+	case 1:
+		size, offset = int(binary.LittleEndian.Uint16(data[8:])), 10
+	case 2, 3:
+		if len(data) < 12 {
+			return nil, errors.New("rtf: truncated .npy header")
+		}
+		size, offset = int(binary.LittleEndian.Uint32(data[8:])), 12
+	default:
+		return nil, fmt.Errorf("rtf: unsupported .npy version %d", data[6])
+	}
+	if len(data) < offset+size {
+		return nil, errors.New("rtf: truncated .npy header")
+	}
+	tensor := &Tensor{Data: data[offset+size:]}
+	for _, match := range npyHeader.FindAllStringSubmatch(string(data[offset:offset+size]), -1) {
+		switch {
+		case match[1] != "":
+			tensor.DType = match[1]
+		case match[2] == "True":
+			return nil, errors.New("rtf: fortran order .npy values are not supported")
+		case match[0][1] == 's':
+			tensor.Shape = []int{}
+			for _, dim := range strings.Split(match[3], ",") {
+				if dim = strings.TrimSpace(dim); dim == "" {
+					continue
+				}
+				n, err := strconv.Atoi(dim)
+				if err != nil {
+					return nil, fmt.Errorf("rtf: invalid .npy shape %q", match[3])
+				}
+				tensor.Shape = append(tensor.Shape, n)
+			}
+		}
+	}
+	if tensor.DType == "" || tensor.Shape == nil {
+		return nil, errors.New("rtf: invalid .npy header")
+	}
+	return tensor, nil
+}
+
+// NPY encodes the tensor in the .npy format.
+func (t *Tensor) NPY() []byte {
+	var header strings.Builder
+	header.WriteString("{'descr': '")
+	header.WriteString(t.DType)
+	header.WriteString("', 'fortran_order': False, 'shape': (")
+	for _, dim := range t.Shape {
+		header.WriteString(strconv.Itoa(dim))
+		header.WriteString(", ")
+	}
+	header.WriteString("), }")
+	// The data starts at a multiple of 64 bytes, the header ends with \n.
+	padding := 63 - (10+header.Len())%64
+	size := header.Len() + padding + 1
+
+	data := make([]byte, 0, 10+size+len(t.Data))
+	data = append(data, npyMagic...)
+	data = append(data, 1, 0)
+	data = binary.LittleEndian.AppendUint16(data, uint16(size))
+	data = append(data, header.String()...)
+	data = append(data, bytes.Repeat([]byte{' '}, padding)...)
+	data = append(data, '\n')
+	return append(data, t.Data...)
+}
+
+// Array returns the tensor with the given shape (a vector, when omitted) of
+// the values: a []float32, []float64, []int32, []int64, []uint8 or []bool.
+func Array(values any, shape ...int) (*Tensor, error) {
+	var tensor *Tensor
+	switch v := values.(type) {
+	case []float32:
+		tensor = &Tensor{DType: "<f4", Shape: []int{len(v)}, Data: make([]byte, 0, 4*len(v))}
+		for _, x := range v {
+			tensor.Data = binary.LittleEndian.AppendUint32(tensor.Data, math.Float32bits(x))
+		}
+	case []float64:
+		tensor = &Tensor{DType: "<f8", Shape: []int{len(v)}, Data: make([]byte, 0, 8*len(v))}
+		for _, x := range v {
+			tensor.Data = binary.LittleEndian.AppendUint64(tensor.Data, math.Float64bits(x))
+		}
+	case []int32:
+		tensor = &Tensor{DType: "<i4", Shape: []int{len(v)}, Data: make([]byte, 0, 4*len(v))}
+		for _, x := range v {
+			tensor.Data = binary.LittleEndian.AppendUint32(tensor.Data, uint32(x))
+		}
+	case []int64:
+		tensor = &Tensor{DType: "<i8", Shape: []int{len(v)}, Data: make([]byte, 0, 8*len(v))}
+		for _, x := range v {
+			tensor.Data = binary.LittleEndian.AppendUint64(tensor.Data, uint64(x))
+		}
+	case []uint8:
+		tensor = &Tensor{DType: "|u1", Shape: []int{len(v)}, Data: append([]byte(nil), v...)}
+	case []bool:
+		tensor = &Tensor{DType: "|b1", Shape: []int{len(v)}, Data: make([]byte, len(v))}
+		for i, x := range v {
+			if x {
+				tensor.Data[i] = 1
+			}
+		}
+	default:
+		return nil, fmt.Errorf("rtf: unsupported array type %T", values)
+	}
+	if len(shape) > 0 {
+		if tensor.Size() != productOf(shape) {
+			return nil, fmt.Errorf("rtf: %d values can't have shape %v", tensor.Size(), shape)
+		}
+		tensor.Shape = shape
+	}
+	return tensor, nil
+}
+
+func productOf(shape []int) int {
+	size := 1
+	for _, dim := range shape {
+		size *= dim
+	}
+	return size
+}
+
+// Size returns the number of elements.
+func (t *Tensor) Size() int {
+	return productOf(t.Shape)
+}
+
+func (t *Tensor) check(kind byte, itemsize int) error {
+	if len(t.DType) != 3 || t.DType[1] != kind || int(t.DType[2]-'0') != itemsize ||
+		(t.DType[0] == '>' && itemsize > 1) {
+		return fmt.Errorf("rtf: %s values requested from a %s tensor", string(kind)+strconv.Itoa(itemsize), t.DType)
+	}
+	if len(t.Data) != itemsize*t.Size() {
+		return fmt.Errorf("rtf: %d bytes of data for shape %v", len(t.Data), t.Shape)
+	}
+	return nil
+}
+
+// Float32s returns the values of a float32 tensor.
+func (t *Tensor) Float32s() ([]float32, error) {
+	if err := t.check('f', 4); err != nil {
+		return nil, err
+	}
+	values := make([]float32, t.Size())
+	for i := range values {
+		values[i] = math.Float32frombits(binary.LittleEndian.Uint32(t.Data[4*i:]))
+	}
+	return values, nil
+}
+
+// Float64s returns the values of a float64 tensor.
+func (t *Tensor) Float64s() ([]float64, error) {
+	if err := t.check('f', 8); err != nil {
+		return nil, err
+	}
+	values := make([]float64, t.Size())
+	for i := range values {
+		values[i] = math.Float64frombits(binary.LittleEndian.Uint64(t.Data[8*i:]))
+	}
+	return values, nil
+}
+
+// Int32s returns the values of an int32 tensor.
+func (t *Tensor) Int32s() ([]int32, error) {
+	if err := t.check('i', 4); err != nil {
+		return nil, err
+	}
+	values := make([]int32, t.Size())
+	for i := range values {
+		values[i] = int32(binary.LittleEndian.Uint32(t.Data[4*i:]))
+	}
+	return values, nil
+}
+
+// Int64s returns the values of an int64 tensor.
+func (t *Tensor) Int64s() ([]int64, error) {
+	if err := t.check('i', 8); err != nil {
+		return nil, err
+	}
+	values := make([]int64, t.Size())
+	for i := range values {
+		values[i] = int64(binary.LittleEndian.Uint64(t.Data[8*i:]))
+	}
+	return values, nil
+}
+
+// Bools returns the values of a bool tensor.
+func (t *Tensor) Bools() ([]bool, error) {
+	if err := t.check('b', 1); err != nil {
+		return nil, err
+	}
+	values := make([]bool, t.Size())
+	for i := range values {
+		values[i] = t.Data[i] != 0
+	}
+	return values, nil
+}
@@ -13,8 +13,11 @@
 # limitations under the License.
 """Generator for the Python programming language."""
 
+import ast
+import functools
+import io
 import os
-import pathlib
+from concurrent import futures
 
 import black
 
@@ -22,6 +25,23 @@ from ..proto.lib import api_objects_pb2 as tf_api_objects
 from .base import Generator, Parser
 
 
+def _format_and_write(formatter, source):
+    """Format the source code and write it to its file.
+
+    Args:
+        formatter: "black" to format the code with black, "fast" to
+                   only replace the tabs with spaces.
+        source: (file_path, code) pair.
+    """
+    file_path, code = source
+    if formatter == "black":
+        code = black.format_str(code, mode=black.FileMode())
+    else:
+        code = code.expandtabs(4)
+    with open(file_path, "w") as fp:
+        fp.write(code)
+
+
 class Python(Parser, Generator):
     """Parser and Generator from and to the Python programming language."""
 
@@ -29,24 +49,62 @@ class Python(Parser, Generator):
         r'"""Remote {package} - machine generated."""'
         "\n"
         "# This file is machine generated. Do NOT edit unless you\n"
-        "# REALLY know what are you doing.\n\n"
-        "# TODO: import grpc client\n"
+        "# REALLY know what are you doing.\n"
         "\n\n"
     )
 
+    # Module of the package with the index of the submodules and classes of
+    # every module, imported lazily by their __getattr__.
+    INDEX = (
+        "import importlib\n"
+        "import sys\n\n"
+        "# The submodules and the classes of every module of the package,\n"
+        "# imported on first access by the __getattr__ of the module.\n"
+        "INDEX = {index}\n\n"
+        "\ndef load(package, name):\n"
+        '\t"""Import the submodule or the class name of package, and bind it to\n'
+        '\tpackage: the next accesses do not go through __getattr__."""\n'
+        '\tmodule = importlib.import_module(f"{{package}}.{{name}}")\n'
+        '\tvalue = module if INDEX[package][name] == "module" else getattr(module, name)\n'
+        "\tsetattr(sys.modules[package], name, value)\n"
+        "\treturn value\n"
+    )
+
+    # 2: lazily loaded package, defaults that are not literals quoted.
+    # 3: constants baked in the stubs.
+    # 4: deferred calls.
+    # 5: deferred class methods and members.
+    VERSION = 5
+
+    def __init__(self, formatter="black", workers=None, asyncio=False):
+        """
+        Args:
+            formatter: "black" to format the generated code with black,
+                       "fast" to skip black when its exact output isn't needed.
+            workers: number of processes formatting the generated files,
+                     os.cpu_count() by default.
+            asyncio: generate the asyncio client, whose calls are awaited
+                     (runtime: rtf.aio), instead of the synchronous one
+                     (runtime: rtf.client).
+        """
+        self._formatter = formatter
+        self._workers = workers or os.cpu_count() or 1
+        self._asyncio = asyncio
+        self._runtime = "rtf.aio" if asyncio else "rtf.client"
+
+    def options(self):
+        # Switching client or formatter generates every file again.
+        return {"formatter": self._formatter, "asyncio": self._asyncio}
+
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def build_signature(argspec):
+        # Many methods share the same argspec: the signature is built once
+        # for every unique argspec.
         spec = Parser._parse_argspec(argspec)
-        dp_len = len(spec["defaults"]) if spec["defaults"] else 0
-        args_count = len(spec["args"])
-        args = {}
-        for i in range(args_count - dp_len, args_count):
-            args[str(spec["args"][i])] = spec["defaults"][i - args_count]
-        signature = ""
-        if args_count - dp_len > 0:
-            signature = ",".join(spec["args"][: args_count - dp_len])
-            if args:
-                signature += ","
+        defaults = spec.defaults or ()
+        required = len(spec.args) - len(defaults)
+        params = list(spec.args[:required])
         # The default parameteres are hard to disambiguate.
         # eg. default='[None', 'categorical_hinge'] must be parsed in two different ways.
         # 'None' -> must become the symbol None
@@ -54,154 +112,227 @@ class Python(Parser, Generator):
         # literal_eval just removes the string, making the defaults None, categorical_hinge.
         #
         # Thus, we have to handle these different scenarios.
-
-        defaults = ""
-        first_append = True
-        for param, default in args.items():
-            # Use a stupid heuristic: if the default parameter starts with an upper case
-            # character, it is likely to be a language symbol (e.g None), or a class
-            # static member (Variable.SOMETHING).
-            # If the parameter value contains the symbols "(", ")" then it might be a
-            # tuple, or a function call, and it should remain as it is.
-            # Otherwise, we treat this as a string.
-            if not first_append:
-                defaults += ", "
-
-            defaults += f"{param}="
-            if default[0].isupper() or "(" in default or ")" in default:
-                defaults += f"{default}"
+        for param, default in zip(spec.args[required:], defaults):
+            # The defaults that are Python literals (None, -1, (1, 2), ...) remain
+            # as they are. Any other value (a string, or the str of an object, like
+            # a class static member) is treated as a string: the generated code
+            # must be importable.
+            try:
+                ast.literal_eval(default)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                params.append(f"{param}={default!r}")
             else:
-                defaults += f"'{default}'"
-            first_append = False
+                params.append(f"{param}={default}")
 
-        return signature + defaults
-
-    def _write_module_members(self, fp, members):
-        if not members:
-            return
+        if spec.varargs:
+            params.append(f"*{spec.varargs}")
+        if spec.keywords:
+            params.append(f"**{spec.keywords}")
+        return ", ".join(params)
 
-        members_string_list = "[{}]".format(",".join(f"'{m.name}'" for m in members))
+    @staticmethod
+    def _write_constants(fp, key, members, indent=""):
+        """Write the members whose value never changes, resolved without
+        calling the server. Returns the other members."""
+        dynamic = []
+        for member in members:
+            if Generator.is_constant(member):
+                fp.write(
+                    f"{indent}{member.name} = Constant("
+                    f"{key + '.' + member.name!r}, {member.mtype!r})\n"
+                )
+            else:
+                dynamic.append(member)
+        return dynamic
 
-        # First write all the getters
+    def _write_module_members(self, fp, key, members):
+        # The submodules and the classes are imported on first access.
+        fp.write(f"\nfrom {'.' * (key.count('.') + 1)} import _index\n\n")
+        members = self._write_constants(fp, key, members)
         fp.write("\ndef __getattr__(name):\n")
         fp.write(
-            "\tif name in {members_list}:\n"
-            "\t\traise ValueError('implement grcp getter call')\n".format(
-                members_list=members_string_list
-            )
+            "\tif name in _index.INDEX.get(__name__, ()):\n"
+            "\t\treturn _index.load(__name__, name)\n"
         )
-
-        # Now write all the setters
-        fp.write("\ndef __setattr__(name, value):\n")
-        fp.write(
-            "\tif name in {members_list}:\n"
-            "\t\traise ValueError('implement grcp setter call')\n".format(
-                members_list=members_string_list
+        if members:
+            # The members whose value can change are read on the server.
+            fp.write(
+                "\tif name in ({members},):\n"
+                "\t\treturn member(f{path!r})\n".format(
+                    members=", ".join(repr(m.name) for m in members),
+                    path=f"{key}.{{name}}",
+                )
             )
+        fp.write(
+            "\traise AttributeError(f'module {__name__!r} has no attribute {name!r}')\n"
         )
 
-    def _write_module_member_methods(self, fp, member_methods):
+    def _write_module_member_methods(self, fp, key, member_methods):
         if not member_methods:
             return
 
+        # The calls are deferred: they are executed on the server when the
+        # value of their result is needed (see rtf.client.Session).
         for member_method in member_methods:
             # optional: name, path, argspec
-            if member_method.HasField("name") and member_method.HasField("argspec"):
+            if not member_method.name:
+                continue
+            if member_method.argspec:
                 fp.write(
                     "\ndef {func_name}({func_signature}):\n"
-                    "\traise ValueError('implement member method grpc call')\n".format(
+                    "\treturn defer({path!r}, *bound({func_name}, locals()))\n".format(
                         func_name=member_method.name,
                         func_signature=self.build_signature(member_method.argspec),
+                        path=f"{key}.{member_method.name}",
+                    )
+                )
+            else:
+                # Builtins, whose argspec is unknown.
+                fp.write(
+                    "\ndef {func_name}(*args, **kwargs):\n"
+                    "\treturn defer({path!r}, args, kwargs)\n".format(
+                        func_name=member_method.name,
+                        path=f"{key}.{member_method.name}",
                     )
                 )
 
-    def _write_class_member_methods(self, fp, member_methods):
-        if not member_methods:
-            return
+    def _write_class_member_methods(self, fp, key, member_methods):
+        # The instances are nodes, whose methods are deferred by attribute
+        # access: these are the methods called on the class, e.g.
+        # tf.data.Dataset.range(5), deferred as the module functions.
+        name = key.split(".")[-1]
         for member_method in member_methods:
             # optional: name, path, argspec
-            if member_method.HasField("name") and member_method.HasField("argspec"):
+            if not member_method.name or member_method.name.startswith("__"):
+                continue
+            path = f"{key}.{member_method.name}"
+            if member_method.argspec:
+                signature = self.build_signature(member_method.argspec)
+                # The classmethods are bound to the remote class.
+                if Parser._parse_argspec(member_method.argspec).args[:1] == ("cls",):
+                    signature = signature[len("cls") :].lstrip(", ")
                 fp.write(
-                    "\n\tdef {func_name}({func_signature}):\n"
-                    "\t\traise ValueError('implement member method grpc call')\n".format(
+                    "\n\t@staticmethod\n"
+                    "\tdef {func_name}({func_signature}):\n"
+                    "\t\treturn defer({path!r}, *bound({name}.{func_name}, locals()))\n".format(
                         func_name=member_method.name,
-                        func_signature=self.build_signature(member_method.argspec),
+                        func_signature=signature,
+                        path=path,
+                        name=name,
+                    )
+                )
+            else:
+                # Builtins, whose argspec is unknown.
+                fp.write(
+                    "\n\t@staticmethod\n"
+                    "\tdef {func_name}(*args, **kwargs):\n"
+                    "\t\treturn defer({path!r}, args, kwargs)\n".format(
+                        func_name=member_method.name, path=path
                     )
                 )
 
-    def _write_class_members(self, fp, members):
-        if not members:
-            return
-
-        members_string_list = "[{}]".format(",".join(f"'{m.name}'" for m in members))
+    def _write_class_members(self, fp, key, members):
+        members = self._write_constants(fp, key, members, indent="\t")
+        # The members whose value can change are read on the server.
+        for m in members:
+            fp.write(f"\t{m.name} = Member({key + '.' + m.name!r})\n")
 
-        # First write all the getters
-        fp.write("\n\tdef __getattr__(self, name):\n")
+    def _write_class(self, fp, key, tf_class):
+        name = key.split(".")[-1]
+        fp.write(f"class {name}:\n\n")
+        # The construction is deferred, as the calls of the module functions:
+        # the instances are rtf.client.Node.
         fp.write(
-            "\t\tif name in {members_list}:\n"
-            "\t\t\traise ValueError('implement grcp getter call')\n".format(
-                members_list=members_string_list
-            )
+            "\tdef __new__(cls, *args, **kwargs):\n"
+            f"\t\treturn defer({key!r}, args, kwargs)\n\n"
         )
+        self._write_class_members(fp, key, tf_class.member)
+        self._write_class_member_methods(fp, key, tf_class.member_method)
 
-        # Now write all the setters
-        fp.write("\n\tdef __setattr__(self, name, value):\n")
-        fp.write(
-            "\t\tif name in {members_list}:\n"
-            "\t\t\traise ValueError('implement grcp setter call')\n".format(
-                members_list=members_string_list
-            )
-        )
+    def _write_module(self, fp, key, tf_module):
+        self._write_module_members(fp, key, tf_module.member)
+        self._write_module_member_methods(fp, key, tf_module.member_method)
 
-    def _write_class(self, fp, name, tf_class):
-        fp.write(f"class {name}:\n\n" f"\t#TODO: class attribute grpc client?\n\n")
-        self._write_class_members(fp, tf_class.member)
-        self._write_class_member_methods(fp, tf_class.member_method)
+    def output_files(self, key, tf_api_object):
+        path = os.path.join(*key.split("."))
+        if tf_api_object.tf_module is not None:
+            return [os.path.join(path, "__init__.py")]
+        if tf_api_object.tf_class is not None:
+            return [path + ".py"]
+        return []
 
-    def _write_module(self, fp, tf_module):
-        self._write_module_members(fp, tf_module.member)
-        self._write_module_member_methods(fp, tf_module.member_method)
+    def package_files(self, api_model):
+        index = {}
+        for key, tf_api_object in api_model.items():
+            if tf_api_object.tf_module is None:
+                continue
+            for child in api_model.children(key):
+                # Only the direct children with a generated file.
+                if child.rpartition(".")[0] != key:
+                    continue
+                if api_model[child].tf_module is not None:
+                    index.setdefault(key, {})[child.rpartition(".")[2]] = "module"
+                elif api_model[child].tf_class is not None:
+                    index.setdefault(key, {})[child.rpartition(".")[2]] = "class"
 
-    def convert(self, dest_dir, golden_proto_dict):
-        for path, tf_api_object in golden_proto_dict.items():
-            file_path = os.path.join(
-                dest_dir, os.path.join(path.replace(".", os.path.sep))
-            )
+        # Written as black would format it: one entry per line.
+        index = "".join(
+            f'\t"{key}": {{\n'
+            + "".join(f'\t\t"{name}": "{kind}",\n' for name, kind in children.items())
+            + "\t},\n"
+            for key, children in index.items()
+        )
+        code = Python.HEADER.format(package=Generator.MODULE_NAME)
+        code += Python.INDEX.format(index="{\n" + index + "}")
+        return {os.path.join(Generator.MODULE_NAME, "_index.py"): code.expandtabs(4)}
 
-            if tf_api_object.HasField("tf_module"):
-                file_basedir = file_path
-                if not os.path.exists(file_basedir):
-                    os.makedirs(file_basedir)
-                file_path = os.path.join(file_basedir, "__init__.py")
-
-                if not os.path.exists(file_path):
-                    with open(file_path, "w") as fp:
-                        fp.write(Python.HEADER.format(package=Generator.MODULE_NAME))
-
-                with open(file_path, "a") as fp:
-                    # TFAPIModule: repeated {member, member_method}
-                    self._write_module(tf_api_object.tf_module)
-
-            if tf_api_object.HasField("tf_class"):
-                explode = file_path.split(os.path.sep)
-                file_basedir = os.path.sep.join(explode[:-1])
-                class_name = explode[-1]
-                if not os.path.exists(file_basedir):
-                    os.makedirs(file_basedir)
-                file_path += ".py"
-
-                if not os.path.exists(file_path):
-                    with open(file_path, "w") as fp:
-                        fp.write(Python.HEADER.format(package=Generator.MODULE_NAME))
-
-                with open(file_path, "a") as fp:
-                    self._write_class(fp, class_name, tf_api_object.tf_class)
-
-            # Format the file
-            black.format_file_in_place(
-                pathlib.Path(file_path),
-                fast=True,
-                mode=black.FileMode(),
-                write_back=black.WriteBack.YES,
+    def render(self, key, tf_api_object):
+        """Render the source code of the file generated from the API object."""
+        fp = io.StringIO()
+        fp.write(Python.HEADER.format(package=Generator.MODULE_NAME))
+        imports = []
+        members = tf_api_object.scope.member
+        if any(Generator.is_constant(member) for member in members):
+            imports.append("Constant")
+        if not all(Generator.is_constant(member) for member in members):
+            imports.append(
+                "member" if tf_api_object.tf_module is not None else "Member"
             )
-            break
+        if any(
+            method.name and method.argspec and not method.name.startswith("__")
+            for method in tf_api_object.scope.member_method
+        ):
+            imports.append("bound")
+        if tf_api_object.tf_class is not None or tf_api_object.scope.member_method:
+            imports.append("defer")
+        if imports:
+            fp.write(f"from {self._runtime} import {', '.join(imports)}\n")
+        if tf_api_object.tf_module is not None:
+            # TFAPIModule: repeated {member, member_method}
+            self._write_module(fp, key, tf_api_object.tf_module)
+        else:
+            self._write_class(fp, key, tf_api_object.tf_class)
+        return fp.getvalue()
+
+    def convert(self, dest_dir, api_model):
+        sources = []
+        for path, tf_api_object in api_model.items():
+            for file_path in self.output_files(path, tf_api_object):
+                file_path = os.path.join(dest_dir, file_path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                sources.append((file_path, self.render(path, tf_api_object)))
+
+        # Rendering is cheap, formatting is not: the files are formatted and
+        # written by a pool of processes.
+        if self._workers == 1 or len(sources) < 2 * self._workers:
+            for source in sources:
+                _format_and_write(self._formatter, source)
+            return
+
+        with futures.ProcessPoolExecutor(max_workers=self._workers) as pool:
+            for _ in pool.map(
+                functools.partial(_format_and_write, self._formatter),
+                sources,
+                chunksize=max(len(sources) // (4 * self._workers), 1),
+            ):
+                pass
@@ -41,7 +41,7 @@ import enum
 import logging
 import sys
 
-from google.protobuf import messagea
+from google.protobuf import message
 
 from . import api_objects_pb2, tf_decorator, tf_inspect
 
@@ -191,7 +191,11 @@ def _SanitizedMRO(obj):
 
 def _IsProtoClass(obj):
     """Returns whether the passed obj is a Protocol Buffer class."""
-    return isinstance(obj, type) and issubclass(obj, message.Message)
+    return (
+        isinstance(obj, type)
+        and issubclass(obj, message.Message)
+        and getattr(obj, "DESCRIPTOR", None) is not None
+    )
 
 
 class PythonObjectToProtoVisitor(object):
@@ -201,6 +205,18 @@ class PythonObjectToProtoVisitor(object):
         # A dict to store all protocol buffers.
         # Keyed by "path" to the object.
         self._protos = {}
+        # The same object is reachable from several paths (its aliases):
+        # the protos and the argspecs already built are keyed by id of the
+        # object. The object is stored too, to keep its id valid.
+        self._visited = {}
+        self._argspecs = {}
+
+    def _ArgSpec(self, obj):
+        """Memoized _SanitizedArgSpec."""
+        cached = self._argspecs.get(id(obj))
+        if cached is None or cached[0] is not obj:
+            cached = self._argspecs[id(obj)] = (obj, _SanitizedArgSpec(obj))
+        return cached[1]
 
     def GetProtos(self):
         """Return the list of protos stored."""
@@ -211,6 +227,17 @@ class PythonObjectToProtoVisitor(object):
         lib_path = "tensorflow.%s" % path if path else "tensorflow"
         _, parent = tf_decorator.unwrap(parent)
 
+        visited = self._visited.get(id(parent))
+        if (
+            visited is not None
+            and visited[0] is parent
+            and path not in _CORNER_CASES
+        ):
+            self._protos[lib_path] = api_objects_pb2.TFAPIObject()
+            self._protos[lib_path].CopyFrom(visited[1])
+            self._protos[lib_path].path = lib_path
+            return
+
         # A small helper method to construct members(children) protos.
         def _AddMember(member_name, member_obj, proto):
             """Add the child object to the object being constructed."""
@@ -227,7 +254,7 @@ class PythonObjectToProtoVisitor(object):
                     # argspec, because it is implemented on the C side. It also has no
                     # func_code.
                     if hasattr(member_obj, "__code__"):
-                        new_method.argspec = _SanitizedArgSpec(member_obj)
+                        new_method.argspec = self._ArgSpec(member_obj)
                 else:
                     new_member = proto.member.add()
                     new_member.name = member_name
@@ -287,3 +314,6 @@ class PythonObjectToProtoVisitor(object):
                     "Object is neither a module nor a class: %s",
                     path,
                 )
+
+        if lib_path in self._protos and path not in _CORNER_CASES:
+            self._visited[id(parent)] = (parent, self._protos[lib_path])
@@ -55,11 +55,103 @@ Example:
   def count_calls(target):
     return CallCounter(target)
 """
+import functools
 import inspect
+import types
+import weakref
 
 from . import tf_stack
 
 
+class WeakIdCache(object):
+    """A cache of values computed from objects, keyed by the objects identity.
+
+  The objects are weakly referenced: an entry is discarded as soon as its
+  object is garbage collected, and objects that are not hashable can be used
+  as keys. The builtins implemented in C can not be weakly referenced, but
+  live as long as their module or type: they are referenced. The other
+  objects that can not be weakly referenced are not cached.
+  Every cache is cleared by `clear_caches`, when a decorator is changed.
+  """
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        _CACHES.append(self)
+
+    def _discard(self, key, ref):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is ref:
+            del self._entries[key]
+
+    def get(self, obj, default=None):
+        entry = self._entries.get(id(obj))
+        if entry is not None and entry[0]() is obj:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return default
+
+    def put(self, obj, value):
+        try:
+            ref = weakref.ref(obj, functools.partial(self._discard, id(obj)))
+        except TypeError:
+            if not _is_static_builtin(obj):
+                return
+            ref = functools.partial(_identity, obj)
+        self._entries[id(obj)] = (ref, value)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_CACHES = []
+
+
+def _identity(obj):
+    return obj
+
+
+def _is_static_builtin(obj):
+    """Whether obj is a builtin function of a module or a method of a type."""
+    if isinstance(obj, types.BuiltinFunctionType):
+        return obj.__self__ is None or inspect.ismodule(obj.__self__)
+    return isinstance(
+        obj,
+        (
+            types.WrapperDescriptorType,
+            types.MethodDescriptorType,
+            types.ClassMethodDescriptorType,
+        ),
+    )
+
+
+def clear_caches():
+    """Clear the caches of `unwrap` and of the `tf_inspect` argspecs."""
+    for cache in _CACHES:
+        cache.clear()
+
+
+def cache_info():
+    """Returns the hits, misses and size of every cache, keyed by name."""
+    return {
+        cache.name: {"hits": cache.hits, "misses": cache.misses, "size": len(cache)}
+        for cache in _CACHES
+    }
+
+
+_UNWRAP_CACHE = WeakIdCache("unwrap")
+
+# Stands for the object itself in the cached `unwrap` results: the cache must
+# not keep a strong reference to its keys.
+_SELF = object()
+
+
 def make_decorator(
     target,
     decorator_func,
@@ -86,6 +178,7 @@ def make_decorator(
         decorator_name = frame.name
     decorator = TFDecorator(decorator_name, target, decorator_doc, decorator_argspec)
     setattr(decorator_func, "_tf_decorator", decorator)
+    clear_caches()
     # Objects that are callables (e.g., a functools.partial object) may not have
     # the following attributes.
     if hasattr(target, "__name__"):
@@ -190,6 +283,7 @@ def rewrap(decorator_func, previous_target, new_target):
             innermost_decorator.__wrapped__ = new_target
     else:
         innermost_decorator.__wrapped__ = new_target
+    clear_caches()
 
     return decorator_func
 
@@ -208,6 +302,29 @@ def unwrap(maybe_tf_decorator):
     list. The `TFDecorator` list is ordered from outermost to innermost
     decorators.
   """
+    if inspect.ismethod(maybe_tf_decorator):
+        # Bound methods are created on every attribute access: not cached.
+        return _unwrap(maybe_tf_decorator)
+
+    cached = _UNWRAP_CACHE.get(maybe_tf_decorator)
+    if cached is None:
+        decorators, target = _unwrap(maybe_tf_decorator)
+        _UNWRAP_CACHE.put(
+            maybe_tf_decorator,
+            (
+                tuple(_SELF if d is maybe_tf_decorator else d for d in decorators),
+                _SELF if target is maybe_tf_decorator else target,
+            ),
+        )
+        return decorators, target
+    decorators, target = cached
+    return (
+        [maybe_tf_decorator if d is _SELF else d for d in decorators],
+        maybe_tf_decorator if target is _SELF else target,
+    )
+
+
+def _unwrap(maybe_tf_decorator):
     decorators = []
     cur = maybe_tf_decorator
     while True:
@@ -261,6 +378,7 @@ class TFDecorator(object):
     @decorated_target.setter
     def decorated_target(self, decorated_target):
         self._decorated_target = decorated_target
+        clear_caches()
 
     @property
     def decorator_name(self):
@@ -19,7 +19,13 @@ import inspect as _inspect
 
 from . import tf_decorator
 
-ArgSpec = _inspect.ArgSpec
+if hasattr(_inspect, "ArgSpec"):
+    ArgSpec = _inspect.ArgSpec
+else:
+    # Removed in Python 3.11
+    ArgSpec = collections.namedtuple(
+        "ArgSpec", ["args", "varargs", "keywords", "defaults"]
+    )
 
 if hasattr(_inspect, "FullArgSpec"):
     FullArgSpec = _inspect.FullArgSpec  # pylint: disable=invalid-name
@@ -96,6 +102,22 @@ else:
         return _convert_maybe_argspec_to_fullargspec(getargspec(target))
 
 
+_ARGSPEC_CACHE = tf_decorator.WeakIdCache("getargspec")
+_FULLARGSPEC_CACHE = tf_decorator.WeakIdCache("getfullargspec")
+
+
+def _cached(cache, compute, obj):
+    """Returns compute(obj), cached in cache. The errors are not cached."""
+    if _inspect.ismethod(obj):
+        # Bound methods are created on every attribute access: not cached.
+        return compute(obj)
+    spec = cache.get(obj)
+    if spec is None:
+        spec = compute(obj)
+        cache.put(obj, spec)
+    return spec
+
+
 def currentframe():
     """TFDecorator-aware replacement for inspect.currentframe."""
     return _inspect.stack()[1][0]
@@ -120,6 +142,10 @@ def getargspec(obj):
       ArgSpec.
     TypeError: For objects of unsupported types.
   """
+    return _cached(_ARGSPEC_CACHE, _uncached_getargspec, obj)
+
+
+def _uncached_getargspec(obj):
     if isinstance(obj, functools.partial):
         return _get_argspec_for_partial(obj)
 
@@ -262,6 +288,10 @@ def getfullargspec(obj):
     callable is not decorated, `inspect.getfullargspec()` will be called
     directly on the callable.
   """
+    return _cached(_FULLARGSPEC_CACHE, _uncached_getfullargspec, obj)
+
+
+def _uncached_getfullargspec(obj):
     decorators, target = tf_decorator.unwrap(obj)
 
     for d in decorators:
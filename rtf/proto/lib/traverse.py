@@ -0,0 +1,124 @@
+# Copyright 2015 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Traversing the public API of a Python module, as done by the TensorFlow
+api_compatibility_test to build the golden files."""
+
+# NOTE: traverse.py and public_api.py merged, without the tensorflow imports.
+
+import re
+
+from . import tf_inspect
+
+# Modules (keyed by the path of their parent) the golden files do not descend.
+DO_NOT_DESCEND = {
+    "": [
+        "pywrap_tensorflow",
+        "user_ops",
+        "python",
+        "examples",
+        "tools",
+        "tensorboard",
+        "compiler",
+        "core",
+        "flags",
+        "platform",
+        # The implementation of tf.experimental.dtensor.
+        "dtensor",
+    ],
+    "compat": ["v1", "v2"],
+}
+
+# Members (keyed by the path of their parent) that are not part of the API.
+PRIVATE = {
+    "": ["core", "python"],
+    "compat": ["v1", "v2"],
+}
+
+
+def _is_private(path, name, obj):
+    """Return whether a member is private."""
+    # TODO(wicke): Find out what names to exclude.
+    del obj  # Unused.
+    return (
+        (path in PRIVATE and name in PRIVATE[path])
+        or (name.startswith("_") and not re.match("__.*__$", name))
+        or name in ["__base__", "__class__", "__next_in_mro__"]
+    )
+
+
+def _children(root, listings):
+    """The sorted (name, member) pairs of root, memoized by id in listings:
+    the same module or class is reachable from several paths."""
+    cached = listings.get(id(root))
+    if cached is not None and cached[0] is root:
+        return list(cached[1])
+    try:
+        children = tf_inspect.getmembers(root)
+    except ImportError:
+        # On some Python installations, some modules do not support enumerating
+        # members (six in particular), leading to import errors.
+        children = []
+    listings[id(root)] = (root, children)
+    return list(children)
+
+
+def _traverse_internal(root, visit, stack, path, listings, packages):
+    """Internal helper for traverse."""
+
+    # Only traverse modules and classes
+    if not tf_inspect.isclass(root) and not tf_inspect.ismodule(root):
+        return
+
+    children = [
+        (name, child)
+        for name, child in _children(root, listings)
+        if not _is_private(path, name, child)
+    ]
+
+    new_stack = stack + [root]
+    visit(path, root, children)
+    for name, child in children:
+        # Do not descend into the modules of other packages, the forbidden
+        # modules and the objects we are already visiting, to avoid cycles.
+        if (
+            tf_inspect.ismodule(child)
+            and child.__name__.split(".")[0] not in packages
+            or name in DO_NOT_DESCEND.get(path, ())
+            or any(child is item for item in new_stack)
+        ):
+            continue
+
+        child_path = path + "." + name if path else name
+        _traverse_internal(child, visit, new_stack, child_path, listings, packages)
+
+
+def traverse(root, visit, packages=None):
+    """Recursively enumerate all members of `root`.
+
+    Similar to the Python `ast.walk`, but on a live module: calls
+    `visit(path, parent, children)` for each module or class `parent` found
+    in the public API of `root`, where `children` is the list of the
+    (name, object) pairs of its public members, sorted by name. The visitor
+    may modify `children`, to stop the traversal of some members.
+    Only the modules of the given packages are traversed.
+
+    Args:
+        root: A python object with which to start the traversal.
+        visit: A function taking arguments `(path, parent, children)`.
+        packages: the names of the top-level packages whose modules are
+                  traversed, the package of `root` by default.
+    """
+    packages = packages or (root.__name__.split(".")[0],)
+    _traverse_internal(root, visit, [], "", {}, packages)
@@ -14,22 +14,218 @@
 
 """Remote Tensorflow Execution, gRCP server."""
 
+import logging
+import signal
+import sys
+import threading
 import time
+from argparse import ArgumentParser
 from concurrent import futures
 import grpc
-from .proto import rtf_pb2_grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
+from .api import SymbolIndex
+from .generators.base import Generator
+from .proto import rtf_pb2, rtf_pb2_grpc
 from .service import RTFServicer
 
 
 def main():
     """Serving function."""
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    rtf_pb2_grpc.add_RTFServicer_to_server(RTFServicer(), server)
+    parser = ArgumentParser(description="Remote TensorFlow Execution server")
+    parser.add_argument(
+        "--rpc_workers",
+        type=int,
+        default=10,
+        help="number of DefineAndCall served concurrently",
+    )
+    parser.add_argument(
+        "--executor_workers",
+        type=int,
+        default=None,
+        help="maximum number of threads executing the independent statements of every "
+        "program, with --concurrent_subtrees",
+    )
+    parser.add_argument(
+        "--concurrent_subtrees",
+        action="store_true",
+        help="execute the independent statements of the programs concurrently, "
+        "instead of in program order",
+    )
+    parser.add_argument(
+        "--stdout_batch_size",
+        type=int,
+        default=64 * 1024,
+        help="bytes (UTF-8 encoded) of standard output sent in a single response",
+    )
+    parser.add_argument(
+        "--stdout_batch_latency",
+        type=float,
+        default=0.05,
+        help="seconds a line of standard output can wait before being sent",
+    )
+    parser.add_argument(
+        "--stdout_limit",
+        type=int,
+        default=16 * 1024 * 1024,
+        help="maximum bytes (UTF-8 encoded) of standard output relayed for every "
+        "execution",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="bytes of responses of cacheable programs to keep, 0 disables the cache",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=3600,
+        help="seconds after which a cached response expires",
+    )
+    parser.add_argument(
+        "--cache_stats_interval",
+        type=float,
+        default=0,
+        help="seconds between the logs of the cache metrics (entries, size, "
+        "hits, misses, evictions, hit rate), 0 disables them",
+    )
+    parser.add_argument(
+        "--unix_socket",
+        default=None,
+        metavar="PATH",
+        help="also listen on the unix socket at PATH: its clients can exchange "
+        "the large values in shared memory",
+    )
+    parser.add_argument(
+        "--shared_segments",
+        type=int,
+        default=64,
+        help="shared memory segments of the clients kept attached, 0 disables "
+        "the shared memory",
+    )
+    parser.add_argument(
+        "--stream_prefetch",
+        type=int,
+        default=8,
+        help="elements of a streamed dataset produced ahead of the credits of "
+        "the client",
+    )
+    parser.add_argument(
+        "--session_dir",
+        default=None,
+        metavar="DIR",
+        help="snapshot the sessions in DIR, and restore them from it on first access",
+    )
+    parser.add_argument(
+        "--snapshot_interval",
+        type=float,
+        default=300,
+        help="seconds between the snapshots of the changed sessions, 0 to "
+        "snapshot them only when the server stops",
+    )
+    parser.add_argument(
+        "--max_message_size",
+        type=int,
+        default=256 * 1024 * 1024,
+        help="maximum size in bytes of the messages received and sent",
+    )
+    parser.add_argument(
+        "--client_ttl",
+        type=float,
+        default=3600,
+        help="seconds after which the nodes kept on the server for an idle "
+        "client are dropped",
+    )
+    parser.add_argument(
+        "--validate_symbols",
+        default=None,
+        help="validate the tf.* symbols of the programs, before executing them, "
+        "against the golden API of this TensorFlow version",
+        choices=Generator.golden_versions(),
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    symbols = None
+    if args.validate_symbols:
+        symbols = SymbolIndex(Generator.get_api_model(args.validate_symbols))
+
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=args.rpc_workers),
+        options=[
+            ("grpc.max_send_message_length", args.max_message_size),
+            ("grpc.max_receive_message_length", args.max_message_size),
+        ],
+    )
+    servicer = RTFServicer(
+        max_workers=args.executor_workers,
+        stdout_batch_size=args.stdout_batch_size,
+        stdout_batch_latency=args.stdout_batch_latency,
+        stdout_limit=args.stdout_limit,
+        cache_size=args.cache_size,
+        cache_ttl=args.cache_ttl,
+        symbols=symbols,
+        shared_segments=args.shared_segments,
+        stream_prefetch=args.stream_prefetch,
+        session_dir=args.session_dir,
+        concurrent_subtrees=args.concurrent_subtrees,
+        client_ttl=args.client_ttl,
+    )
+    rtf_pb2_grpc.add_RTFServicer_to_server(servicer, server)
+
+    # The server is alive as soon as the port is bound, and ready (SERVING)
+    # once TensorFlow has been initialized.
+    health_servicer = health.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+    services = ("", rtf_pb2.DESCRIPTOR.services_by_name["RTF"].full_name)
+    for service in services:
+        health_servicer.set(service, health_pb2.HealthCheckResponse.NOT_SERVING)
+
     server.add_insecure_port("[::]:50051")
+    if args.unix_socket:
+        server.add_insecure_port(f"unix:{args.unix_socket}")
     server.start()
-    while True:
-        time.sleep(1)
-    return 1
+
+    def warm_up():
+        try:
+            servicer.warm_up()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("TensorFlow initialization failed")
+            return
+        for service in services:
+            health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
+
+    threading.Thread(target=warm_up, daemon=True).start()
+
+    def snapshot():
+        while True:
+            time.sleep(args.snapshot_interval)
+            servicer.snapshot_sessions()
+
+    if args.session_dir and args.snapshot_interval > 0:
+        threading.Thread(target=snapshot, daemon=True).start()
+
+    def cache_stats():
+        while True:
+            time.sleep(args.cache_stats_interval)
+            logging.info("response cache: %s", servicer.cache_stats())
+
+    if args.cache_size and args.cache_stats_interval > 0:
+        threading.Thread(target=cache_stats, daemon=True).start()
+
+    # On SIGTERM and SIGINT the server stops accepting calls, waits for the
+    # running ones and snapshots the sessions.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop(grace=30).wait()
+        if args.session_dir:
+            logging.info("%d sessions snapshotted", servicer.snapshot_sessions())
+    return 0
 
 
 if __name__ == "__main__":
@@ -11,37 +11,170 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-
 """Remote TensorFlow (RTF) gRPC service provider."""
+
+import ast
+import base64
+import builtins
 import io
+import itertools
+import os
 import queue
-from collections import deque
+from collections import defaultdict, deque
+from concurrent import futures
 import threading
 import sys
+import time
+import traceback
 from typing import Iterator
 import re
 import contextlib
-import tensorflow as tf
+import logging
+from . import shm, values
+from .sessions import ClientNamespaces, Sessions, aliased, mutated
+from .cache import ResponseCache, fingerprint
 from .proto import rtf_pb2, rtf_pb2_grpc
 
+# ast.parse and compile of an AST are not thread safe in every Python version
+# (CPython 3.11: "AST constructor recursion depth mismatch"): the programs of
+# the concurrent calls are compiled one at a time.
+_COMPILE_LOCK = threading.Lock()
+
+# The names of the builtins, that never alias the objects of a program.
+_BUILTINS = frozenset(vars(builtins))
+
+# Seconds between the checks of the cancellation of a stream, by the threads
+# waiting for its elements.
+_POLL_INTERVAL = 0.1
+
 
 def rreplace(s, old, new, occurrence):
     li = s.rsplit(old, occurrence)
     return new.join(li)
 
 
+class Subtree:
+    """A contiguous group of top-level statements that runs as a single unit.
+
+    Subtrees are the nodes of the dependency DAG built by the Builder:
+    every subtree runs once all the subtrees in `depends_on` completed.
+    """
+
+    def __init__(self, node_id, statements):
+        self.node_id = node_id
+        self.statements = statements
+        self.code = None
+        self.reads = set()
+        self.writes = set()
+        # The global names bound by the statements (assignments, def, import).
+        self.binds = set()
+        # The names of the objects changed in place (method calls,
+        # attribute and item assignments).
+        self.mutates = set()
+        # The names of the functions called.
+        self.calls = set()
+        # True if the statements have side effects (output, files...).
+        self.effect = False
+        self.barrier = False
+        self.depends_on = set()
+        self.dependents = set()
+
+
+class InvalidSymbolError(Exception):
+    """Raised when a statement uses a symbol that's not part of the API."""
+
+    def __init__(self, symbol, lineno):
+        super().__init__(f"{symbol} is not part of the TensorFlow API")
+        self.filename = Builder.FILENAME
+        self.lineno = lineno
+
+
 class Builder:
 
-    HEADER = (
-        "import tensorflow as tf\n"
-        "import sys\n\n"
-        # "@tf.function\n"
-        "def f():\n"
+    HEADER = "import tensorflow as tf\nimport sys\n"
+
+    # Filename of the compiled program, used to find its frames in the tracebacks.
+    FILENAME = "<rtf>"
+
+    # Functions available to the program: RETURN(value) sets the value sent
+    # in the body of the final response, STREAM(dataset) sets the dataset
+    # whose elements are streamed (see RTFServicer.Stream), LOAD(node_id)
+    # deserializes the value sent by the client in RTFStatement.value (or
+    # LOAD(data), the value in the source), LOAD_SHARED(offset, size) one
+    # uploaded in the shared memory segment of the client. See rtf.values
+    # and rtf.shm.
+    RETURN = "rtf_return"
+    STREAM = "rtf_stream"
+    LOAD = "rtf_load"
+    LOAD_SHARED = "rtf_load_shared"
+
+    # Calls that change the global TensorFlow state: the statements containing
+    # them are executed after every previous statement and before any
+    # following statement.
+    BARRIERS = (
+        "tf.config.",
+        "tf.random.set_seed",
+        "tf.keras.backend.",
+        "tf.keras.utils.set_random_seed",
+        "tf.compat.v1.",
     )
-    FOOTER = "\nf()\n"
 
-    def __init__(self):
+    # Calls with side effects (output, files, checkpoints...): the subtrees
+    # containing them run in program order. The calls of the functions that
+    # are not PURE_BUILTINS, and of the modules other than tf, are too.
+    EFFECTS = (
+        "tf.print",
+        "tf.io.",
+        "tf.summary.",
+        "tf.saved_model.",
+        "tf.train.",
+        "tf.keras.models.",
+    )
+    EFFECT_METHODS = frozenset(
+        ("save", "save_weights", "load_weights", "write", "read", "restore", "flush")
+    )
+    PURE_BUILTINS = frozenset(
+        (
+            "abs all any bool bytes complex dict divmod enumerate filter float "
+            "frozenset getattr hasattr hash int isinstance issubclass iter len list "
+            "map max min range repr reversed round set slice sorted str sum tuple "
+            "type zip"
+        ).split()
+        + [LOAD, LOAD_SHARED]
+    )
+
+    def __init__(self, symbols=None, shared=None, concurrent=False):
+        """
+        Args:
+            symbols: the SymbolIndex used to validate the tf.* symbols of the
+                     program before executing it. None to skip the validation.
+            shared: the memoryview of the uploaded values, in the shared
+                    memory segment of the client, or None.
+            concurrent: execute the independent subtrees concurrently. False
+                        to execute them one at a time, in program order.
+        """
+        self._symbols = symbols
+        self._shared = shared
+        self.concurrent = concurrent
+        # name -> the Subtree describing the body of the functions (and the
+        # classes) defined by the program.
+        self._functions = {}
+        # The dataset passed to the last STREAM call.
+        self.dataset = None
+        # The global names bound by the executed program.
+        self.binds = set()
+        # Set when no subtree of the program is running: after a failure the
+        # subtrees already running are not awaited by __call__, but still use
+        # the namespace until they finish.
+        self.idle = threading.Event()
+        self.idle.set()
         self._statements = []
+        self._node_ids = []
+        # node_id -> the value sent in the RTFStatement.
+        self._values = {}
+        # Index of the statement every line of the source comes from.
+        self._line_statements = []
+        self._links = []
         self._indent_re = re.compile(r"^(\s*)")
 
     def _flush_stdout(self, stmt):
@@ -57,74 +190,993 @@ class Builder:
 
         return stmt
 
-    def build(self, stmt):
+    def build(self, stmt, node_id=0, parent_id=0, contexts=(), value=b""):
         # TODO: check stmt correctness using its AST or other structure.
+        if value:
+            self._values[node_id] = value
         stmt = self._flush_stdout(stmt)
+        index = len(self._statements)
         self._statements.append(stmt)
+        self._node_ids.append(node_id)
+        self._line_statements.extend([index] * (stmt.count("\n") + 1))
+        if node_id:
+            self._links.extend((node_id, ref) for ref in (parent_id, *contexts) if ref)
+
+    def _load(self, key):
+        """LOAD: the value sent in RTFStatement.value of the statement key
+        (a node_id), or the value key (the serialized value)."""
+        if isinstance(key, int):
+            return values.loads(self._values[key])
+        return values.loads(key)
+
+    def _group(self, body):
+        """Split the top-level statements into contiguous groups.
+
+        Lines coming from the same statement and statements linked through
+        parent_id/contexts end up in the same group, together with every
+        statement between them.
+        """
+        # ends[i] is the index of the last statement that must be in the same
+        # group of the statement at index i.
+        ends = list(range(len(body)))
+        first_index, node_index = {}, {}
+        for index, stmt in enumerate(body):
+            for line in range(stmt.lineno, stmt.end_lineno + 1):
+                statement = self._line_statements[line - 1]
+                first = first_index.setdefault(statement, index)
+                ends[first] = max(ends[first], index)
+                node_index.setdefault(self._node_ids[statement], first)
+
+        for node_id, ref in self._links:
+            if node_id in node_index and ref in node_index:
+                low, high = sorted((node_index[node_id], node_index[ref]))
+                ends[low] = max(ends[low], high)
+
+        groups, start, end = [], 0, -1
+        for index in range(len(body)):
+            end = max(end, ends[index])
+            if index == end:
+                groups.append(body[start : index + 1])
+                start = index + 1
+        return groups
+
+    @staticmethod
+    def _dotted_name(node):
+        parts = []
+        while isinstance(node, ast.Attribute):
+            parts.append(node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            return None, None
+        parts.append(node.id)
+        return node.id, ".".join(reversed(parts))
+
+    def _collect(self, usage, statements, modules, nested=False):
+        """Collect in usage (a Subtree) the names read and written by the
+        statements, their calls and side effects.
 
-    def __call__(self):
-        source = Builder.HEADER
-        for stmt in self._statements:
-            source += f"    {stmt}\n"
-        source += Builder.FOOTER
-        f = compile(source, "useless", "exec")
-        return eval(f)
+        Method calls and attribute/item assignments are considered writes of
+        the base name, unless the name refers to an imported module.
+        The bodies of the functions and classes are not part of the
+        statements: they're collected apart (see _function), and merged in
+        usage only when nested.
+        """
+        local = set()
+        pending = deque(statements)
+        while pending:
+            node = pending.popleft()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                usage.writes.add(node.name)
+                usage.binds.add(node.name)
+                function = self._function(node, modules)
+                if nested:
+                    usage.reads |= function.reads
+                    usage.writes |= function.writes
+                    usage.mutates |= function.mutates
+                    usage.calls |= function.calls
+                    usage.effect = usage.effect or function.effect
+                    usage.barrier = usage.barrier or function.barrier
+                else:
+                    self._functions[node.name] = function
+                # Evaluated where the function (or class) is defined.
+                pending.extend(node.decorator_list)
+                if isinstance(node, ast.ClassDef):
+                    pending.extend(node.bases)
+                    pending.extend(node.keywords)
+                else:
+                    pending.append(node.args)
+                continue
+            if isinstance(node, ast.comprehension):
+                local.update(
+                    name.id
+                    for name in ast.walk(node.target)
+                    if isinstance(name, ast.Name)
+                )
+            elif isinstance(node, ast.Name):
+                if isinstance(node.ctx, ast.Load):
+                    usage.reads.add(node.id)
+                else:
+                    usage.writes.add(node.id)
+                    usage.binds.add(node.id)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    name = (alias.asname or alias.name).split(".")[0]
+                    usage.writes.add(name)
+                    usage.binds.add(name)
+                    modules.add(name)
+            elif isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(
+                node.ctx, ast.Load
+            ):
+                base, _ = self._dotted_name(
+                    node.value if isinstance(node, ast.Subscript) else node
+                )
+                if base:
+                    usage.writes.add(base)
+                    usage.mutates.add(base)
+            elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                usage.calls.add(node.func.id)
+                if node.func.id not in Builder.PURE_BUILTINS:
+                    usage.effect = True
+            elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+                base, dotted = self._dotted_name(node.func)
+                if dotted and dotted.startswith(Builder.BARRIERS):
+                    usage.barrier = True
+                elif dotted and dotted.startswith(Builder.EFFECTS):
+                    usage.effect = True
+                elif base in modules:
+                    usage.effect = usage.effect or base != "tf"
+                elif base:
+                    usage.writes.add(base)
+                    usage.mutates.add(base)
+                    if node.func.attr in Builder.EFFECT_METHODS:
+                        usage.effect = True
+            pending.extend(ast.iter_child_nodes(node))
+        usage.reads -= local
+        usage.writes -= local
+        usage.binds -= local
+        usage.mutates -= local
+
+    def _function(self, node, modules):
+        """The globals read and written by the calls of the function (or by
+        the instantiation of the class) node, its calls and side effects,
+        as a Subtree."""
+        function = Subtree(None, node.body)
+        self._collect(function, node.body, set(modules), nested=True)
+        declared = {
+            name
+            for child in ast.walk(node)
+            if isinstance(child, ast.Global)
+            for name in child.names
+        }
+        local = function.binds - declared
+        if not isinstance(node, ast.ClassDef):
+            local |= {
+                arg.arg for arg in ast.walk(node.args) if isinstance(arg, ast.arg)
+            }
+        function.reads -= local
+        function.writes -= local
+        function.mutates -= local
+        return function
+
+    def _analyze(self, subtree, modules):
+        """Collect the names read and written by the subtree, and its side
+        effects, including the ones of the functions of the program it calls
+        (transitively)."""
+        self._collect(subtree, subtree.statements, modules)
+        seen, calls = set(), list(subtree.calls)
+        while calls:
+            name = calls.pop()
+            function = self._functions.get(name)
+            if name in seen or function is None:
+                continue
+            seen.add(name)
+            subtree.reads |= function.reads
+            subtree.writes |= function.writes
+            subtree.mutates |= function.mutates
+            subtree.effect = subtree.effect or function.effect
+            subtree.barrier = subtree.barrier or function.barrier
+            calls.extend(function.calls)
+
+    def _validate(self, body):
+        """Raise InvalidSymbolError for the first tf.* symbol of the program
+        that's not part of the API."""
+        for node in ast.walk(ast.Module(body=body, type_ignores=[])):
+            if isinstance(node, ast.Attribute):
+                base, dotted = self._dotted_name(node)
+                if base == "tf":
+                    invalid = self._symbols.validate(dotted)
+                    if invalid is not None:
+                        raise InvalidSymbolError(invalid, node.lineno)
+
+    def subtrees(self):
+        """Build the dependency DAG of the program.
+
+        A name bound from the value of other names (`m = l`, `m = f()`,
+        `for m in items`) may refer to the same object: the names are merged
+        in an alias set, and changing the object in place through any of them
+        is a write of all the names of the set.
+
+        Returns:
+            The list of Subtree, in program order.
+        """
+        source = "\n".join(self._statements)
+        with _COMPILE_LOCK:
+            body = ast.parse(source, Builder.FILENAME).body
+        if self._symbols is not None:
+            self._validate(body)
+        modules = {"tf", "sys"}
+        aliases = {}
+        subtrees = []
+        for statements in self._group(body):
+            subtree = Subtree(
+                self._node_ids[self._line_statements[statements[0].lineno - 1]],
+                statements,
+            )
+            with _COMPILE_LOCK:
+                subtree.code = compile(
+                    ast.Module(body=statements, type_ignores=[]),
+                    Builder.FILENAME,
+                    "exec",
+                )
+            self._analyze(subtree, modules)
+            # Modules, builtins and functions don't alias their results: the
+            # globals read by the functions called are part of the reads.
+            sources = subtree.reads - modules - _BUILTINS - self._functions.keys()
+            if subtree.binds and sources:
+                merged = set().union(
+                    *(aliases.get(name, {name}) for name in subtree.binds | sources)
+                )
+                for name in merged:
+                    aliases[name] = merged
+            for name in subtree.mutates:
+                subtree.writes |= aliases.get(name, set())
+            if not self.concurrent:
+                # Program order: every subtree depends on the previous one.
+                previous_subtrees = subtrees[-1:]
+            else:
+                previous_subtrees = [
+                    previous
+                    for previous in subtrees
+                    if subtree.barrier
+                    or previous.barrier
+                    or subtree.effect
+                    and previous.effect
+                    or previous.writes & (subtree.reads | subtree.writes)
+                    or previous.reads & subtree.writes
+                ]
+            for previous in previous_subtrees:
+                subtree.depends_on.add(previous)
+                previous.dependents.add(subtree)
+            subtrees.append(subtree)
+        return subtrees
+
+    def format_exception(self, exception):
+        """Format the exception raised by the program as a compact traceback,
+        that contains only the frames of the program.
+
+        Returns:
+            (node_id, traceback): the node_id of the statement that raised
+            the exception and the formatted traceback.
+        """
+        source_lines = "\n".join(self._statements).split("\n")
+        linenos = [
+            frame.lineno
+            for frame in traceback.extract_tb(exception.__traceback__)
+            if frame.filename == Builder.FILENAME
+        ]
+        # SyntaxError and InvalidSymbolError
+        if getattr(exception, "filename", None) == Builder.FILENAME:
+            linenos.append(exception.lineno)
+
+        node_id = 0
+        lines = []
+        for lineno in linenos:
+            if not lineno or lineno > len(source_lines):
+                continue
+            node_id = self._node_ids[self._line_statements[lineno - 1]]
+            lines.append(
+                f"  node {node_id}, line {lineno}: {source_lines[lineno - 1].strip()}\n"
+            )
+        lines.extend(traceback.format_exception_only(type(exception), exception))
+        return node_id, "".join(lines)
+
+    def __call__(self, pool, fp, namespace=None):
+        """Execute the program, running the independent subtrees concurrently
+        on the pool, or one at a time in the calling thread if pool is None.
+        The standard output of every subtree is written to fp.
+        The program runs in namespace (the one of a session), in a new one
+        if None. Returns the serialized value passed to the last RETURN call,
+        or None.
+        On the first failure the exception is raised immediately: no other
+        subtree is started, and the ones already running are abandoned,
+        `idle` is set once they finish.
+        """
+        if namespace is None:
+            namespace = {}
+        exec(compile(Builder.HEADER, "<rtf header>", "exec"), namespace)
+        result = []
+        namespace[Builder.RETURN] = lambda value: result.append(values.dumps(value))
+        namespace[Builder.STREAM] = lambda dataset: setattr(self, "dataset", dataset)
+        namespace[Builder.LOAD] = self._load
+        namespace.pop(Builder.LOAD_SHARED, None)
+        if self._shared is not None:
+            shared = self._shared
+            namespace[Builder.LOAD_SHARED] = lambda offset, size: values.loads(
+                shared[offset : offset + size]
+            )
+        subtrees = self.subtrees()
+        self.binds = set().union(*(subtree.binds for subtree in subtrees))
+
+        lock = threading.Lock()
+        done = threading.Event()
+        errors = []
+        missing = {subtree: len(subtree.depends_on) for subtree in subtrees}
+        ready = [subtree for subtree in subtrees if not subtree.depends_on]
+        running = len(ready)
+
+        def run(subtree):
+            with _STDOUT.redirect(fp), fp.node(subtree.node_id):
+                exec(subtree.code, namespace)
+
+        if pool is None:
+            # The subtrees are in program order.
+            for subtree in subtrees:
+                run(subtree)
+            return result[-1] if result else None
+
+        def on_done(subtree, future):
+            nonlocal running
+            ready = []
+            with lock:
+                running -= 1
+                # The subtrees still queued are cancelled after a failure.
+                if not future.cancelled() and future.exception() is not None:
+                    errors.append(future.exception())
+                    # Fail fast: the subtrees still running are not awaited,
+                    # and none of their dependents is started.
+                    done.set()
+                if not errors:
+                    for dependent in subtree.dependents:
+                        missing[dependent] -= 1
+                        if not missing[dependent]:
+                            ready.append(dependent)
+                running += len(ready)
+                if not running:
+                    done.set()
+                    self.idle.set()
+            submit(ready)
+
+        def submit(subtrees):
+            nonlocal running
+            for subtree in subtrees:
+                try:
+                    future = pool.submit(run, subtree)
+                except RuntimeError as exception:
+                    # The pool has been shut down after a failure: the
+                    # subtree never runs.
+                    with lock:
+                        errors.append(exception)
+                        done.set()
+                        running -= 1
+                        if not running:
+                            done.set()
+                            self.idle.set()
+                    continue
+                future.add_done_callback(lambda f, s=subtree: on_done(s, f))
+
+        if not ready:
+            return None
+        self.idle.clear()
+        submit(ready)
+        done.wait()
+        if errors:
+            raise errors[0]
+        return result[-1] if result else None
+
+
+def _utf8_size(s):
+    """Size in bytes of s, UTF-8 encoded as in the RTFResponse."""
+    return len(s.encode("utf-8", "surrogatepass"))
+
+
+def _utf8_chunks(s, size):
+    """Split s into strings of at most size bytes, UTF-8 encoded, without
+    splitting any character (a chunk holds at least one character)."""
+    encoded = s.encode("utf-8", "surrogatepass")
+    chunks = []
+    start = 0
+    while start < len(encoded):
+        end = start + size
+        # Move back to the first byte of the character: 0b10xxxxxx are the
+        # continuation bytes.
+        while start < end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        if end == start:
+            end += 1
+            while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+                end += 1
+        chunks.append(encoded[start:end].decode("utf-8", "surrogatepass"))
+        start = end
+    return chunks
 
 
 class DoubleIO(io.StringIO):
-    def __init__(self, initial_value="", newline="\n"):
+    """Buffer of the standard output of a program.
+
+    Every flushed line is queued, tagged with the node_id of the writing
+    thread, until a reader collects it in batches (see read_batch).
+    At most `limit` bytes (UTF-8 encoded) are accepted, everything after that
+    is dropped.
+    """
+
+    def __init__(self, initial_value="", newline="\n", limit=None):
         super().__init__(initial_value, newline)
         self._lines = deque()
-        self._buffer = []
+        self._buffers = defaultdict(list)
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._limit = limit
+        self._written = 0
+        self._pending = 0
+        self._first_pending = 0.0
+        self.dropped = 0
+
+    @contextlib.contextmanager
+    def node(self, node_id):
+        """Attribute everything written by the current thread to node_id."""
+        previous = getattr(self._local, "node_id", 0)
+        self._local.node_id = node_id
+        try:
+            yield self
+        finally:
+            self._local.node_id = previous
 
     def flush(self):
-        self._lines.append("".join(self._buffer))
-        self._buffer.clear()
+        with self._cond:
+            buffer = self._buffers[getattr(self._local, "node_id", 0)]
+            if not buffer:
+                return
+            line = "".join(buffer)
+            buffer.clear()
+            if not self._lines:
+                self._first_pending = time.monotonic()
+            self._lines.append((getattr(self._local, "node_id", 0), line))
+            self._pending += _utf8_size(line)
+            self._cond.notify()
 
     def write(self, s):
-        self._buffer.append(s)
+        with self._cond:
+            size = _utf8_size(s)
+            if self._limit is not None and self._written + size > self._limit:
+                # The character cut by the limit is dropped whole.
+                s = s.encode("utf-8", "surrogatepass")[
+                    : max(self._limit - self._written, 0)
+                ].decode("utf-8", "ignore")
+                accepted = _utf8_size(s)
+                self.dropped += size - accepted
+                size = accepted
+            self._written += size
+            if s:
+                self._buffers[getattr(self._local, "node_id", 0)].append(s)
+        return len(s)
 
     def close(self):
-        super().close()
+        with self._cond:
+            for node_id, buffer in self._buffers.items():
+                if buffer:
+                    self._lines.append((node_id, "".join(buffer)))
+            self._buffers.clear()
+            super().close()
+            self._cond.notify_all()
+
+    def read_batch(self, max_size, max_latency):
+        """Wait for the flushed lines and return them as a list of
+        (node_id, line) pairs.
 
-    def readline(self):
-        return self._lines.popleft()
+        Returns when at least max_size bytes are pending, when the oldest
+        pending line waited for max_latency seconds or when the stream is closed.
+        Returns None once the stream is closed and every line has been read.
+        """
+        with self._cond:
+            while True:
+                if self._lines:
+                    waited = time.monotonic() - self._first_pending
+                    if (
+                        self.closed
+                        or self._pending >= max_size
+                        or waited >= max_latency
+                    ):
+                        break
+                    self._cond.wait(max_latency - waited)
+                elif self.closed:
+                    return None
+                else:
+                    self._cond.wait()
+            batch = list(self._lines)
+            self._lines.clear()
+            self._pending = 0
+            return batch
+
+
+class StdoutRouter(io.TextIOBase):
+    """Replacement of sys.stdout that forwards every write to the stream
+    selected by the writing thread, or to the real stdout otherwise.
+
+    contextlib.redirect_stdout swaps the stdout of the whole process, hence it
+    can't be used when several statements are executed concurrently.
+    """
+
+    def __init__(self, stdout):
+        super().__init__()
+        self._stdout = stdout
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, "target", None) or self._stdout
+
+    @contextlib.contextmanager
+    def redirect(self, target):
+        previous = getattr(self._local, "target", None)
+        self._local.target = target
+        try:
+            yield target
+        finally:
+            self._local.target = previous
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        return self._target().flush()
+
+
+_STDOUT = StdoutRouter(sys.stdout)
+
+
+class Credits:
+    """The elements a client of Stream is ready to receive: the client grants
+    them, the server takes one for every element it sends."""
+
+    def __init__(self, credits=0):
+        self._credits = credits
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def grant(self, credits):
+        with self._cond:
+            self._credits += credits
+            self._cond.notify_all()
+
+    def take(self):
+        """Wait for a credit and take it. Returns False if closed."""
+        with self._cond:
+            while not self._credits and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return False
+            self._credits -= 1
+            return True
+
+    def close(self):
+        """Wake up the waiting take, that returns False."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
 
 
 class RTFServicer(rtf_pb2_grpc.RTFServicer):
     """Remote TensorFlow (RTF) gRPC service provider."""
 
+    def __init__(
+        self,
+        max_workers=None,
+        stdout_batch_size=64 * 1024,
+        stdout_batch_latency=0.05,
+        stdout_limit=16 * 1024 * 1024,
+        cache_size=64 * 1024 * 1024,
+        cache_ttl=3600,
+        symbols=None,
+        shared_segments=64,
+        stream_prefetch=8,
+        session_dir=None,
+        concurrent_subtrees=False,
+        client_ttl=3600,
+    ):
+        """
+        Args:
+            max_workers: maximum number of threads executing the subtrees of
+                         every program, with concurrent_subtrees.
+            stdout_batch_size: bytes (UTF-8 encoded) of standard output that
+                               trigger the sending of a response, and the
+                               maximum size of its stdout.
+            stdout_batch_latency: seconds a flushed line can wait before being sent.
+            stdout_limit: maximum number of bytes (UTF-8 encoded) of standard
+                          output relayed for every execution; the rest is
+                          dropped.
+            cache_size: maximum size in bytes of the cached responses of the
+                        programs marked as cacheable. 0 disables the cache.
+            cache_ttl: seconds after which a cached response expires.
+            symbols: the SymbolIndex used to validate the programs before
+                     executing them. None disables the validation.
+            shared_segments: number of shared memory segments of the clients
+                             kept attached. 0 disables the shared memory.
+            stream_prefetch: elements of a streamed dataset produced ahead of
+                             the credits of the client.
+            session_dir: the folder of the snapshots of the sessions (see
+                         rtf.sessions). None keeps them in memory only.
+            concurrent_subtrees: execute the independent subtrees of every
+                                 program concurrently, instead of in program
+                                 order.
+            client_ttl: seconds after which the names kept for an idle client
+                        (RTFStatement.keep) are dropped.
+        """
+        self._max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self._stdout_batch_size = stdout_batch_size
+        self._stdout_batch_latency = stdout_batch_latency
+        self._stdout_limit = stdout_limit
+        self._cache = ResponseCache(cache_size, cache_ttl) if cache_size else None
+        self._symbols = symbols
+        self._shared_segments = (
+            shm.AttachedSegments(shared_segments) if shared_segments else None
+        )
+        self._stream_prefetch = max(stream_prefetch, 1)
+        self._sessions = Sessions(session_dir)
+        self._concurrent_subtrees = concurrent_subtrees
+        self._clients = ClientNamespaces(client_ttl)
+        sys.stdout = _STDOUT
+
+    def warm_up(self):
+        """Import TensorFlow and initialize its runtime, so that the first
+        program doesn't pay the startup cost.
+        TensorFlow is never imported at module import time: the server binds its
+        port and answers the health checks while this runs in background.
+        """
+        namespace = {}
+        exec(compile(Builder.HEADER, "<rtf header>", "exec"), namespace)
+        # Creates the eager context and the CPU device.
+        namespace["tf"].constant(0).numpy()
+
+    def cache_stats(self):
+        """Returns the metrics of the response cache as a dict (see
+        ResponseCache.stats), None if the cache is disabled."""
+        return self._cache.stats() if self._cache is not None else None
+
+    def snapshot_sessions(self):
+        """Snapshot the sessions changed since their last snapshot.
+        Returns the number of snapshots written."""
+        return self._sessions.snapshot_all()
+
     def DefineAndCall(self, request_iterator, context) -> Iterator[rtf_pb2.RTFResponse]:
+        statements = list(request_iterator)
+        region = next(
+            (
+                statement.shared
+                for statement in statements
+                if statement.HasField("shared")
+            ),
+            None,
+        )
+        if region is None:
+            yield from self._define_and_call(statements)
+            return
+
+        # Only the clients on the same host can share memory with the server.
+        if self._shared_segments is None or not context.peer().startswith("unix:"):
+            yield rtf_pb2.RTFResponse(
+                status=False,
+                error="Shared memory is available only through the unix socket of the server",
+            )
+            return
+        try:
+            with self._shared_segments.attach(region.name) as memory:
+                if region.offset + region.size > len(memory):
+                    raise ValueError(f"The region exceeds the segment {region.name}")
+                with memory[: region.offset] as shared, memory[
+                    region.offset : region.offset + region.size
+                ] as output:
+                    for response in self._define_and_call(statements, shared):
+                        yield self._share(response, region, output)
+        except (OSError, ValueError) as error:
+            yield rtf_pb2.RTFResponse(status=False, error=f"Shared memory: {error}")
+
+    @staticmethod
+    def _share(response, region, output):
+        """The response with its body written in the output region of the
+        shared memory of the client, if it's large enough and fits."""
+        size = len(response.body)
+        if size < shm.MIN_SIZE or size > len(output):
+            return response
+        output[:size] = response.body
+        return rtf_pb2.RTFResponse(
+            node_id=response.node_id,
+            status=response.status,
+            stdout=response.stdout,
+            stdout_truncated=response.stdout_truncated,
+            error=response.error,
+            shared_body=rtf_pb2.SharedRegion(
+                name=region.name, offset=region.offset, size=size
+            ),
+        )
+
+    def Stream(self, request_iterator, context) -> Iterator[rtf_pb2.RTFResponse]:
+        requests = iter(request_iterator)
+        builder = Builder(self._symbols, concurrent=self._concurrent_subtrees)
+        credits = Credits()
+        statements = []
+        for request in requests:
+            if request.HasField("statement"):
+                statement = request.statement
+                statements.append(statement)
+                builder.build(
+                    statement.stmt,
+                    statement.node_id,
+                    statement.parent_id,
+                    statement.contexts,
+                    statement.value,
+                )
+            else:
+                credits.grant(request.credits)
+                break
+
+        # The standard output of the program is sent as it's produced, its
+        # final response only if the execution failed.
+        final = None
+        for response in self._run(builder, statements, keep=False):
+            if final is not None:
+                yield final
+            final = response
+        if not final.status:
+            yield final
+            return
+        if builder.dataset is None:
+            yield rtf_pb2.RTFResponse(
+                status=False,
+                error=f"The program didn't pass a dataset to {Builder.STREAM}",
+            )
+            return
+
+        # The credits granted later are read in background, every element
+        # takes one. A producer serializes the elements ahead of the
+        # credits, at most stream_prefetch of them.
+        done = threading.Event()
+        context.add_callback(done.set)
+        context.add_callback(credits.close)
+
+        def read_credits():
+            for request in requests:
+                credits.grant(request.credits)
+
+        elements = queue.Queue(self._stream_prefetch)
+
+        def put(item):
+            while not done.is_set():
+                try:
+                    elements.put(item, timeout=_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            import tensorflow as tf  # pylint: disable=import-outside-toplevel
+
+            try:
+                for element in builder.dataset:
+                    item = [values.dumps(value) for value in tf.nest.flatten(element)]
+                    if not put(item):
+                        return
+                put(None)
+            except Exception as exception:  # pylint: disable=broad-except
+                put(exception)
+
+        threading.Thread(target=read_credits, daemon=True).start()
+        threading.Thread(target=produce, daemon=True).start()
+        try:
+            while not done.is_set():
+                try:
+                    item = elements.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if isinstance(item, Exception):
+                    node_id, error = builder.format_exception(item)
+                    yield rtf_pb2.RTFResponse(
+                        node_id=node_id, status=False, error=error
+                    )
+                    return
+                if item is None:
+                    yield final
+                    return
+                if not credits.take():
+                    return
+                yield rtf_pb2.RTFResponse(status=True, element=item)
+        finally:
+            done.set()
+
+    def _define_and_call(self, statements, shared=None):
+        """Execute the program (or send its cached responses), yielding its
+        responses. shared is the memoryview of the values uploaded in shared
+        memory, if any."""
+        # The programs of a session (or of the namespace of a client) depend
+        # on its state: they're not cached.
+        key = None
+        if (
+            self._cache is not None
+            and any(statement.cacheable for statement in statements)
+            and not any(statement.session or statement.keep for statement in statements)
+        ):
+            key = fingerprint(statements, shared)
+            responses = self._cache.get(key)
+            if responses is not None:
+                yield from responses
+                return
+
+        builder = Builder(self._symbols, shared, self._concurrent_subtrees)
+        for statement in statements:
+            builder.build(
+                statement.stmt,
+                statement.node_id,
+                statement.parent_id,
+                statement.contexts,
+                statement.value,
+            )
+
+        responses = []
+        for response in self._run(builder, statements):
+            if key is not None:
+                responses.append(response)
+            yield response
+
+        # Only the successful executions are cached.
+        if key is not None and responses[-1].status:
+            self._cache.put(key, responses)
+
+    def _run(self, builder, statements, keep=True) -> Iterator[rtf_pb2.RTFResponse]:
+        """Execute the program in builder, in the namespace of its session
+        if any, yielding its responses. The programs of a session are
+        executed one at a time, the first one restores its snapshot (or
+        clones the session in RTFStatement.clone).
+        The programs with RTFStatement.keep are executed in a copy of the
+        namespace of their client, that keeps the names they bound after a
+        successful execution, unless keep is False."""
+        name = next((s.session for s in statements if s.session), "")
+        clone = next((s.clone for s in statements if s.clone), None)
+        if not name:
+            client = next((s.uuid for s in statements if s.keep), None)
+            if client is None:
+                yield from self._execute(builder)
+                return
+            namespace = self._clients.namespace(
+                client, [name for s in statements for name in s.release]
+            )
+            for response in self._execute(builder, namespace):
+                yield response
+            if keep and response.status:
+                self._clients.keep(client, namespace, builder.binds)
+            return
+        try:
+            session = self._sessions.get(name)
+        except ValueError as error:
+            yield rtf_pb2.RTFResponse(status=False, error=str(error))
+            return
+        with session.lock:
+            try:
+                self._sessions.open(session, self._replay, clone)
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.exception("opening the session %s failed", name)
+                yield rtf_pb2.RTFResponse(
+                    status=False,
+                    error=f"Opening the session {name} failed: "
+                    f"{type(exception).__name__}: {exception}",
+                )
+                return
+            # The programs of a clone don't change the objects it shares with
+            # its source, nor bind them to other names, that would escape
+            # the check.
+            source = "\n".join(s.stmt for s in statements)
+            names = self._sessions.shared(session)
+            for check, action in (
+                (mutated, "changed"),
+                (aliased, "bound to other names"),
+            ):
+                shared = check(source, names)
+                if shared is not None:
+                    yield rtf_pb2.RTFResponse(
+                        status=False,
+                        error=f"{shared} is shared by the session {name} with the "
+                        f"session {session.source}, it can't be {action}: bind a "
+                        f"copy of it first",
+                    )
+                    return
+            try:
+                for response in self._execute(builder, session.namespace):
+                    yield response
+                if response.status:
+                    session.record(statements, builder.binds)
+            finally:
+                # The subtrees abandoned after a failure still use the
+                # namespace: the session stays locked until they finish.
+                builder.idle.wait()
+
+    def _replay(self, statements, namespace):
+        """Execute again a program of the registry of a session, discarding
+        its standard output."""
         builder = Builder()
-        for statement in request_iterator:
-            builder.build(statement.stmt)
+        for node_id, parent_id, contexts, stmt, *value in statements:
+            builder.build(
+                stmt,
+                node_id,
+                parent_id,
+                contexts,
+                base64.b64decode(value[0]) if value else b"",
+            )
+        fp = DoubleIO(limit=0)
+        try:
+            builder(None, fp, namespace)
+        finally:
+            fp.close()
 
-        fp = DoubleIO()
-        stop = False
+    def _execute(self, builder, namespace=None) -> Iterator[rtf_pb2.RTFResponse]:
+        """Execute the program in builder, in namespace, yielding its
+        responses."""
+        fp = DoubleIO(limit=self._stdout_limit)
         response_q = queue.Queue()
 
         def executor():
-            with contextlib.redirect_stdout(fp):
-                output_value = builder()
-            fp.close()
-
             response = rtf_pb2.RTFResponse()
-            if output_value:
-                response.body = bytes(output_value)
-            response.status = True
-            response_q.put(response)
-            stop = True
+            # Every call has its own threads: the long programs don't hold
+            # the ones of the other calls.
+            pool = (
+                futures.ThreadPoolExecutor(self._max_workers)
+                if builder.concurrent
+                else None
+            )
+            try:
+                output_value = builder(pool, fp, namespace)
+                if output_value:
+                    response.body = bytes(output_value)
+                response.status = True
+            # Whatever the program raises (SystemExit, KeyboardInterrupt...)
+            # ends the call with a failure.
+            except BaseException as exception:  # pylint: disable=broad-except
+                response.node_id, response.error = builder.format_exception(exception)
+                response.status = False
+            finally:
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                fp.close()
+                threads[0].join()
+                response_q.put(response)
+                response_q.put(None)
 
         def stdout_sender():
-            while not fp.closed:
-                try:
-                    line = fp.readline()
-                    response = rtf_pb2.RTFResponse()
-                    response.stdout = line
-                    response.status = True
-                    response_q.put(response)
-                except IndexError as e:
-                    pass
+            while True:
+                batch = fp.read_batch(
+                    self._stdout_batch_size, self._stdout_batch_latency
+                )
+                if batch is None:
+                    break
+                # Consecutive lines of the same node are sent together, in
+                # responses of at most stdout_batch_size bytes.
+                for node_id, lines in itertools.groupby(batch, lambda line: line[0]):
+                    stdout = "".join(line for _, line in lines)
+                    for chunk in _utf8_chunks(stdout, self._stdout_batch_size):
+                        response = rtf_pb2.RTFResponse()
+                        response.node_id = node_id
+                        response.stdout = chunk
+                        response.status = True
+                        response_q.put(response)
+
+            if fp.dropped:
+                response = rtf_pb2.RTFResponse()
+                response.stdout = (
+                    f"[rtf: stdout truncated, {fp.dropped} bytes dropped]\n"
+                )
+                response.stdout_truncated = True
+                response.status = True
+                response_q.put(response)
 
         threads = [
             threading.Thread(target=stdout_sender),
@@ -134,8 +1186,7 @@ class RTFServicer(rtf_pb2_grpc.RTFServicer):
             thread.start()
 
         while True:
-            if stop:
-                while not response_q.empty():
-                    yield response_q.get()
+            response = response_q.get()
+            if response is None:
                 break
-            yield response_q.get()
+            yield response
@@ -0,0 +1,758 @@
+# Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sessions: the namespaces of the programs kept across the calls, and their
+snapshots on disk.
+
+The snapshot of a session is a folder of the session directory:
+- session.json: the program registry, the programs that bound the global
+  names of the session, and the handle table, the kind of every name;
+- variables.*: a TensorFlow checkpoint of the trackable objects (variables,
+  modules, models, optimizers...);
+- values/<name>.npy: the tensors and numpy arrays.
+A session is restored on first access: its programs are executed again, to
+create its objects, then their variables are restored from the checkpoint
+and the values are loaded. The statements that train or run the models
+(fit, evaluate, predict...) are not recorded: their effects on the variables
+come from the checkpoint, and the names they bind (e.g. the History of fit)
+are not restored, nor the statements that read them. A program that fails
+when executed again is logged and skipped. The snapshots can be copied to
+another server.
+
+A new session can be a clone of a session (e.g. one that loaded a model):
+its namespace is a copy of the one of the source, whose objects are shared,
+not copied, with their mutable state. The programs of the clone that change
+them (see mutated) or bind them to other names (see aliased) are rejected,
+but the check reads only their source: it's not a sandbox. The snapshot of
+a clone refers to its source, and contains only the names bound by its own
+programs.
+
+The clients keep the nodes computed by their programs in namespaces of their
+own (ClientNamespaces), in memory only: the next programs refer to them.
+"""
+
+import ast
+import base64
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import types
+import uuid
+
+from . import values
+
+_NAME = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.-]{0,127}")
+
+# Names of the namespace that are not part of the session.
+_RESERVED = ("__builtins__", "tf", "sys")
+
+# Methods that train or run a model: the statements calling them (outside of
+# the functions they define) are not recorded.
+_TRAINING = frozenset(
+    (
+        "fit",
+        "fit_generator",
+        "evaluate",
+        "evaluate_generator",
+        "predict",
+        "predict_generator",
+        "train_on_batch",
+        "test_on_batch",
+        "predict_on_batch",
+    )
+)
+
+
+# Methods that change their object, and the ones that change the objects
+# passed to them (the variables of the optimizers).
+_MUTATING = frozenset(
+    (
+        "assign",
+        "assign_add",
+        "assign_sub",
+        "scatter_add",
+        "scatter_sub",
+        "scatter_mul",
+        "scatter_div",
+        "scatter_min",
+        "scatter_max",
+        "scatter_update",
+        "scatter_nd_add",
+        "scatter_nd_sub",
+        "scatter_nd_update",
+        "batch_scatter_update",
+        "set_weights",
+        "load_weights",
+        "reset_states",
+        "reset_metrics",
+        "compile",
+        "build",
+        "add",
+        "pop",
+        "append",
+        "extend",
+        "insert",
+        "remove",
+        "clear",
+        "update",
+        "setdefault",
+        "popitem",
+        "discard",
+        "sort",
+        "reverse",
+    )
+    + ("fit", "fit_generator", "train_on_batch")
+)
+_MUTATING_ARGUMENTS = frozenset(("apply_gradients", "minimize"))
+
+
+def _root(node):
+    """The name at the root of an attribute, subscript or call chain, or
+    None."""
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def _targets(target):
+    """The attributes and items assigned by an assignment target."""
+    if isinstance(target, (ast.Tuple, ast.List)):
+        for element in target.elts:
+            yield from _targets(element)
+    elif isinstance(target, ast.Starred):
+        yield from _targets(target.value)
+    elif isinstance(target, (ast.Attribute, ast.Subscript)):
+        yield target
+
+
+def _changes(statement):
+    """The names whose objects the statement changes (see mutated)."""
+    for node in ast.walk(statement):
+        if isinstance(node, (ast.Assign, ast.Delete)):
+            for target in node.targets:
+                yield from (_root(t) for t in _targets(target))
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+            yield from (_root(t) for t in _targets(node.target))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if node.func.attr in _MUTATING | _MUTATING_ARGUMENTS:
+                yield _root(node.func.value)
+            if node.func.attr in _MUTATING_ARGUMENTS:
+                for argument in [*node.args, *(k.value for k in node.keywords)]:
+                    yield from (
+                        name.id
+                        for name in ast.walk(argument)
+                        if isinstance(name, ast.Name)
+                    )
+
+
+def _binds(statement):
+    """The global names bound by the statement."""
+    nodes = [statement]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            yield node.name
+            continue
+        if isinstance(node, ast.Lambda):
+            continue
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            yield node.id
+        elif isinstance(node, ast.alias):
+            yield (node.asname or node.name).partition(".")[0]
+        nodes.extend(ast.iter_child_nodes(node))
+
+
+def mutated(source, names):
+    """The first of names whose object the program source changes, as far
+    as its source tells: assigning (or deleting) its attributes or items,
+    calling its mutating methods (assign, fit, append...), or passing it to
+    apply_gradients or minimize. The names are checked until the program
+    binds them to other objects. None if the program doesn't change them."""
+    try:
+        body = ast.parse(source).body
+    except SyntaxError:
+        # The execution reports the error.
+        return None
+    names = set(names)
+    for statement in body:
+        for name in _changes(statement):
+            if name in names:
+                return name
+        names.difference_update(_binds(statement))
+    return None
+
+
+# Builtins whose result can be (or hold) their arguments.
+_ALIASING_BUILTINS = frozenset(
+    (
+        "getattr",
+        "vars",
+        "iter",
+        "next",
+        "list",
+        "tuple",
+        "set",
+        "frozenset",
+        "dict",
+        "sorted",
+        "reversed",
+        "enumerate",
+        "zip",
+        "map",
+        "filter",
+        "min",
+        "max",
+    )
+)
+# Builtins that neither return nor keep their arguments.
+_SAFE_BUILTINS = frozenset(
+    (
+        "print",
+        "len",
+        "str",
+        "repr",
+        "format",
+        "type",
+        "id",
+        "hash",
+        "bool",
+        "int",
+        "float",
+        "complex",
+        "abs",
+        "round",
+        "isinstance",
+        "issubclass",
+        "callable",
+        "hasattr",
+        "any",
+        "all",
+        "sum",
+    )
+)
+# Methods that return a part of their object, or its content.
+_ALIASING_METHODS = frozenset(
+    (
+        "get_layer",
+        "get",
+        "copy",
+        "items",
+        "values",
+        "__getattribute__",
+        "__getattr__",
+        "__getitem__",
+    )
+)
+
+
+def _alias(node, names):
+    """The first of names whose object (or a part of it) the value of the
+    expression node can be, or hold. None if it can't, as far as the
+    expression tells: calling an object, or its methods, returns a new
+    object."""
+    if isinstance(node, ast.Name):
+        return node.id if node.id in names else None
+    if isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred, ast.Await)):
+        return _alias(node.value, names)
+    if isinstance(node, ast.NamedExpr):
+        return _alias(node.value, names)
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        elements = node.elts
+    elif isinstance(node, ast.Dict):
+        elements = [key for key in node.keys if key is not None] + node.values
+    elif isinstance(node, ast.IfExp):
+        elements = [node.body, node.orelse]
+    elif isinstance(node, ast.BoolOp):
+        elements = node.values
+    elif isinstance(node, ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id in _ALIASING_BUILTINS:
+            elements = [*node.args, *(k.value for k in node.keywords)]
+        elif (
+            isinstance(node.func, ast.Attribute) and node.func.attr in _ALIASING_METHODS
+        ):
+            elements = [node.func.value]
+        else:
+            return None
+    else:
+        return None
+    for element in elements:
+        name = _alias(element, names)
+        if name is not None:
+            return name
+    return None
+
+
+def _aliases(statement, names, modules):
+    """The names whose objects the statement binds to other names or
+    places (see aliased)."""
+    for node in ast.walk(statement):
+        values = []
+        if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+            values.append(node.value)
+        elif isinstance(node, (ast.For, ast.AsyncFor, ast.comprehension)):
+            values.append(node.iter)
+        elif isinstance(node, ast.withitem) and node.optional_vars is not None:
+            values.append(node.context_expr)
+        elif isinstance(
+            node, (ast.NamedExpr, ast.Return, ast.Yield, ast.YieldFrom, ast.Await)
+        ):
+            values.append(node.value)
+        elif isinstance(node, ast.Lambda):
+            values.append(node.body)
+        elif isinstance(node, ast.arguments):
+            values.extend(node.defaults)
+            values.extend(node.kw_defaults)
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Call):
+                # e.g. getattr(v, "assign")(1)
+                values.append(node.func)
+            # The arguments are bound to the parameters of the function.
+            root = _root(node.func)
+            if not (
+                root in names
+                or root in modules
+                or isinstance(node.func, ast.Name)
+                and node.func.id in _SAFE_BUILTINS | _ALIASING_BUILTINS
+            ):
+                values.extend(node.args)
+                values.extend(k.value for k in node.keywords)
+        for value in values:
+            name = value is not None and _alias(value, names)
+            if name:
+                yield name
+
+
+def aliased(source, names):
+    """The first of names whose object the program source binds to other
+    names or places, as far as its source tells: assigning it (a part of
+    it, or a container holding it) to other names, attributes or items,
+    iterating over it, returning it from a function, or passing it to the
+    functions and methods that are not of the modules, of the objects in
+    names or safe builtins (e.g. `list.append`, `setattr`, the functions of
+    the program). The names are checked until the program binds them to
+    other objects. None if the program doesn't bind them."""
+    try:
+        body = ast.parse(source).body
+    except SyntaxError:
+        # The execution reports the error.
+        return None
+    names = set(names)
+    modules = {"tf", "sys"}
+    for statement in body:
+        for name in _aliases(statement, names, modules):
+            return name
+        modules.update(
+            (alias.asname or alias.name).partition(".")[0]
+            for node in ast.walk(statement)
+            if isinstance(node, (ast.Import, ast.ImportFrom))
+            for alias in node.names
+        )
+        names.difference_update(_binds(statement))
+    return None
+
+
+def _reads(stmt):
+    """The names the statement reads when executed: the bodies of the
+    functions it defines are not. None if the statement can't be parsed."""
+    try:
+        nodes = ast.parse(stmt).body
+    except SyntaxError:
+        # A part of a compound statement.
+        return None
+    names = set()
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            # The decorators and the default values are evaluated.
+            nodes.extend(getattr(node, "decorator_list", ()))
+            nodes.extend(node.args.defaults)
+            nodes.extend(d for d in node.args.kw_defaults if d is not None)
+            continue
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        nodes.extend(ast.iter_child_nodes(node))
+    return names
+
+
+def _trains(stmt):
+    """True if the statement calls a method in _TRAINING, outside of the
+    functions and the classes it defines."""
+    try:
+        nodes = ast.parse(stmt).body
+    except SyntaxError:
+        # A part of a compound statement.
+        return False
+    while nodes:
+        node = nodes.pop()
+        if isinstance(
+            node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+        ):
+            continue
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and node.func.attr in _TRAINING
+        ):
+            return True
+        nodes.extend(ast.iter_child_nodes(node))
+    return False
+
+
+# Kinds of the handles.
+TRACKABLE = "trackable"
+TENSOR = "tensor"
+ARRAY = "array"
+OBJECT = "object"
+
+
+class Session:
+    """The namespace of the programs of a session, executed one at a time."""
+
+    def __init__(self, name):
+        self.name = name
+        # None until the session is opened (and restored).
+        self.namespace = None
+        # The registry: the statements, as (node_id, parent_id, contexts,
+        # stmt[, value in base64]), of the programs that bound global names.
+        self.programs = []
+        # The names bound by the statements not recorded: the statements
+        # that read them are not recorded either.
+        self.skipped = set()
+        # The session cloned by this one, and the number of programs of the
+        # registry that come from it.
+        self.source = None
+        self.cloned = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def record(self, statements, binds):
+        """Record the successful execution of a program, that bound the
+        names in binds: its statements that build the objects, not the ones
+        that train them, nor the ones that read the names bound by them
+        (e.g. `loss = history.history["loss"]`), that would fail when
+        executed again."""
+        recorded = []
+        for statement in statements:
+            reads = _reads(statement.stmt)
+            try:
+                bound = set(_binds(ast.parse(statement.stmt)))
+            except SyntaxError:
+                bound = set()
+            if _trains(statement.stmt) or reads and reads & self.skipped:
+                self.skipped |= bound
+            else:
+                self.skipped -= bound
+                recorded.append(statement)
+        statements = recorded
+        if binds and statements:
+            self.programs.append(
+                [
+                    [s.node_id, s.parent_id, list(s.contexts), s.stmt]
+                    + ([base64.b64encode(s.value).decode()] if s.value else [])
+                    for s in statements
+                ]
+            )
+        self.dirty = True
+
+    def handles(self, exclude=()):
+        """The handle table: the kind of every name of the session, but the
+        names in exclude."""
+        import numpy as np
+        import tensorflow as tf
+
+        table = {}
+        for name, value in self.namespace.items():
+            if (
+                name in exclude
+                or name in _RESERVED
+                or name.startswith("rtf_")
+                or isinstance(value, types.ModuleType)
+            ):
+                continue
+            if isinstance(value, tf.Variable) or (
+                isinstance(value, tf.__internal__.tracking.Trackable)
+                and not isinstance(value, tf.data.Dataset)
+            ):
+                table[name] = TRACKABLE
+            elif tf.is_tensor(value) and value.dtype != tf.string:
+                table[name] = TENSOR
+            elif isinstance(value, np.ndarray) and not value.dtype.hasobject:
+                table[name] = ARRAY
+            else:
+                table[name] = OBJECT
+        return table
+
+
+class Sessions:
+    """The sessions of the server, snapshotted in directory (if any).
+    Thread safe."""
+
+    def __init__(self, directory=None):
+        """
+        Args:
+            directory: the folder of the snapshots, None to keep the sessions
+                       in memory only.
+        """
+        self.directory = directory
+        self._sessions = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, name):
+        """The session name, created on first use. Open it (holding its
+        lock) before using its namespace.
+
+        Raises:
+            ValueError: if name is not a valid session name.
+        """
+        if not _NAME.fullmatch(name):
+            raise ValueError(f"Invalid session name {name!r}")
+        with self._lock:
+            session = self._sessions.get(name)
+            if session is None:
+                session = self._sessions[name] = Session(name)
+            return session
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _snapshotted(self, name):
+        return bool(self.directory) and os.path.exists(
+            os.path.join(self._path(name), "session.json")
+        )
+
+    def open(self, session, replay, clone=None):
+        """Create the namespace of the session, restoring its snapshot if
+        any. A session neither in memory nor snapshotted is a clone of the
+        session clone, if given. The caller holds the session lock.
+
+        Args:
+            session: the Session.
+            replay: function(statements, namespace) that executes a program,
+                    a list of (node_id, parent_id, contexts, stmt[, value])
+                    as in the registry, in the namespace.
+            clone: the name of the session to clone, or None.
+
+        Raises:
+            ValueError: if the session to clone doesn't exist.
+        """
+        if session.namespace is not None:
+            return
+        if self._snapshotted(session.name):
+            self._restore(session, replay)
+        elif clone:
+            self._clone(session, clone, replay)
+        else:
+            session.namespace = {}
+
+    def _clone(self, session, name, replay):
+        """Open the session as a clone of the session name: its namespace
+        is a copy of the one of the source, that refers to the same objects.
+        Nothing is copied but the names: the clone is created immediately,
+        and the weights of the models (and their traced functions) are
+        shared by the source and its clones, with their mutable state."""
+        if name == session.name:
+            raise ValueError(f"The session {name} can't clone itself")
+        with self._lock:
+            exists = name in self._sessions
+        if not exists and not self._snapshotted(name):
+            raise ValueError(f"The session {name} doesn't exist")
+        source = self.get(name)
+        with source.lock:
+            self.open(source, replay)
+            session.namespace = dict(source.namespace)
+            session.programs = list(source.programs)
+            session.skipped = set(source.skipped)
+        session.source = name
+        session.cloned = len(session.programs)
+
+    def shared(self, session):
+        """The names of the session (a clone) still bound to the objects of
+        its source. The caller holds the session lock."""
+        if session.source is None:
+            return set()
+        source = self.get(session.source)
+        with source.lock:
+            return {
+                name
+                for name, value in (source.namespace or {}).items()
+                if session.namespace.get(name) is value
+            }
+
+    def _restore(self, session, replay):
+        """Open the session restoring its snapshot."""
+        import tensorflow as tf
+
+        path = self._path(session.name)
+        namespace = {}
+
+        with open(os.path.join(path, "session.json"), "r") as fp:
+            snapshot = json.load(fp)
+        # The snapshot of a clone has only what differs from its source.
+        programs = []
+        if snapshot.get("source"):
+            self._clone(session, snapshot["source"], replay)
+            namespace, programs = session.namespace, session.programs
+            session.namespace = None
+        restored = []
+        for statements in snapshot["programs"]:
+            try:
+                replay(statements, namespace)
+                restored.append(statements)
+            except Exception:  # pylint: disable=broad-except
+                # The session is opened without the names of the program,
+                # and its next programs that read them fail when executed
+                # again too.
+                logging.exception(
+                    "a program of the session %s failed when executed again, "
+                    "its names are not restored",
+                    session.name,
+                )
+                try:
+                    names = set(_binds(ast.parse("\n".join(s[3] for s in statements))))
+                except SyntaxError:
+                    names = set()
+                for name in names:
+                    namespace.pop(name, None)
+                session.skipped |= names
+
+        trackables = {}
+        for name, kind in snapshot["handles"].items():
+            if kind in (TENSOR, ARRAY):
+                with open(os.path.join(path, "values", f"{name}.npy"), "rb") as fp:
+                    value = values.loads(fp.read())
+                namespace[name] = tf.constant(value) if kind == TENSOR else value
+            elif kind == TRACKABLE and name in namespace:
+                trackables[name] = namespace[name]
+        if trackables:
+            tf.train.Checkpoint(
+                **{f"h_{name}": value for name, value in trackables.items()}
+            ).read(os.path.join(path, "variables")).expect_partial()
+
+        session.namespace = namespace
+        session.programs = programs + restored
+        session.skipped |= set(snapshot.get("skipped", ()))
+        logging.info("session %s restored from %s", session.name, path)
+
+    def snapshot(self, session):
+        """Write the snapshot of the session, replacing the previous one.
+        The caller holds the session lock."""
+        import tensorflow as tf
+
+        path = self._path(session.name)
+        tmp = os.path.join(self.directory, f".{session.name}.{uuid.uuid4().hex}")
+        os.makedirs(os.path.join(tmp, "values"))
+        try:
+            # The names of a clone still bound to the objects of its source
+            # are not part of its snapshot.
+            handles = session.handles(self.shared(session))
+            trackables = {}
+            for name, kind in handles.items():
+                value = session.namespace[name]
+                if kind == TRACKABLE:
+                    trackables[f"h_{name}"] = value
+                elif kind in (TENSOR, ARRAY):
+                    with open(os.path.join(tmp, "values", f"{name}.npy"), "wb") as fp:
+                        fp.write(values.dumps(value))
+            if trackables:
+                tf.train.Checkpoint(**trackables).write(os.path.join(tmp, "variables"))
+            with open(os.path.join(tmp, "session.json"), "w") as fp:
+                json.dump(
+                    {
+                        "programs": session.programs[session.cloned :],
+                        "handles": handles,
+                        "skipped": sorted(session.skipped),
+                        "source": session.source,
+                    },
+                    fp,
+                )
+
+            # The new snapshot replaces the previous one.
+            old = None
+            if os.path.exists(path):
+                old = f"{tmp}.old"
+                os.rename(path, old)
+            os.rename(tmp, path)
+            if old is not None:
+                shutil.rmtree(old, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        session.dirty = False
+
+    def snapshot_all(self):
+        """Snapshot the sessions changed since their last snapshot.
+        Returns the number of snapshots written."""
+        if not self.directory:
+            return 0
+        with self._lock:
+            sessions = list(self._sessions.values())
+        written = 0
+        for session in sessions:
+            with session.lock:
+                if not session.dirty or session.namespace is None:
+                    continue
+                try:
+                    self.snapshot(session)
+                    written += 1
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("snapshot of the session %s failed", session.name)
+        return written
+
+
+class ClientNamespaces:
+    """The names kept by the programs of every client (RTFStatement.keep),
+    for its next programs. The namespaces of the clients idle for ttl
+    seconds are dropped. Thread safe."""
+
+    def __init__(self, ttl):
+        """
+        Args:
+            ttl: seconds after which the namespace of an idle client is
+                 dropped.
+        """
+        self._ttl = ttl
+        # uuid -> (namespace, time of the last use)
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def namespace(self, uuid, release=()):
+        """A new namespace with the names kept by the client uuid, but the
+        names in release, removed from the ones kept."""
+        now = time.monotonic()
+        with self._lock:
+            for client in [
+                client
+                for client, (_, used) in self._clients.items()
+                if now - used > self._ttl
+            ]:
+                del self._clients[client]
+            kept, _ = self._clients.get(uuid, ({}, now))
+            for name in release:
+                kept.pop(name, None)
+            self._clients[uuid] = (kept, now)
+            return dict(kept)
+
+    def keep(self, uuid, namespace, names):
+        """Keep the names of namespace for the next programs of the client
+        uuid."""
+        with self._lock:
+            kept, _ = self._clients.get(uuid, ({}, 0))
+            kept.update((name, namespace[name]) for name in names if name in namespace)
+            self._clients[uuid] = (kept, time.monotonic())
@@ -0,0 +1,184 @@
+# Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared memory transport, between a server and the clients on its host.
+
+A client connected through a unix socket exchanges the large values in
+POSIX shared memory segments it owns, instead of copying them into the gRPC
+messages. Every call uses a segment: the uploaded values are written at its
+start, and the statements load them by offset and size (rtf_load_shared).
+The server writes the returned value in the rest of the segment
+(RTFResponse.shared_body). The control messages are the usual protos.
+"""
+
+import contextlib
+import threading
+import uuid
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+
+from .proto import rtf_pb2
+
+# Prefix of the names of the segments created by the clients.
+PREFIX = "rtf_"
+
+# Values smaller than this are sent in the messages.
+MIN_SIZE = 64 * 1024
+
+
+class Segment:
+    """A shared memory segment of a client, used by one call at a time."""
+
+    def __init__(self, size):
+        """
+        Args:
+            size: size of the segment in bytes.
+        """
+        self.memory = shared_memory.SharedMemory(
+            f"{PREFIX}{uuid.uuid4().hex}", create=True, size=size
+        )
+        self.used = 0
+
+    def put(self, data):
+        """Append data to the uploaded values. Returns its offset, or None
+        when it doesn't fit."""
+        if self.used + len(data) > self.memory.size:
+            return None
+        offset = self.used
+        self.memory.buf[offset : offset + len(data)] = data
+        self.used += len(data)
+        return offset
+
+    def region(self):
+        """The SharedRegion where the server can write the returned value."""
+        return rtf_pb2.SharedRegion(
+            name=self.memory.name, offset=self.used, size=self.memory.size - self.used
+        )
+
+    def view(self, region):
+        """The memoryview of the region of the segment."""
+        if region.name != self.memory.name:
+            raise ValueError(f"Region of the unknown segment {region.name}")
+        return self.memory.buf[region.offset : region.offset + region.size]
+
+    def close(self):
+        """Close and remove the segment."""
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SegmentPool:
+    """The segments of a client, created on demand and reused by the next
+    calls. Thread safe."""
+
+    def __init__(self, size):
+        """
+        Args:
+            size: size in bytes of every segment.
+        """
+        self.size = size
+        self._free = []
+        self._segments = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """A free segment, with no uploaded values."""
+        with self._lock:
+            if self._free:
+                segment = self._free.pop()
+                segment.used = 0
+                return segment
+        segment = Segment(self.size)
+        with self._lock:
+            self._segments.append(segment)
+        return segment
+
+    def release(self, segment):
+        """Give the segment back to the pool."""
+        with self._lock:
+            self._free.append(segment)
+
+    def close(self):
+        """Close and remove every segment."""
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments.clear()
+            self._free.clear()
+
+
+def _attach(name):
+    """Attach to the segment of a client. The segment is not registered in
+    the resource tracker: it must not be removed when the server exits."""
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Python < 3.13
+        memory = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(
+            memory._name, "shared_memory"  # pylint: disable=protected-access
+        )
+        return memory
+
+
+class AttachedSegments:
+    """The client segments attached by the server, kept open for the next
+    calls. At most max_segments unused segments are kept, the least recently
+    used are closed."""
+
+    def __init__(self, max_segments=64):
+        self._max_segments = max_segments
+        # name -> [SharedMemory, number of calls using it]
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def attach(self, name):
+        """Attach to the segment name for the duration of a call.
+        Yields its memoryview.
+
+        Raises:
+            ValueError: if name is not the name of a segment of a client.
+        """
+        if not name.startswith(PREFIX) or "/" in name:
+            raise ValueError(f"{name} is not a RTF shared memory segment")
+        with self._lock:
+            entry = self._segments.get(name)
+            if entry is not None:
+                self._segments.move_to_end(name)
+                entry[1] += 1
+        if entry is None:
+            entry = [_attach(name), 1]
+            with self._lock:
+                # Attached concurrently by another call: the first one is kept.
+                existing = self._segments.setdefault(name, entry)
+                if existing is not entry:
+                    existing[1] += 1
+            if existing is not entry:
+                entry[0].close()
+                entry = existing
+        try:
+            yield entry[0].buf
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                unused = [
+                    key for key, (_, calls) in self._segments.items() if not calls
+                ]
+                closing = [
+                    self._segments.pop(key)[0]
+                    for key in unused[: max(len(unused) - self._max_segments, 0)]
+                ]
+            for memory in closing:
+                memory.close()
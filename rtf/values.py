@@ -0,0 +1,70 @@
+# Copyright 2019 Paolo Galeone <nessuno@nerdz.eu>. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serialization of the values exchanged by the clients and the server.
+
+The values are numpy arrays, in the .npy format: no pickle is involved,
+neither side executes code sent by the other one.
+numpy is imported on first use: the clients that never exchange values
+don't pay its import.
+"""
+
+import io
+
+# Upper bound of the size of the .npy header (magic, version, length and
+# the header of version 2.0).
+_MAX_HEADER_SIZE = 12 + 65536
+
+
+def dumps(value):
+    """Serialize a tensor, numpy array, or Python scalar/sequence to bytes."""
+    import numpy as np
+
+    if hasattr(value, "numpy"):
+        value = value.numpy()
+    fp = io.BytesIO()
+    np.save(fp, np.asarray(value), allow_pickle=False)
+    return fp.getvalue()
+
+
+def loads(data):
+    """Deserialize the bytes created by dumps, to a numpy array
+    (to a numpy scalar, for 0-d arrays).
+    data can be any buffer, e.g. a region of shared memory (see rtf.shm):
+    the elements are copied once, the array doesn't refer to data."""
+    import numpy as np
+    from numpy.lib import format as npy
+
+    data = memoryview(data).cast("B")
+    header = io.BytesIO(data[:_MAX_HEADER_SIZE])
+    version = npy.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy.read_array_header_1_0(header)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = npy.read_array_header_2_0(header)
+    else:
+        value = np.load(io.BytesIO(data), allow_pickle=False)
+        return value[()] if value.ndim == 0 else value
+    if dtype.hasobject:
+        raise ValueError("Object arrays cannot be loaded when allow_pickle=False")
+
+    count = 1
+    for dim in shape:
+        count *= dim
+    value = (
+        np.frombuffer(data, dtype, count=count, offset=header.tell())
+        .reshape(shape, order="F" if fortran_order else "C")
+        .copy(order="K")
+    )
+    return value[()] if value.ndim == 0 else value